@@ -1,20 +1,33 @@
+import sys
+import time
+
+from rpython.rlib import rpoll
+from rpython.rlib.rarithmetic import ovfcheck, ovfcheck_float_to_int
+from rpython.rlib.listsort import make_timsort_class
+
 from trifle_types import (Function, FunctionWithEnv, Lambda, Macro, Special,
                           Integer, Float, Fraction, RBigInt,
-                          List, Hashmap, Keyword,
+                          List, Range, Hashmap, Keyword,
                           FileHandle, Bytestring, Character,
                           TRUE, FALSE, NULL, Symbol, String,
                           TrifleExceptionInstance, TrifleExceptionType,
-                          is_equal)
+                          LazySequence, EXHAUSTED, is_equal)
 from errors import (
-    ArityError, changing_closed_handle, division_by_zero,
+    ArityError, IncomparableValues, error, changing_closed_handle,
+    division_by_zero, wrong_argument_number, stack_overflow,
     wrong_type, file_not_found, value_error, missing_key,
 )
-from almost_python import deepcopy, copy, raw_input, list
+from almost_python import deepcopy, copy, raw_input
 from parameters import validate_parameters
 from lexer import lex
 from trifle_parser import parse
+from reader import Reader
 from arguments import check_args
 from hashable import check_hashable
+from continuations import Continuation, call_with_continuation
+from tasks import (
+    Task, SleepWait, YieldWait, PollWait, TaskWait,
+    scheduler, task_result, poll_ready, wait_on)
 
 
 class SetSymbol(FunctionWithEnv):
@@ -30,18 +43,17 @@ class SetSymbol(FunctionWithEnv):
                 u"The first argument to set-symbol! must be a symbol, but got: %s"
                 % variable_name.repr())
 
-        env.set(variable_name.symbol_name, variable_value)
+        env.set(variable_name, variable_value)
 
         return NULL
 
 
 class Let(Special):
-    def call(self, args, env, stack):
+    def check(self, args):
         # TODO: we should take at least two arguments.
         check_args(u'let', args, 1)
 
         bindings = args[0]
-        body = args[1:]
 
         if not isinstance(bindings, List):
             return TrifleExceptionInstance(
@@ -64,6 +76,12 @@ class Let(Special):
                 u"no value given for let-bound variable: %s"
                 % bindings.values[-1].repr())
 
+        return None
+
+    def call(self, args, env, stack):
+        bindings = args[0]
+        assert isinstance(bindings, List)
+
         # Fix circular import by importing here.
         from environment import LetScope
         from evaluator import Frame
@@ -96,7 +114,7 @@ class Let(Special):
                     previous_value = frame.evalled.pop()
 
                     let_scope = let_env.scopes[-1]
-                    let_scope.set(previous_sym.symbol_name, previous_value)
+                    let_scope.set(previous_sym, previous_value)
                 
                 frame.expression_index += 1
                 return None
@@ -114,36 +132,43 @@ class Let(Special):
                 previous_value = frame.evalled.pop()
                 
                 let_scope = let_env.scopes[-1]
-                let_scope.set(previous_sym.symbol_name, previous_value)
+                let_scope.set(previous_sym, previous_value)
                 
                 stack.push(Frame(bindings.values[2 * frame.let_assignment_index + 1], let_env))
                 frame.let_assignment_index += 1
                 return None
                 
-        elif frame.expression_index == 2:
-            # Evaluate the body now we have all the assignments.
-            stack.push(Frame(List(body), frame.let_environment, as_block=True))
-            
-            frame.expression_index += 1
-            return None
-
         else:
-            # Evalled body, just return the result
-            return frame.evalled[-1]
+            # Evaluate the body forms now we have all the
+            # assignments. The body starts at args[1].
+            body_index = frame.expression_index - 1
+
+            if body_index < len(args) - 1:
+                stack.push(Frame(args[body_index], frame.let_environment))
+
+                frame.expression_index += 1
+                return None
+
+            elif len(args) > 1:
+                # The last body form is in tail position, so it
+                # replaces this frame.
+                stack.replace(Frame(args[body_index], frame.let_environment))
+                return None
+
+            else:
+                return NULL
 
 
 class LambdaFactory(Special):
     """Return a fresh Lambda object every time it's called."""
 
-    def call(self, args, env, stack):
+    def check(self, args):
         check_args(u'lambda', args, 1)
 
-        parameters = args[0]
-
-        error = validate_parameters(parameters)
-        if error:
-            return error
+        return validate_parameters(args[0])
 
+    def call(self, args, env, stack):
+        parameters = args[0]
         lambda_body = List(args[1:])
         return Lambda(parameters, lambda_body, env)
 
@@ -155,26 +180,26 @@ class DefineMacro(Special):
 
     """
 
-    def call(self, args, env, stack):
+    def check(self, args):
         check_args(u'macro', args, 3)
 
         macro_name = args[0]
-        parameters = args[1]
-        
+
         if not isinstance(macro_name, Symbol):
             return TrifleExceptionInstance(
                 wrong_type,
                 u"macro name should be a symbol, but got: %s" %
                 macro_name.repr())
 
-        parameters = args[1]
-        error = validate_parameters(parameters)
+        return validate_parameters(args[1])
 
-        if error:
-            return error
+    def call(self, args, env, stack):
+        macro_name = args[0]
+        assert isinstance(macro_name, Symbol)
 
+        parameters = args[1]
         macro_body = List(args[2:])
-        env.set_global(macro_name.symbol_name,
+        env.set_global(macro_name,
                        Macro(macro_name.symbol_name, parameters, macro_body))
 
         return NULL
@@ -182,16 +207,17 @@ class DefineMacro(Special):
 
 # TODO: unit test
 # TODOC
-# TODO: add an expand-all-macros special too.
 # TODO: Could we make this a function?
 class ExpandMacro(Special):
     """Given an expression that is a macro call, expand it one step and
     return the resulting (unevaluated) expression.
 
     """
-    def call(self, args, env, stack):
+    def check(self, args):
         check_args(u'expand-macro', args, 1)
+        return None
 
+    def call(self, args, env, stack):
         expr = args[0]
 
         if not isinstance(expr, List):
@@ -218,6 +244,37 @@ class ExpandMacro(Special):
         return expand_macro(macro, macro_args, env)
 
 
+# TODO: Could we make this a function?
+class ExpandAllMacros(Special):
+    """Given an expression, return it with every macro call expanded,
+    recursively. The expression is not evaluated.
+
+    """
+    def check(self, args):
+        check_args(u'expand-all-macros', args, 1, 1)
+        return None
+
+    def call(self, args, env, stack):
+        from evaluator import expand_all_macros
+        return expand_all_macros(args[0], env)
+
+
+class MacroExpansionCounts(Function):
+    """Return a list of how many macro calls we have expanded, and how
+    many times we reused an earlier expansion of the same call.
+
+    """
+    def call(self, args):
+        check_args(u'macro-expansion-counts', args, 0, 0)
+
+        from evaluator import macro_counts
+
+        return List([
+            Integer.fromint(macro_counts.expansions),
+            Integer.fromint(macro_counts.cache_hits),
+        ])
+
+
 # todo: it would be nice to define this as a trifle macro using a 'literal' primitive
 # (e.g. elisp defines backquote in terms of quote)
 class Quote(Special):
@@ -257,7 +314,7 @@ class Quote(Special):
     
     # todo: fix the potential stack overflow
     def evaluate_unquote_calls(self, expression, env, stack):
-        from evaluator import evaluate
+        from evaluator import evaluate, is_thrown_exception, macro_reads
         if isinstance(expression, List):
             for index, item in enumerate(copy(expression).values):
                 if self.is_unquote(item):
@@ -267,7 +324,12 @@ class Quote(Special):
                             u"unquote takes 1 argument, but got: %s" % item.repr())
             
                     unquote_argument = item.values[1]
-                    expression.values[index] = evaluate(unquote_argument, env)
+                    unquoted_value = evaluate(unquote_argument, env)
+
+                    if is_thrown_exception(unquoted_value, error):
+                        return unquoted_value
+
+                    expression.set_index(index, unquoted_value)
                     
                 elif self.is_unquote_star(item):
                     if len(item.values) != 2:
@@ -277,13 +339,20 @@ class Quote(Special):
                     unquote_argument = item.values[1]
                     values_list = evaluate(unquote_argument, env)
 
+                    if is_thrown_exception(values_list, error):
+                        return values_list
+
                     if not isinstance(values_list, List):
                         return TrifleExceptionInstance(
                             wrong_type,
                             u"unquote* must be used with a list, but got a %s" % values_list.repr())
 
+                    # A macro expansion that splices a list depends on
+                    # its contents.
+                    macro_reads.note(values_list)
+
                     # Splice in the result of evaluating the unquote* argument
-                    expression.values = expression.values[:index] + values_list.values + expression.values[index+1:]
+                    expression.set_values(expression.values[:index] + values_list.values + expression.values[index+1:])
 
                 elif isinstance(item, List):
                     # recurse the nested list
@@ -294,7 +363,7 @@ class Quote(Special):
 
         return expression
     
-    def call(self, args, env, stack):
+    def check(self, args):
         check_args(u'quote', args, 1, 1)
 
         if isinstance(args[0], List) and args[0].values:
@@ -306,6 +375,10 @@ class Quote(Special):
                         value_error,
                         u"Can't call unquote* at top level of quote expression, you need to be inside a list.")
 
+        return None
+
+    def call(self, args, env, stack):
+
         result = self.evaluate_unquote_calls(List([deepcopy(args[0])]), env, stack)
 
         if isinstance(result, TrifleExceptionInstance):
@@ -315,9 +388,11 @@ class Quote(Special):
 
 
 class If(Special):
-    def call(self, args, environment, stack):
+    def check(self, args):
         check_args(u'if', args, 3, 3)
+        return None
 
+    def call(self, args, environment, stack):
         condition = args[0]
         then = args[1]
         otherwise = args[2]
@@ -344,16 +419,14 @@ class If(Special):
             # or 'otherwise' depending on the return value.
             evalled_condition = frame.evalled[-1]
             
+            # Both branches are in tail position, so the branch we
+            # take replaces this frame.
             if evalled_condition == TRUE:
-                stack.push(Frame(then, environment))
-                
-                frame.expression_index += 1
+                stack.replace(Frame(then, environment))
                 return None
 
             elif evalled_condition == FALSE:
-                stack.push(Frame(otherwise, environment))
-                
-                frame.expression_index += 2
+                stack.replace(Frame(otherwise, environment))
                 return None
 
             else:
@@ -361,19 +434,43 @@ class If(Special):
                     wrong_type,
                     u"The first argument to if must be a boolean, but got: %s" %
                     evalled_condition.repr())
-                
+
+
+class Do(Special):
+    """Evaluate each expression in turn, returning the value of the last.
+
+    This is a special expression rather than a function so the last
+    expression is in tail position.
+
+    """
+    def call(self, args, env, stack):
+        frame = stack.peek()
+
+        from evaluator import Frame
+
+        if not args:
+            return NULL
+
+        body_index = frame.expression_index
+
+        if body_index < len(args) - 1:
+            stack.push(Frame(args[body_index], env))
+
+            frame.expression_index += 1
+            return None
+
         else:
-            # We've evaluated the condition and either 'then' or
-            # 'otherwise', so pop this frame and return.
-            return frame.evalled[-1]
+            stack.replace(Frame(args[body_index], env))
+            return None
 
 
 class While(Special):
-    def call(self, args, env, stack):
+    def check(self, args):
         check_args(u'while', args, 1)
+        return None
 
+    def call(self, args, env, stack):
         condition = args[0]
-        body = List(args[1:])
 
         frame = stack.peek()
 
@@ -396,12 +493,7 @@ class While(Special):
             evalled_condition = frame.evalled[-1]
             
             if evalled_condition == TRUE:
-                stack.push(Frame(body, env, as_block=True))
-
-                # Once we've evaluated the body, we should evaluate
-                # the condition again.
-                frame.expression_index = 1
-
+                frame.expression_index += 1
                 return None
 
             elif evalled_condition == FALSE:
@@ -413,7 +505,27 @@ class While(Special):
                     wrong_type,
                     u"The first argument to while must be a boolean, but got: %s" %
                     evalled_condition.repr())
-        
+
+        else:
+            # We evaluate the body forms directly, rather than
+            # building a new List of them, so the JIT sees the same
+            # expressions on every iteration. The body starts at args[1].
+            body_index = frame.expression_index - 2
+
+            if body_index < len(args):
+                stack.push(Frame(args[body_index], env))
+
+                frame.expression_index += 1
+                return None
+
+            # We've evaluated the body, so discard the results and
+            # evaluate the condition again. The evaluator treats
+            # this jump backwards as a loop header for the JIT.
+            del frame.evalled[:]
+
+            frame.expression_index = 1
+            return None
+
 
 # todo: implement in prelude in terms of stdin and stdout
 class Input(Function):
@@ -428,22 +540,15 @@ class Input(Function):
                 % prefix.repr())
 
         user_input = raw_input(prefix.as_unicode())
-        return String([char for char in user_input])
+        return String.fromunicode(user_input)
 
 
 class Same(Function):
     def call(self, args):
         check_args(u'same?', args, 2, 2)
 
-        # Sadly, we can't access .__class__ in RPython.
-        # TODO: proper symbol interning.
-        if isinstance(args[0], Symbol):
-            if isinstance(args[1], Symbol):
-                if args[0].symbol_name == args[1].symbol_name:
-                    return TRUE
-
-            return FALSE
-
+        # Symbols and keywords are interned, so this is also true for
+        # two symbols or keywords with the same name.
         if args[0] is args[1]:
             return TRUE
         else:
@@ -472,7 +577,7 @@ class FreshSymbol(Function):
         symbol_name = u"%d-unnamed" % self.count
         self.count += 1
 
-        return Symbol(symbol_name)
+        return Symbol.intern(symbol_name)
 
 
 def coerce_numbers(nums):
@@ -504,7 +609,7 @@ def coerce_numbers(nums):
             if isinstance(num, Integer):
                 # TODO: This could overflow if the integer is outside
                 # the range of acceptable floats.
-                result.append(Float(num.bigint_value.tofloat()))
+                result.append(Float(num.tofloat()))
             elif isinstance(num, Fraction):
                 # TODO: Carefully document and unit test the corner cases
                 # here.
@@ -518,7 +623,7 @@ def coerce_numbers(nums):
         for num in nums:
             if isinstance(num, Integer):
                 # TODO: we need abitrary sized fractions too.
-                result.append(Fraction(num.bigint_value, RBigInt.fromint(1)))
+                result.append(Fraction(num.as_bigint(), RBigInt.fromint(1)))
             elif isinstance(num, Fraction):
                 result.append(num)
 
@@ -528,8 +633,55 @@ def coerce_numbers(nums):
         return nums
 
 
+def add_integers(x, y):
+    if x.is_small() and y.is_small():
+        try:
+            return Integer.fromint(ovfcheck(x.int_value + y.int_value))
+        except OverflowError:
+            pass
+
+    return Integer.frombigint(x.as_bigint().add(y.as_bigint()))
+
+
+def subtract_integers(x, y):
+    if x.is_small() and y.is_small():
+        try:
+            return Integer.fromint(ovfcheck(x.int_value - y.int_value))
+        except OverflowError:
+            pass
+
+    return Integer.frombigint(x.as_bigint().sub(y.as_bigint()))
+
+
+def multiply_integers(x, y):
+    if x.is_small() and y.is_small():
+        try:
+            return Integer.fromint(ovfcheck(x.int_value * y.int_value))
+        except OverflowError:
+            pass
+
+    return Integer.frombigint(x.as_bigint().mul(y.as_bigint()))
+
+
+def integer_less_than(x, y):
+    if x.is_small() and y.is_small():
+        return x.int_value < y.int_value
+
+    return x.as_bigint().lt(y.as_bigint())
+
+
 class Add(Function):
     def call(self, args):
+        # Fast path: most calls are on two integers or two floats,
+        # so we don't need to coerce.
+        if len(args) == 2:
+            x = args[0]
+            y = args[1]
+            if isinstance(x, Integer) and isinstance(y, Integer):
+                return add_integers(x, y)
+            elif isinstance(x, Float) and isinstance(y, Float):
+                return Float(x.float_value + y.float_value)
+
         float_args = False
         fraction_args = False
         
@@ -565,20 +717,32 @@ class Add(Function):
                 )
 
             if total.denominator.eq(RBigInt.fromint(1)):
-                return Integer(total.numerator)
+                return Integer.frombigint(total.numerator)
 
             return total
 
         else:
             # Just integers.
-            total = RBigInt.fromint(0)
-            for arg in args:
-                total = total.add(arg.bigint_value)
-            return Integer(total)
+            if not args:
+                return Integer.fromint(0)
+
+            total = args[0]
+            for arg in args[1:]:
+                total = add_integers(total, arg)
+            return total
 
 
 class Subtract(Function):
     def call(self, args):
+        # Fast path for two integers or two floats, see Add.
+        if len(args) == 2:
+            x = args[0]
+            y = args[1]
+            if isinstance(x, Integer) and isinstance(y, Integer):
+                return subtract_integers(x, y)
+            elif isinstance(x, Float) and isinstance(y, Float):
+                return Float(x.float_value - y.float_value)
+
         float_args = False
         fraction_args = False
         
@@ -599,7 +763,7 @@ class Subtract(Function):
 
         if len(args) == 1:
             if isinstance(args[0], Integer):
-                return Integer(args[0].bigint_value.neg())
+                return subtract_integers(Integer.fromint(0), args[0])
             elif isinstance(args[0], Fraction):
                 return Fraction(args[0].numerator.neg(), args[0].denominator)
             else:
@@ -626,19 +790,28 @@ class Subtract(Function):
                 )
 
             if total.denominator.eq(RBigInt.fromint(1)):
-                return Integer(total.numerator)
+                return Integer.frombigint(total.numerator)
 
             return total
 
         else:
-            total = args[0].bigint_value
+            total = args[0]
             for arg in args[1:]:
-                total = total.sub(arg.bigint_value)
-            return Integer(total)
+                total = subtract_integers(total, arg)
+            return total
 
 
 class Multiply(Function):
     def call(self, args):
+        # Fast path for two integers or two floats, see Add.
+        if len(args) == 2:
+            x = args[0]
+            y = args[1]
+            if isinstance(x, Integer) and isinstance(y, Integer):
+                return multiply_integers(x, y)
+            elif isinstance(x, Float) and isinstance(y, Float):
+                return Float(x.float_value * y.float_value)
+
         float_args = False
         fraction_args = False
         
@@ -675,15 +848,18 @@ class Multiply(Function):
             # TODO: It would be convenient to have RBIGINT_ZERO and RBIGINT_ONE
             # even if we don't cache small numbers the way Python does.
             if product.denominator.eq(RBigInt.fromint(1)):
-                return Integer(product.numerator)
+                return Integer.frombigint(product.numerator)
 
             return product
 
         else:
-            product = RBigInt.fromint(1)
-            for arg in args:
-                product = product.mul(arg.bigint_value)
-            return Integer(product)
+            if not args:
+                return Integer.fromint(1)
+
+            product = args[0]
+            for arg in args[1:]:
+                product = multiply_integers(product, arg)
+            return product
 
 
 class Divide(Function):
@@ -721,7 +897,7 @@ class Divide(Function):
 
         else:
             if isinstance(args[0], Integer):
-                quotient = Fraction(args[0].bigint_value, RBigInt.fromint(1))
+                quotient = Fraction(args[0].as_bigint(), RBigInt.fromint(1))
             elif isinstance(args[0], Fraction):
                 quotient = args[0]
             else:
@@ -730,13 +906,13 @@ class Divide(Function):
                 
             for arg in args[1:]:
                 if isinstance(arg, Integer):
-                    if arg.bigint_value.eq(RBigInt.fromint(0)):
+                    if arg.is_small() and arg.int_value == 0:
                         return TrifleExceptionInstance(
                             division_by_zero,
                             u"Divided %s by %s" % (quotient.repr(), arg.repr()))
                     
                     quotient = Fraction(
-                        quotient.numerator, quotient.denominator.mul(arg.bigint_value)
+                        quotient.numerator, quotient.denominator.mul(arg.as_bigint())
                     )
 
                 elif isinstance(arg, Fraction):
@@ -750,7 +926,7 @@ class Divide(Function):
                     )
 
             if quotient.denominator.eq(RBigInt.fromint(1)):
-                return Integer(quotient.numerator)
+                return Integer.frombigint(quotient.numerator)
 
             return quotient
             
@@ -766,12 +942,18 @@ class Mod(Function):
                     wrong_type,
                     u"mod requires integers, but got: %s." % arg.repr())
 
-        if args[1].bigint_value.eq(RBigInt.fromint(0)):
+        if args[1].is_small() and args[1].int_value == 0:
             return TrifleExceptionInstance(
                 division_by_zero,
                 u"Divided by zero: %s" % args[1].repr())
 
-        return Integer(args[0].bigint_value.mod(args[1].bigint_value))
+        # As with div, -sys.maxint - 1 mod -1 overflows in C, so we
+        # leave it to the bigint path.
+        if (args[0].is_small() and args[1].is_small() and
+            not (args[0].int_value == -sys.maxint - 1 and args[1].int_value == -1)):
+            return Integer.fromint(args[0].int_value % args[1].int_value)
+
+        return Integer.frombigint(args[0].as_bigint().mod(args[1].as_bigint()))
 
 
 class Div(Function):
@@ -791,18 +973,37 @@ class Div(Function):
                     wrong_type,
                     u"div requires integers, but got: %s." % arg.repr())
 
-        if args[1].bigint_value.eq(RBigInt.fromint(0)):
+        if args[1].is_small() and args[1].int_value == 0:
             return TrifleExceptionInstance(
                 division_by_zero,
                 u"Divided by zero: %s" % args[1].repr())
 
-        return Integer(args[0].bigint_value.floordiv(args[1].bigint_value))
+        # Dividing -sys.maxint - 1 by -1 is the only division of small
+        # integers that overflows.
+        if (args[0].is_small() and args[1].is_small() and
+            not (args[0].int_value == -sys.maxint - 1 and args[1].int_value == -1)):
+            return Integer.fromint(args[0].int_value // args[1].int_value)
+
+        return Integer.frombigint(args[0].as_bigint().floordiv(args[1].as_bigint()))
             
 
 class LessThan(Function):
     def call(self, args):
         check_args(u'<', args, 2)
 
+        # Fast path for comparing two integers or two floats.
+        if len(args) == 2:
+            x = args[0]
+            y = args[1]
+            if isinstance(x, Integer) and isinstance(y, Integer):
+                if integer_less_than(x, y):
+                    return TRUE
+                return FALSE
+            elif isinstance(x, Float) and isinstance(y, Float):
+                if x.float_value < y.float_value:
+                    return TRUE
+                return FALSE
+
         float_args = False
         fraction_args = False
 
@@ -849,7 +1050,7 @@ class LessThan(Function):
         else:
             # Only integers.
             for arg in args[1:]:
-                if not previous_number.bigint_value.lt(arg.bigint_value):
+                if not integer_less_than(previous_number, arg):
                     return FALSE
 
                 previous_number = arg
@@ -880,6 +1081,17 @@ class ListPredicate(Function):
             return FALSE
 
 
+class RangePredicate(Function):
+    def call(self, args):
+        check_args(u'range?', args, 1, 1)
+        value = args[0]
+
+        if isinstance(value, Range):
+            return TRUE
+        else:
+            return FALSE
+
+
 class HashmapPredicate(Function):
     def call(self, args):
         check_args(u'hashmap?', args, 1, 1)
@@ -924,6 +1136,20 @@ class CharacterPredicate(Function):
             return FALSE
 
 
+def index_as_int(index):
+    """Return a Trifle Integer as a Python int, for indexing into a
+    sequence. Integers that don't fit in a machine word are out of
+    range for any sequence, so we clamp them.
+
+    """
+    if index.is_small():
+        return index.int_value
+    elif index.bigint_value.sign > 0:
+        return sys.maxint
+    else:
+        return -sys.maxint
+
+
 class GetIndex(Function):
     def call(self, args):
         check_args(u'get-index', args, 2, 2)
@@ -931,11 +1157,13 @@ class GetIndex(Function):
         index = args[1]
 
         if isinstance(sequence, List):
-            sequence_length = RBigInt.fromint(len(sequence.values))
+            sequence_length = len(sequence.values)
         elif isinstance(sequence, Bytestring):
-            sequence_length = RBigInt.fromint(len(sequence.byte_value))
+            sequence_length = len(sequence.byte_value)
         elif isinstance(sequence, String):
-            sequence_length = RBigInt.fromint(len(sequence.string))
+            sequence_length = len(sequence.string)
+        elif isinstance(sequence, Range):
+            sequence_length = sequence.length
         else:
             return TrifleExceptionInstance(
                 wrong_type,
@@ -948,30 +1176,36 @@ class GetIndex(Function):
                 u"the second argument to get-index must be an integer, but got: %s"
                 % index.repr())
 
-        if sequence_length.eq(RBigInt.fromint(0)):
+        index_int = index_as_int(index)
+
+        if sequence_length == 0:
             return TrifleExceptionInstance(
                 value_error,
                 u"can't call get-item on an empty sequence")
 
         # todo: use a separate error class for index errors
-        if index.bigint_value.ge(sequence_length):
+        if index_int >= sequence_length:
             return TrifleExceptionInstance(
                 value_error,
                 u"the sequence has %s items, but you asked for index %s"
-                % (unicode(sequence_length.str()), index.repr()))
+                % (unicode(str(sequence_length)), index.repr()))
 
-        if index.bigint_value.lt(sequence_length.neg()):
+        if index_int < -sequence_length:
             return TrifleExceptionInstance(
                 value_error,
                 u"Can't get index %s of a %s element sequence (must be -%s or higher)"
-                % (index.repr(), unicode(sequence_length.str()), unicode(sequence_length.str())))
+                % (index.repr(), unicode(str(sequence_length)), unicode(str(sequence_length))))
 
         if isinstance(sequence, List):
-            return sequence.values[index.bigint_value.toint()]
+            return sequence.values[index_int]
         elif isinstance(sequence, Bytestring):
-            return Integer.fromint(sequence.byte_value[index.bigint_value.toint()])
+            return Integer.fromint(sequence.get_byte(index_int))
         elif isinstance(sequence, String):
-            return Character(sequence.string[index.bigint_value.toint()])
+            return Character.fromchar(sequence.string[index_int])
+        elif isinstance(sequence, Range):
+            if index_int < 0:
+                index_int += sequence_length
+            return Integer.fromint(sequence.get(index_int))
 
 
 class GetKey(Function):
@@ -1047,6 +1281,8 @@ class Length(Function):
             return Integer.fromint(len(sequence.byte_value))
         elif isinstance(sequence, String):
             return Integer.fromint(len(sequence.string))
+        elif isinstance(sequence, Range):
+            return Integer.fromint(sequence.length)
 
         return TrifleExceptionInstance(
             wrong_type,
@@ -1062,11 +1298,15 @@ class SetIndex(Function):
         value = args[2]
 
         if isinstance(sequence, List):
-            sequence_length = RBigInt.fromint(len(sequence.values))
+            sequence_length = len(sequence.values)
         elif isinstance(sequence, Bytestring):
-            sequence_length = RBigInt.fromint(len(sequence.byte_value))
+            sequence_length = len(sequence.byte_value)
         elif isinstance(sequence, String):
-            sequence_length = RBigInt.fromint(len(sequence.string))
+            sequence_length = len(sequence.string)
+        elif isinstance(sequence, Range):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"set-index! can't modify a range, but got: %s" % sequence.repr())
         else:
             return TrifleExceptionInstance(
                 wrong_type,
@@ -1079,51 +1319,41 @@ class SetIndex(Function):
                 u"the second argument to set-index! must be an integer, but got: %s"
                 % index.repr())
 
-        if sequence_length.eq(RBigInt.fromint(0)):
+        index_int = index_as_int(index)
+
+        if sequence_length == 0:
             return TrifleExceptionInstance(
                 value_error,
                 u"can't call set-index! on an empty sequence")
 
         # TODO: use a separate error class for index error
-        if index.bigint_value.ge(sequence_length):
+        if index_int >= sequence_length:
             return TrifleExceptionInstance(
                 value_error,
                 # TODO: pluralisation (to avoid '1 items')
                 u"the sequence has %s items, but you asked to set index %s"
-                % (unicode(sequence_length.str()), index.repr()))
+                % (unicode(str(sequence_length)), index.repr()))
 
-        if index.bigint_value.lt(sequence_length.neg()):
+        if index_int < -sequence_length:
             return TrifleExceptionInstance(
                 value_error,
                 u"Can't set index %s of a %s element sequence (must be -%s or higher)"
-                % (index.repr(), unicode(sequence_length.str()), unicode(sequence_length.str())))
+                % (index.repr(), unicode(str(sequence_length)), unicode(str(sequence_length))))
+
+        value_error_instance = check_sequence_value(sequence, value)
+        if value_error_instance is not None:
+            return value_error_instance
 
         if isinstance(sequence, List):
-            sequence.values[index.bigint_value.toint()] = value
+            sequence.set_index(index_int, value)
         elif isinstance(sequence, Bytestring):
-            if not isinstance(value, Integer):
-                return TrifleExceptionInstance(
-                    wrong_type,
-                    u"Permitted values inside bytestrings are only integers between 0 and 255, but got: %s"
-                    % value.repr())
-
-            if value.bigint_value.lt(RBigInt.fromint(0)) or value.bigint_value.gt(RBigInt.fromint(255)):
-                return TrifleExceptionInstance(
-                    value_error,
-                    u"Permitted values inside bytestrings are only integers between 0 and 255, but got: %s"
-                    % value.repr())
-
-            sequence.byte_value[index.bigint_value.toint()] = value.bigint_value.toint()
+            assert isinstance(value, Integer)
+            sequence.set_index(index_int, value.int_value)
         elif isinstance(sequence, String):
-            if not isinstance(value, Character):
-                return TrifleExceptionInstance(
-                    wrong_type,
-                    u"Permitted values inside strings are only characters, but got: %s"
-                    % value.repr())
-
+            assert isinstance(value, Character)
             # TODO: what if the list contains more than 2 ** 32 items?
             # We should remove all uses of .toint, it's risky.
-            sequence.string[index.bigint_value.toint()] = value.character
+            sequence.set_index(index_int, value.character)
 
         return NULL
 
@@ -1137,11 +1367,15 @@ class Insert(Function):
 
         if isinstance(sequence, List):
             # TODO: what if the sequence has more than 2**32 items?
-            sequence_length = RBigInt.fromint(len(sequence.values))
+            sequence_length = len(sequence.values)
         elif isinstance(sequence, Bytestring):
-            sequence_length = RBigInt.fromint(len(sequence.byte_value))
+            sequence_length = len(sequence.byte_value)
         elif isinstance(sequence, String):
-            sequence_length = RBigInt.fromint(len(sequence.string))
+            sequence_length = len(sequence.string)
+        elif isinstance(sequence, Range):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"insert! can't modify a range, but got: %s" % sequence.repr())
         else:
             return TrifleExceptionInstance(
                 wrong_type,
@@ -1154,173 +1388,1645 @@ class Insert(Function):
                 u"the second argument to insert! must be an integer, but got: %s"
                 % index.repr())
 
+        index_int = index_as_int(index)
+
         # todo: use a separate error class for index error
-        if index.bigint_value.gt(sequence_length):
+        if index_int > sequence_length:
             return TrifleExceptionInstance(
                 value_error,
                 u"the sequence has %s items, but you asked to insert at index %s"
-                % (unicode(sequence_length.str()), index.repr()))
+                % (unicode(str(sequence_length)), index.repr()))
 
-        if index.bigint_value.lt(sequence_length.neg()):
+        if index_int < -sequence_length:
             return TrifleExceptionInstance(
                 value_error,
                 u"Can't set index %s of a %s element sequence (must be -%s or higher)"
-                % (index.repr(), unicode(sequence_length.str()), unicode(sequence_length.str())))
+                % (index.repr(), unicode(str(sequence_length)), unicode(str(sequence_length))))
 
-        target_index = index.bigint_value
-        if target_index.lt(RBigInt.fromint(0)):
-            target_index = target_index.mod(sequence_length)
+        target_index_int = index_int
+        if target_index_int < 0:
+            target_index_int = target_index_int % sequence_length
 
-        target_index_int = target_index.toint()
         # We know that this is always non-negative, but RPython
         # cannot prove it. This if statement is just to keep
         # RPython happy.
         if target_index_int < 0:
             target_index_int = 0
 
+        value_error_instance = check_sequence_value(sequence, value)
+        if value_error_instance is not None:
+            return value_error_instance
+
         if isinstance(sequence, List):
-            sequence.values.insert(target_index_int, value)
+            sequence.insert(target_index_int, value)
         elif isinstance(sequence, Bytestring):
-            if not isinstance(value, Integer):
-                return TrifleExceptionInstance(
-                    wrong_type,
-                    u"Permitted values inside bytestrings are only integers between 0 and 255, but got: %s"
-                    % value.repr())
+            assert isinstance(value, Integer)
+            sequence.insert(target_index_int, value.int_value)
+        elif isinstance(sequence, String):
+            assert isinstance(value, Character)
+            sequence.insert(target_index_int, value.character)
 
-            if value.bigint_value.lt(RBigInt.fromint(0)) or value.bigint_value.gt(RBigInt.fromint(255)):
-                return TrifleExceptionInstance(
-                    value_error,
-                    u"Permitted values inside bytestrings are only integers between 0 and 255, but got: %s"
-                    % value.repr())
+        return NULL
 
-            sequence.byte_value.insert(target_index_int, value.bigint_value.toint())
-        elif isinstance(sequence, String):
-            if not isinstance(value, Character):
-                return TrifleExceptionInstance(
-                    wrong_type,
-                    u"Permitted values inside strings are only characters, but got: %s"
-                    % value.repr())
 
-            sequence.string.insert(target_index_int, value.character)
+def sequence_length(sequence):
+    """Return the number of elements in this sequence, or -1 if it isn't
+    a sequence.
 
-        return NULL
+    """
+    if isinstance(sequence, List):
+        return len(sequence.values)
+    elif isinstance(sequence, Bytestring):
+        return len(sequence.byte_value)
+    elif isinstance(sequence, String):
+        return len(sequence.string)
+    elif isinstance(sequence, Range):
+        return sequence.length
 
+    return -1
 
-class Parse(Function):
-    def call(self, args):
-        check_args(u'parse', args, 1, 1)
-        program_string = args[0]
 
-        if not isinstance(program_string, String):
-            return TrifleExceptionInstance(
-                wrong_type,
-                u"the first argument to parse must be a string, but got: %s"
-                % program_string.repr())
+def get_element(sequence, index):
+    """Return the element at this index as a Trifle value. The index
+    must be in range.
 
-        tokens = lex(program_string.as_unicode())
+    """
+    if isinstance(sequence, List):
+        return sequence.values[index]
+    elif isinstance(sequence, Bytestring):
+        return Integer.fromint(sequence.get_byte(index))
+    elif isinstance(sequence, String):
+        return Character.fromchar(sequence.string[index])
+    elif isinstance(sequence, Range):
+        return Integer.fromint(sequence.get(index))
 
-        if isinstance(tokens, TrifleExceptionInstance):
-            return tokens
-        
-        return parse(tokens)
+    assert False, "Not a sequence: %s" % sequence
 
 
-# todo: consider allowing the user to pass in an environment for sandboxing
-class Eval(FunctionWithEnv):
-    def call(self, args, env, stack):
-        check_args(u'eval', args, 1, 1)
+def empty_sequence(sequence):
+    """Return a new, empty sequence of the same type as this one. Ranges
+    can't be modified, so we return a list for them.
 
-        frame = stack.peek()
+    """
+    if isinstance(sequence, List) or isinstance(sequence, Range):
+        return List()
+    elif isinstance(sequence, Bytestring):
+        return Bytestring([])
+    elif isinstance(sequence, String):
+        return String([])
 
-        # Note that the expression index will already be 2, since
-        # evaluate_function_call will have iterated over our
-        # arguments.
-        from evaluator import Frame
+    assert False, "Not a sequence: %s" % sequence
 
-        # Evaluate our argument.
-        stack.push(Frame(args[0], env))
 
-        # Incrementing the expression_index will result in evaluate()
-        # just returning frame.evalled, so Eval.call will not be called again.
-        frame.expression_index += 1
-        return None
+def check_sequence_value(sequence, value):
+    """Return an exception if value can't be stored in this sequence,
+    otherwise None. Bytestrings may only contain integers between 0
+    and 255, strings may only contain characters, and ranges can't be
+    modified at all.
 
-class Call(FunctionWithEnv):
-    def call(self, args, env, stack):
-        check_args(u'call', args, 2, 2)
-        function = args[0]
-        arguments = args[1]
+    """
+    if isinstance(sequence, Range):
+        return TrifleExceptionInstance(
+            wrong_type,
+            u"Ranges can't be modified, but got: %s" % sequence.repr())
 
-        # Sadly, RPython doesn't support isinstance(x, (A, B)).
-        if not (isinstance(function, Function) or isinstance(function, FunctionWithEnv)
-                or isinstance(function, Lambda)):
+    elif isinstance(sequence, Bytestring):
+        if not isinstance(value, Integer):
             return TrifleExceptionInstance(
                 wrong_type,
-                u"the first argument to call must be a function, but got: %s"
-                % function.repr())
+                u"Permitted values inside bytestrings are only integers between 0 and 255, but got: %s"
+                % value.repr())
 
-        if not isinstance(arguments, List):
+        if not value.is_small() or value.int_value < 0 or value.int_value > 255:
+            return TrifleExceptionInstance(
+                value_error,
+                u"Permitted values inside bytestrings are only integers between 0 and 255, but got: %s"
+                % value.repr())
+
+    elif isinstance(sequence, String):
+        if not isinstance(value, Character):
             return TrifleExceptionInstance(
                 wrong_type,
-                u"the second argument to call must be a list, but got: %s"
-                % arguments.repr())
+                u"Permitted values inside strings are only characters, but got: %s"
+                % value.repr())
 
-        frame = stack.peek()
+    return None
 
-        # Note that the expression index will already be 3, since
-        # evaluate_function_call will have iterated over our
-        # arguments. We just increment from there.
-        if frame.expression_index == 3:
-            # Build an equivalent expression
-            expression = List([function] + arguments.values)
 
-            from evaluator import Frame
-            new_frame = Frame(expression, env)
+def append_value(sequence, value):
+    """Append value to the end of this sequence. Returns an exception if
+    the sequence can't contain value, otherwise None.
 
-            # Ensure that we don't evaluate the arguments to the function
-            # a second time.
-            new_frame.expression_index = len(arguments.values) + 1
-            new_frame.evalled = [function] + arguments.values
+    """
+    value_error_instance = check_sequence_value(sequence, value)
+    if value_error_instance is not None:
+        return value_error_instance
 
-            # Call the function.
-            stack.push(new_frame)
+    if isinstance(sequence, List):
+        sequence.append(value)
+    elif isinstance(sequence, Bytestring):
+        assert isinstance(value, Integer)
+        sequence.insert(len(sequence.byte_value), value.int_value)
+    elif isinstance(sequence, String):
+        assert isinstance(value, Character)
+        sequence.insert(len(sequence.string), value.character)
 
-            # Increment expression_index to show there's nothing left to do here.
-            frame.expression_index += 1
-            return None
+    return None
 
 
-# todo: rename to DefinedPredicate
-class Defined(FunctionWithEnv):
+def copy_sequence(sequence):
+    """Return a shallow copy of this sequence. Copying a range gives a
+    list of its elements.
+
+    """
+    if isinstance(sequence, List):
+        return List(sequence.values[:])
+    elif isinstance(sequence, Range):
+        return List([Integer.fromint(sequence.get(index))
+                     for index in range(sequence.length)])
+    elif isinstance(sequence, Bytestring):
+        return Bytestring(sequence.byte_value[:])
+    elif isinstance(sequence, String):
+        return String(sequence.string[:])
+
+    assert False, "Not a sequence: %s" % sequence
+
+
+class EmptyPredicate(FunctionWithEnv):
     def call(self, args, env, stack):
-        check_args(u'defined?', args, 1, 1)
-        symbol = args[0]
+        check_args(u'empty?', args, 1, 1)
+        sequence = args[0]
 
-        if not isinstance(symbol, Symbol):
+        # Finding out if a lazy sequence is empty means computing
+        # its next element.
+        if isinstance(sequence, LazySequence):
+            return PeekContinuation(sequence).run(stack)
+
+        length = sequence_length(sequence)
+        if length == -1:
             return TrifleExceptionInstance(
                 wrong_type,
-                u"the first argument to defined? must be a symbol, but got: %s"
-                % symbol.repr())
+                u"the first argument to empty? must be a sequence, but got: %s"
+                % sequence.repr())
 
-        if env.contains(symbol.symbol_name):
+        if length == 0:
             return TRUE
         else:
             return FALSE
 
 
-# TODO: error on a file we can't write to
-# TODO: error when we run out of file handles
-# TODO: other errors the file system can throw at us
-class Open(Function):
+class Append(Function):
     def call(self, args):
-        check_args(u'open', args, 2, 2)
-        path = args[0]
+        check_args(u'append!', args, 2, 2)
+        sequence = args[0]
 
-        if not isinstance(path, String):
+        if sequence_length(sequence) == -1:
             return TrifleExceptionInstance(
                 wrong_type,
-                u"the first argument to open must be a string, but got: %s"
-                % path.repr())
+                u"the first argument to append! must be a sequence, but got: %s"
+                % sequence.repr())
+
+        append_error = append_value(sequence, args[1])
+        if append_error is not None:
+            return append_error
+
+        return NULL
+
+
+class Copy(Function):
+    def call(self, args):
+        check_args(u'copy', args, 1, 1)
+        sequence = args[0]
+
+        if sequence_length(sequence) == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to copy must be a sequence, but got: %s"
+                % sequence.repr())
+
+        return copy_sequence(sequence)
+
+
+class Rest(Function):
+    def call(self, args):
+        check_args(u'rest', args, 1, 1)
+        sequence = args[0]
+
+        length = sequence_length(sequence)
+        if length == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to rest must be a sequence, but got: %s"
+                % sequence.repr())
+
+        if length == 0:
+            return empty_sequence(sequence)
+
+        if isinstance(sequence, List):
+            return List(sequence.values[1:])
+        elif isinstance(sequence, Bytestring):
+            return Bytestring(sequence.byte_value[1:])
+        elif isinstance(sequence, String):
+            return String(sequence.string[1:])
+        elif isinstance(sequence, Range):
+            if length == 1:
+                return Range(sequence.stop, sequence.stop, sequence.step)
+            return Range(sequence.get(1), sequence.stop, sequence.step)
+
+
+def join_sequences(sequence, sequences, function_name):
+    """Append every element of each of sequences to sequence. Returns an
+    exception if any of them isn't a sequence or contains a value that
+    sequence can't hold, otherwise None.
+
+    """
+    for additional_sequence in sequences:
+        # We find the length first, so joining a sequence with itself
+        # terminates.
+        length = sequence_length(additional_sequence)
+        if length == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the arguments to %s must be sequences, but got: %s"
+                % (function_name, additional_sequence.repr()))
+
+        for index in range(length):
+            append_error = append_value(
+                sequence, get_element(additional_sequence, index))
+            if append_error is not None:
+                return append_error
+
+    return None
+
+
+class JoinMutate(Function):
+    def call(self, args):
+        check_args(u'join!', args, 1)
+        sequence = args[0]
+
+        if sequence_length(sequence) == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to join! must be a sequence, but got: %s"
+                % sequence.repr())
+
+        if isinstance(sequence, Range):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"join! can't modify a range, but got: %s" % sequence.repr())
+
+        join_error = join_sequences(sequence, args[1:], u'join!')
+        if join_error is not None:
+            return join_error
+
+        return NULL
+
+
+class Join(Function):
+    def call(self, args):
+        check_args(u'join', args, 1)
+        sequence = args[0]
+
+        if sequence_length(sequence) == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to join must be a sequence, but got: %s"
+                % sequence.repr())
+
+        result = copy_sequence(sequence)
+
+        join_error = join_sequences(result, args[1:], u'join')
+        if join_error is not None:
+            return join_error
+
+        return result
+
+
+def range_bound(value):
+    """Return the smallest Python int that is greater than or equal to
+    this Trifle number. Raises OverflowError if it doesn't fit in a
+    machine word.
+
+    """
+    if isinstance(value, Integer):
+        if not value.is_small():
+            raise OverflowError
+        return value.int_value
+    elif isinstance(value, Float):
+        bound = ovfcheck_float_to_int(value.float_value)
+        if bound < value.float_value:
+            bound = ovfcheck(bound + 1)
+        return bound
+    elif isinstance(value, Fraction):
+        # Python division rounds towards negative infinity, so we
+        # negate to round up instead.
+        return value.numerator.neg().div(value.denominator).neg().toint()
+
+    assert False, "Not a number: %s" % value
+
+
+class RangeFactory(Function):
+    def call(self, args):
+        check_args(u'range', args, 1, 3)
+
+        if len(args) == 1:
+            maximum = args[0]
+
+            is_negative = LessThan().call([maximum, Integer.fromint(0)])
+            if isinstance(is_negative, TrifleExceptionInstance):
+                return is_negative
+
+            if is_negative is TRUE:
+                return TrifleExceptionInstance(
+                    value_error,
+                    u"The function `range` requires a number greater than 0, but got: %s"
+                    % maximum.repr())
+
+            # For floats and fractions, we want every integer that's
+            # less than maximum.
+            try:
+                return Range(0, range_bound(maximum), 1)
+            except OverflowError:
+                return TrifleExceptionInstance(
+                    value_error,
+                    u"The function `range` can't create a range of %s items"
+                    % maximum.repr())
+
+        for arg in args:
+            if not isinstance(arg, Integer):
+                return TrifleExceptionInstance(
+                    wrong_type,
+                    u"The function `range` requires integers when given a start, but got: %s"
+                    % arg.repr())
+
+        step = Integer.fromint(1)
+        if len(args) == 3:
+            step = args[2]
+            assert isinstance(step, Integer)
+
+            if step.is_small() and step.int_value == 0:
+                return TrifleExceptionInstance(
+                    value_error,
+                    u"The function `range` requires a non-zero step")
+
+        try:
+            return Range(range_bound(args[0]), range_bound(args[1]),
+                         range_bound(step))
+        except OverflowError:
+            return TrifleExceptionInstance(
+                value_error,
+                u"The function `range` can't create a range from %s to %s"
+                % (args[0].repr(), args[1].repr()))
+
+
+class EachElementContinuation(Continuation):
+    """Call function with each element of sequence in turn, passing
+    each result to handle_result, which builds self.result.
+
+    """
+    def __init__(self, function, sequence, environment):
+        self.function = function
+        self.sequence = sequence
+        self.environment = environment
+        self.index = 0
+        self.result = empty_sequence(sequence)
+
+    def run(self, stack):
+        from evaluator import is_thrown_exception
+
+        # Like for-each, we check the length on every iteration, in
+        # case function modifies the sequence.
+        while self.index < sequence_length(self.sequence):
+            element = get_element(self.sequence, self.index)
+            function = self.function
+
+            if isinstance(function, Function):
+                # Built-ins that don't take the environment can't
+                # touch the stack, so we call them directly.
+                value = function.call([element])
+                if is_thrown_exception(value, error):
+                    return value
+            else:
+                call_with_continuation(
+                    stack, self, function, [element], self.environment)
+                return None
+
+            handle_error = self.handle_result(value)
+            if handle_error is not None:
+                return handle_error
+
+            self.index += 1
+
+        return self.result
+
+    def resume(self, result, stack):
+        handle_error = self.handle_result(result)
+        if handle_error is not None:
+            return handle_error
+
+        self.index += 1
+        return self.run(stack)
+
+
+class MapContinuation(EachElementContinuation):
+    def handle_result(self, value):
+        return append_value(self.result, value)
+
+
+class FilterContinuation(EachElementContinuation):
+    def handle_result(self, value):
+        if value is TRUE:
+            return append_value(
+                self.result, get_element(self.sequence, self.index))
+        elif value is FALSE:
+            return None
+
+        return TrifleExceptionInstance(
+            wrong_type,
+            u"the function given to filter must return a boolean, but got: %s"
+            % value.repr())
+
+
+class Map(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'map', args, 2, 2)
+        function = args[0]
+        sequence = args[1]
+
+        if sequence_length(sequence) == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the second argument to map must be a sequence, but got: %s"
+                % sequence.repr())
+
+        return MapContinuation(function, sequence, env).run(stack)
+
+
+class Filter(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'filter', args, 2, 2)
+        function = args[0]
+        sequence = args[1]
+
+        if sequence_length(sequence) == -1:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the second argument to filter must be a sequence, but got: %s"
+                % sequence.repr())
+
+        return FilterContinuation(function, sequence, env).run(stack)
+
+
+def is_thrown(value):
+    """Is this the result of a failed computation, rather than a value?"""
+    from evaluator import is_thrown_exception
+    return is_thrown_exception(value, error)
+
+
+def deliver(element, continuation, stack):
+    """Pass a pulled element to continuation.resume, unless we're still
+    waiting for it or computing it failed.
+
+    """
+    if element is None or is_thrown(element):
+        return element
+
+    return continuation.resume(element, stack)
+
+
+class SequenceIterator(LazySequence):
+    """The elements of an ordinary sequence, as a lazy sequence."""
+    def __init__(self, sequence):
+        LazySequence.__init__(self)
+        self.sequence = sequence
+        self.index = 0
+
+    def next_element(self, stack, continuation):
+        if self.index >= sequence_length(self.sequence):
+            return EXHAUSTED
+
+        element = get_element(self.sequence, self.index)
+        self.index += 1
+        return element
+
+
+class FileLines(LazySequence):
+    """The lines of a file handle, as bytestrings without the trailing
+    newline. We only read a line when it's asked for.
+
+    """
+    def __init__(self, handle):
+        LazySequence.__init__(self)
+        self.handle = handle
+
+    def next_element(self, stack, continuation):
+        handle = self.handle
+        if handle.is_closed:
+            return TrifleExceptionInstance(
+                changing_closed_handle,
+                u"File handle for %s is already closed." % handle.file_name.decode('utf-8'))
+
+        line = handle.file_handle.readline()
+        if not line:
+            return EXHAUSTED
+
+        if line[-1] == '\n':
+            end = len(line) - 1
+            assert end >= 0
+            line = line[:end]
+
+        return Bytestring.frombytes(line)
+
+
+class LazyMap(LazySequence):
+    def __init__(self, function, source, environment):
+        LazySequence.__init__(self)
+        self.function = function
+        self.source = source
+        self.environment = environment
+
+    def apply(self, element, stack, continuation):
+        """Call our function with element. Returns the result if we
+        could call it directly, otherwise the result is passed to
+        continuation.
+
+        """
+        function = self.function
+        if isinstance(function, Function):
+            return function.call([element])
+
+        call_with_continuation(
+            stack, continuation, function, [element], self.environment)
+        return None
+
+    def next_element(self, stack, continuation):
+        element = self.source.pull(
+            stack, LazyMapContinuation(self, continuation))
+        if element is None or element is EXHAUSTED or is_thrown(element):
+            return element
+
+        return self.apply(element, stack, continuation)
+
+
+class LazyMapContinuation(Continuation):
+    """Called when the source of a lazy-map has computed an element."""
+    def __init__(self, lazy_map, continuation):
+        self.lazy_map = lazy_map
+        self.continuation = continuation
+
+    def resume(self, element, stack):
+        if element is EXHAUSTED:
+            return self.continuation.resume(element, stack)
+
+        result = self.lazy_map.apply(element, stack, self.continuation)
+        return deliver(result, self.continuation, stack)
+
+
+def filter_decision(function_name, result):
+    """Check that the function given to a filter returned a boolean."""
+    if result is TRUE or result is FALSE or is_thrown(result):
+        return result
+
+    return TrifleExceptionInstance(
+        wrong_type,
+        u"the function given to %s must return a boolean, but got: %s"
+        % (function_name, result.repr()))
+
+
+class LazyFilter(LazySequence):
+    def __init__(self, function, source, environment):
+        LazySequence.__init__(self)
+        self.function = function
+        self.source = source
+        self.environment = environment
+
+    def test(self, element, stack, continuation):
+        """Call our function with element. Returns TRUE or FALSE if we
+        could call it directly, otherwise we pass element to
+        continuation if it's kept, or carry on looking if not.
+
+        """
+        function = self.function
+        if isinstance(function, Function):
+            return filter_decision(u'lazy-filter', function.call([element]))
+
+        call_with_continuation(
+            stack, LazyFilterTestContinuation(self, element, continuation),
+            function, [element], self.environment)
+        return None
+
+    def next_element(self, stack, continuation):
+        while True:
+            element = self.source.pull(
+                stack, LazyFilterContinuation(self, continuation))
+            if element is None or element is EXHAUSTED or is_thrown(element):
+                return element
+
+            decision = self.test(element, stack, continuation)
+            if decision is TRUE:
+                return element
+            elif decision is not FALSE:
+                return decision
+
+
+class LazyFilterContinuation(Continuation):
+    """Called when the source of a lazy-filter has computed an element."""
+    def __init__(self, lazy_filter, continuation):
+        self.lazy_filter = lazy_filter
+        self.continuation = continuation
+
+    def resume(self, element, stack):
+        if element is EXHAUSTED:
+            return self.continuation.resume(element, stack)
+
+        decision = self.lazy_filter.test(element, stack, self.continuation)
+        if decision is TRUE:
+            return self.continuation.resume(element, stack)
+        elif decision is FALSE:
+            element = self.lazy_filter.pull(stack, self.continuation)
+            return deliver(element, self.continuation, stack)
+
+        return decision
+
+
+class LazyFilterTestContinuation(Continuation):
+    """Called when the function given to lazy-filter has returned."""
+    def __init__(self, lazy_filter, element, continuation):
+        self.lazy_filter = lazy_filter
+        self.element = element
+        self.continuation = continuation
+
+    def resume(self, result, stack):
+        decision = filter_decision(u'lazy-filter', result)
+        if decision is TRUE:
+            return self.continuation.resume(self.element, stack)
+        elif decision is FALSE:
+            element = self.lazy_filter.pull(stack, self.continuation)
+            return deliver(element, self.continuation, stack)
+
+        return decision
+
+
+class Take(LazySequence):
+    def __init__(self, count, source):
+        LazySequence.__init__(self)
+        self.remaining = count
+        self.source = source
+
+    def next_element(self, stack, continuation):
+        if self.remaining <= 0:
+            return EXHAUSTED
+
+        self.remaining -= 1
+        return self.source.pull(stack, continuation)
+
+
+class Drop(LazySequence):
+    def __init__(self, count, source):
+        LazySequence.__init__(self)
+        self.remaining = count
+        self.source = source
+
+    def next_element(self, stack, continuation):
+        while self.remaining > 0:
+            element = self.source.pull(
+                stack, DropContinuation(self, continuation))
+            if element is None or element is EXHAUSTED or is_thrown(element):
+                return element
+
+            self.remaining -= 1
+
+        return self.source.pull(stack, continuation)
+
+
+class DropContinuation(Continuation):
+    """Called when the source of a drop has computed an element that
+    we're skipping.
+
+    """
+    def __init__(self, drop, continuation):
+        self.drop = drop
+        self.continuation = continuation
+
+    def resume(self, element, stack):
+        if element is EXHAUSTED:
+            return self.continuation.resume(element, stack)
+
+        self.drop.remaining -= 1
+        element = self.drop.pull(stack, self.continuation)
+        return deliver(element, self.continuation, stack)
+
+
+def as_lazy(value):
+    """Return value as a lazy sequence, or None if it isn't a sequence."""
+    if isinstance(value, LazySequence):
+        return value
+    elif sequence_length(value) != -1:
+        return SequenceIterator(value)
+
+    return None
+
+
+def check_lazy_arguments(function_name, args):
+    """Return an exception if args aren't a non-negative integer and a
+    sequence, otherwise None. take and drop accept these arguments.
+
+    """
+    check_args(function_name, args, 2, 2)
+    count = args[0]
+
+    if not isinstance(count, Integer):
+        return TrifleExceptionInstance(
+            wrong_type,
+            u"the first argument to %s must be an integer, but got: %s"
+            % (function_name, count.repr()))
+
+    if index_as_int(count) < 0:
+        return TrifleExceptionInstance(
+            value_error,
+            u"the first argument to %s must be 0 or greater, but got: %s"
+            % (function_name, count.repr()))
+
+    if as_lazy(args[1]) is None:
+        return TrifleExceptionInstance(
+            wrong_type,
+            u"the second argument to %s must be a sequence, but got: %s"
+            % (function_name, args[1].repr()))
+
+    return None
+
+
+class LazyMapFactory(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'lazy-map', args, 2, 2)
+        source = as_lazy(args[1])
+
+        if source is None:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the second argument to lazy-map must be a sequence, but got: %s"
+                % args[1].repr())
+
+        return LazyMap(args[0], source, env)
+
+
+class LazyFilterFactory(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'lazy-filter', args, 2, 2)
+        source = as_lazy(args[1])
+
+        if source is None:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the second argument to lazy-filter must be a sequence, but got: %s"
+                % args[1].repr())
+
+        return LazyFilter(args[0], source, env)
+
+
+class TakeFactory(Function):
+    def call(self, args):
+        argument_error = check_lazy_arguments(u'take', args)
+        if argument_error is not None:
+            return argument_error
+
+        count = args[0]
+        assert isinstance(count, Integer)
+        return Take(index_as_int(count), as_lazy(args[1]))
+
+
+class DropFactory(Function):
+    def call(self, args):
+        argument_error = check_lazy_arguments(u'drop', args)
+        if argument_error is not None:
+            return argument_error
+
+        count = args[0]
+        assert isinstance(count, Integer)
+        return Drop(index_as_int(count), as_lazy(args[1]))
+
+
+class ReadLines(Function):
+    def call(self, args):
+        check_args(u'read-lines', args, 1, 1)
+        handle = args[0]
+
+        if not isinstance(handle, FileHandle):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to read-lines must be a file handle, but got: %s"
+                % handle.repr())
+
+        if handle.mode.symbol_name != u"read":
+            return TrifleExceptionInstance(
+                value_error,
+                u"%s is a write-only file handle, you can't read from it."
+                % handle.repr())
+
+        return FileLines(handle)
+
+
+class LazyPredicate(Function):
+    def call(self, args):
+        check_args(u'lazy?', args, 1, 1)
+        value = args[0]
+
+        if isinstance(value, LazySequence):
+            return TRUE
+        else:
+            return FALSE
+
+
+class RealizeContinuation(Continuation):
+    """Collect the remaining elements of a lazy sequence into a list."""
+    def __init__(self, lazy):
+        self.lazy = lazy
+        self.values = []
+
+    def run(self, stack):
+        while True:
+            element = self.lazy.pull(stack, self)
+            if element is None or is_thrown(element):
+                return element
+            elif element is EXHAUSTED:
+                return List(self.values)
+
+            self.values.append(element)
+
+    def resume(self, element, stack):
+        if element is EXHAUSTED:
+            return List(self.values)
+
+        self.values.append(element)
+        return self.run(stack)
+
+
+class Realize(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'realize', args, 1, 1)
+        lazy = as_lazy(args[0])
+
+        if lazy is None:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to realize must be a sequence, but got: %s"
+                % args[0].repr())
+
+        return RealizeContinuation(lazy).run(stack)
+
+
+class NextContinuation(Continuation):
+    """Take the next element of a lazy sequence."""
+    def __init__(self, lazy):
+        self.lazy = lazy
+
+    def run(self, stack):
+        element = self.lazy.pull(stack, self)
+        return deliver(element, self, stack)
+
+    def resume(self, element, stack):
+        if element is EXHAUSTED:
+            return TrifleExceptionInstance(
+                value_error,
+                u"next! was called on a lazy sequence with no elements left")
+
+        return element
+
+
+class Next(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'next!', args, 1, 1)
+        lazy = args[0]
+
+        if not isinstance(lazy, LazySequence):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to next! must be a lazy sequence, but got: %s"
+                % lazy.repr())
+
+        return NextContinuation(lazy).run(stack)
+
+
+class PeekContinuation(Continuation):
+    """Compute the next element of a lazy sequence without consuming it,
+    so we can tell if it's empty.
+
+    """
+    def __init__(self, lazy):
+        self.lazy = lazy
+
+    def run(self, stack):
+        element = self.lazy.pull(stack, self)
+        return deliver(element, self, stack)
+
+    def resume(self, element, stack):
+        self.lazy.peeked = element
+
+        if element is EXHAUSTED:
+            return TRUE
+        else:
+            return FALSE
+
+
+class Generator(LazySequence):
+    """A lazy sequence whose elements are the values passed to yield by
+    a block of code. Between elements, we keep the frames of the
+    block that haven't finished evaluating.
+
+    """
+    def __init__(self, frames):
+        LazySequence.__init__(self)
+        self.frames = frames
+
+        # Have we started evaluating the block, so frames are
+        # suspended inside a call to yield?
+        self.started = False
+
+        # Are our frames currently on the stack? If the block threw an
+        # error, its frames are gone, so we stay running.
+        self.running = False
+
+        # Set by yield, so GeneratorContinuation can tell a yielded
+        # value from the value the block returned.
+        self.yielded = False
+
+        self.finished = False
+
+    def next_element(self, stack, continuation):
+        from evaluator import MAX_STACK_DEPTH
+
+        if self.finished:
+            return EXHAUSTED
+
+        if self.running:
+            return TrifleExceptionInstance(
+                value_error,
+                u"Can't resume a generator that is already running or has thrown an error")
+
+        if len(stack.values) + len(self.frames) > MAX_STACK_DEPTH:
+            return TrifleExceptionInstance(
+                stack_overflow, u"Stack overflow")
+
+        # Put our frames back on top of the caller, so the evaluator
+        # carries on from where the block left off.
+        stack.peek().continuation = GeneratorContinuation(self, continuation)
+        for frame in self.frames:
+            stack.push(frame)
+        self.frames = []
+
+        # The call to yield that we suspended in returns #null.
+        if self.started:
+            stack.peek().evalled.append(NULL)
+
+        self.started = True
+        self.running = True
+        return None
+
+    def repr(self):
+        return u"<generator>"
+
+
+class GeneratorContinuation(Continuation):
+    """Called when a generator yields a value, or its block finishes."""
+    def __init__(self, generator, continuation):
+        self.generator = generator
+        self.continuation = continuation
+
+    def resume(self, result, stack):
+        generator = self.generator
+        generator.running = False
+
+        if generator.yielded:
+            generator.yielded = False
+            return self.continuation.resume(result, stack)
+
+        # The block has returned, so there are no more elements.
+        generator.finished = True
+        return self.continuation.resume(EXHAUSTED, stack)
+
+
+class GeneratorFactory(Special):
+    """Return a fresh Generator every time it's called. We don't
+    evaluate the body until the first element is asked for.
+
+    """
+    def call(self, args, env, stack):
+        from evaluator import Frame
+
+        generator = Generator([Frame(List(args), env, as_block=True)])
+
+        # We can't evaluate an empty block, but we know it can't
+        # yield anything.
+        if not args:
+            generator.finished = True
+
+        return generator
+
+
+class Yield(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'yield', args, 1, 1)
+
+        # Find the frame that's waiting for the innermost generator.
+        # Every frame above it belongs to the generator.
+        frames = stack.values
+        generator_index = len(frames) - 2
+        while generator_index >= 0:
+            if isinstance(frames[generator_index].continuation, GeneratorContinuation):
+                break
+            generator_index -= 1
+        else:
+            return TrifleExceptionInstance(
+                value_error,
+                u"yield can only be called inside a generator")
+
+        waiting_frame = frames[generator_index]
+        continuation = waiting_frame.continuation
+        assert isinstance(continuation, GeneratorContinuation)
+        generator = continuation.generator
+
+        # Suspend the generator's frames, apart from this call to
+        # yield, which is replaced by its return value when we resume.
+        stack.pop()
+        suspended = []
+        while len(stack.values) > generator_index + 1:
+            suspended.append(stack.pop())
+        suspended.reverse()
+
+        generator.frames = suspended
+        generator.yielded = True
+
+        # The evaluator will now pass the value to the waiting frame's
+        # continuation.
+        waiting_frame.evalled.append(args[0])
+        return None
+
+
+class Spawn(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'spawn', args, 1)
+        function = args[0]
+
+        if not (isinstance(function, Function) or isinstance(function, FunctionWithEnv)
+                or isinstance(function, Lambda)):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to spawn must be a function, but got: %s"
+                % function.repr())
+
+        from evaluator import Stack, call_frame
+
+        # We don't call the function until the scheduler gives the
+        # task a slice.
+        task_stack = Stack()
+        task_stack.push(call_frame(function, args[1:], env))
+        return scheduler.spawn(task_stack)
+
+
+class JoinTask(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'join-task', args, 1, 1)
+        task = args[0]
+
+        if not isinstance(task, Task):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to join-task must be a task, but got: %s"
+                % task.repr())
+
+        if task.finished:
+            return task_result(task)
+
+        if not scheduler.is_current(stack):
+            return TrifleExceptionInstance(
+                value_error,
+                u"Can't wait for a task whilst expanding a macro or evaluating a quote")
+
+        return wait_on(stack, TaskWait(task))
+
+
+class TaskPredicate(Function):
+    def call(self, args):
+        check_args(u'task?', args, 1, 1)
+        value = args[0]
+
+        if isinstance(value, Task):
+            return TRUE
+        else:
+            return FALSE
+
+
+def number_to_float(value):
+    """Convert a Trifle number to a Python float. Raises OverflowError
+    if it's too big.
+
+    """
+    if isinstance(value, Integer):
+        return value.tofloat()
+    elif isinstance(value, Float):
+        return value.float_value
+    elif isinstance(value, Fraction):
+        return value.numerator.truediv(value.denominator)
+
+    assert False, "Not a number: %s" % value
+
+
+class Sleep(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'sleep', args, 1, 1)
+        seconds = args[0]
+
+        if not is_number(seconds):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to sleep must be a number, but got: %s"
+                % seconds.repr())
+
+        try:
+            seconds_float = number_to_float(seconds)
+        except OverflowError:
+            return TrifleExceptionInstance(
+                value_error,
+                u"Can't sleep for %s seconds, it's too long" % seconds.repr())
+
+        if seconds_float < 0:
+            return TrifleExceptionInstance(
+                value_error,
+                u"Can't sleep for a negative number of seconds: %s"
+                % seconds.repr())
+
+        # Outside a task, there's nothing else to run, so we just block.
+        if not scheduler.is_current(stack):
+            time.sleep(seconds_float)
+            return NULL
+
+        return wait_on(stack, SleepWait(time.time() + seconds_float))
+
+
+class YieldNow(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'yield-now', args, 0, 0)
+
+        if not scheduler.is_current(stack):
+            return NULL
+
+        return wait_on(stack, YieldWait())
+
+
+class Poll(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'poll', args, 1, 1)
+        handle = args[0]
+
+        if not isinstance(handle, FileHandle):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to poll must be a file handle, but got: %s"
+                % handle.repr())
+
+        if handle.is_closed:
+            return TrifleExceptionInstance(
+                changing_closed_handle,
+                u"File handle for %s is closed." % handle.file_name.decode('utf-8'))
+
+        # Handles are opened for either reading or writing.
+        if handle.mode.symbol_name == u'read':
+            events = rpoll.POLLIN
+        else:
+            events = rpoll.POLLOUT
+
+        fd = handle.fileno()
+
+        if not scheduler.is_current(stack):
+            poll_ready(fd, events, -1)
+            return NULL
+
+        return wait_on(stack, PollWait(fd, events))
+
+
+def sort_less_than(x, y):
+    """Does x sort before y? We can compare numbers with numbers,
+    characters with characters and strings with strings, and raise
+    IncomparableValues otherwise.
+
+    """
+    if isinstance(x, Integer) and isinstance(y, Integer):
+        return integer_less_than(x, y)
+
+    elif isinstance(x, Character) and isinstance(y, Character):
+        return x.character < y.character
+
+    elif isinstance(x, String) and isinstance(y, String):
+        return x.as_unicode() < y.as_unicode()
+
+    elif is_number(x) and is_number(y):
+        return LessThan().call([x, y]) is TRUE
+
+    raise IncomparableValues(
+        u"sort can only compare numbers, characters or strings of the same type, but got: %s and %s"
+        % (x.repr(), y.repr()))
+
+
+IndexTimSort = make_timsort_class()
+
+
+class KeyIndexSort(IndexTimSort):
+    """Sorts a list of indexes into keys, by comparing the keys with
+    sort_less_than.
+
+    """
+    def __init__(self, indexes, keys):
+        IndexTimSort.__init__(self, indexes, len(indexes))
+        self.keys = keys
+
+    def lt(self, a, b):
+        return sort_less_than(self.keys[a], self.keys[b])
+
+
+def is_number(value):
+    return (isinstance(value, Integer) or isinstance(value, Float) or
+            isinstance(value, Fraction))
+
+
+# What a SortContinuation is waiting for.
+WAITING_FOR_KEY = 0
+WAITING_FOR_COMPARISON = 1
+
+
+class SortContinuation(Continuation):
+    """A stable sort of sequence, calling the key and comparison
+    functions (if any) with call_with_continuation. We sort the
+    elements into a new sequence if copy is True, otherwise we update
+    sequence in place.
+
+    Without a comparison function, we use timsort. Otherwise, we use
+    a merge sort that we can stop whenever we need to call the
+    comparison function, and resume when it returns.
+
+    """
+    def __init__(self, sequence, key_function, compare_function,
+                 environment, copy):
+        self.sequence = sequence
+        self.key_function = key_function
+        self.compare_function = compare_function
+        self.environment = environment
+        self.copy = copy
+
+        # The elements we're sorting, and the key we sort each by.
+        self.values = [get_element(sequence, index)
+                       for index in range(sequence_length(sequence))]
+        if key_function is None:
+            self.keys = self.values
+        else:
+            self.keys = []
+
+        # We sort a list of indexes into values. We merge pairs of
+        # sorted runs of length width from source into destination,
+        # then swap them and double width.
+        self.source = range(len(self.values))
+        self.destination = range(len(self.values))
+        self.width = 1
+
+        # The runs we're currently merging are source[low:middle] and
+        # source[middle:high]. left, right and output are our
+        # positions in the two runs and in destination.
+        self.low = 0
+        self.middle = 0
+        self.high = 0
+        self.left = 0
+        self.right = 0
+        self.output = 0
+        self.merging = False
+
+        self.waiting = WAITING_FOR_KEY
+
+    def call_function(self, function, arguments, waiting, stack):
+        """Call function, returning its result if it's a built-in that we
+        can call directly. Otherwise, return None and we'll be resumed
+        with the result.
+
+        """
+        if isinstance(function, Function):
+            return function.call(arguments)
+
+        self.waiting = waiting
+        call_with_continuation(
+            stack, self, function, arguments, self.environment)
+        return None
+
+    def take_comparison(self, result):
+        """result is whether the next element of the right run sorts
+        before the next element of the left run. Move whichever sorts
+        first to the output.
+
+        """
+        if result is TRUE:
+            self.destination[self.output] = self.source[self.right]
+            self.right += 1
+        elif result is FALSE:
+            # If the elements are equal, we take the left element, so
+            # the sort is stable.
+            self.destination[self.output] = self.source[self.left]
+            self.left += 1
+        else:
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the comparison function given to sort must return a boolean, but got: %s"
+                % result.repr())
+
+        self.output += 1
+        return None
+
+    def run(self, stack):
+        from evaluator import is_thrown_exception
+
+        length = len(self.values)
+
+        # Work out the key for every element.
+        while len(self.keys) < length:
+            element = self.values[len(self.keys)]
+            key = self.call_function(
+                self.key_function, [element], WAITING_FOR_KEY, stack)
+            if key is None:
+                return None
+            if is_thrown_exception(key, error):
+                return key
+
+            self.keys.append(key)
+
+        if self.compare_function is None:
+            # We can compare the keys without calling any Trifle code,
+            # so use RPython's timsort.
+            try:
+                KeyIndexSort(self.source, self.keys).sort()
+            except IncomparableValues as e:
+                return TrifleExceptionInstance(wrong_type, e.message)
+
+            return self.finish()
+
+        # Merge sort the indexes by their keys.
+        while self.width < length:
+            while self.low < length:
+                if not self.merging:
+                    self.middle = min(self.low + self.width, length)
+                    self.high = min(self.low + 2 * self.width, length)
+                    self.left = self.low
+                    self.right = self.middle
+                    self.output = self.low
+                    self.merging = True
+
+                while self.left < self.middle and self.right < self.high:
+                    right_key = self.keys[self.source[self.right]]
+                    left_key = self.keys[self.source[self.left]]
+
+                    result = self.call_function(
+                        self.compare_function, [right_key, left_key],
+                        WAITING_FOR_COMPARISON, stack)
+                    if result is None:
+                        return None
+
+                    if is_thrown_exception(result, error):
+                        return result
+
+                    comparison_error = self.take_comparison(result)
+                    if comparison_error is not None:
+                        return comparison_error
+
+                # One run is exhausted, so the rest of the other run
+                # is already in order.
+                while self.left < self.middle:
+                    self.destination[self.output] = self.source[self.left]
+                    self.left += 1
+                    self.output += 1
+
+                while self.right < self.high:
+                    self.destination[self.output] = self.source[self.right]
+                    self.right += 1
+                    self.output += 1
+
+                self.merging = False
+                self.low = self.high
+
+            self.source, self.destination = self.destination, self.source
+            self.width *= 2
+            self.low = 0
+
+        return self.finish()
+
+    def resume(self, result, stack):
+        if self.waiting == WAITING_FOR_KEY:
+            self.keys.append(result)
+        else:
+            comparison_error = self.take_comparison(result)
+            if comparison_error is not None:
+                return comparison_error
+
+        return self.run(stack)
+
+    def finish(self):
+        sorted_values = [self.values[index] for index in self.source]
+
+        if self.copy:
+            result = empty_sequence(self.sequence)
+            for value in sorted_values:
+                append_value(result, value)
+            return result
+
+        sequence = self.sequence
+        if isinstance(sequence, List):
+            sequence.set_values(sorted_values)
+        else:
+            for index, value in enumerate(sorted_values):
+                if isinstance(sequence, Bytestring):
+                    assert isinstance(value, Integer)
+                    sequence.set_index(index, value.int_value)
+                elif isinstance(sequence, String):
+                    assert isinstance(value, Character)
+                    sequence.set_index(index, value.character)
+
+        return NULL
+
+
+def check_sort_arguments(name, args):
+    """Return an exception if args aren't valid arguments to sort or
+    sort!, otherwise None. After the sequence, we accept the options
+    :key FUNCTION and :compare FUNCTION.
+
+    """
+    check_args(name, args, 1, 5)
+    sequence = args[0]
+
+    if sequence_length(sequence) == -1:
+        return TrifleExceptionInstance(
+            wrong_type,
+            u"the first argument to %s must be a sequence, but got: %s"
+            % (name, sequence.repr()))
+
+    options = args[1:]
+    if len(options) % 2 == 1:
+        return TrifleExceptionInstance(
+            wrong_argument_number,
+            u"%s options must be a keyword followed by a value, but got: %s"
+            % (name, List(options).repr()))
+
+    for index in range(0, len(options), 2):
+        option = options[index]
+
+        if not isinstance(option, Keyword):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"%s options must be keywords, but got: %s"
+                % (name, option.repr()))
+
+        if option.symbol_name != u'key' and option.symbol_name != u'compare':
+            return TrifleExceptionInstance(
+                value_error,
+                u"%s only accepts the options :key and :compare, but got: %s"
+                % (name, option.repr()))
+
+    return None
+
+
+def sort_option(args, option_name):
+    """Return the value given for this option to sort or sort!, or None
+    if it wasn't given.
+
+    """
+    value = None
+    for index in range(1, len(args) - 1, 2):
+        option = args[index]
+        assert isinstance(option, Keyword)
+
+        if option.symbol_name == option_name:
+            value = args[index + 1]
+
+    return value
+
+
+class Sort(FunctionWithEnv):
+    def call(self, args, env, stack):
+        argument_error = check_sort_arguments(u'sort', args)
+        if argument_error is not None:
+            return argument_error
+
+        continuation = SortContinuation(
+            args[0], sort_option(args, u'key'), sort_option(args, u'compare'),
+            env, True)
+        return continuation.run(stack)
+
+
+class SortMutate(FunctionWithEnv):
+    def call(self, args, env, stack):
+        argument_error = check_sort_arguments(u'sort!', args)
+        if argument_error is not None:
+            return argument_error
+
+        sequence = args[0]
+        if isinstance(sequence, Range):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"sort! can't modify a range, but got: %s" % sequence.repr())
+
+        continuation = SortContinuation(
+            args[0], sort_option(args, u'key'), sort_option(args, u'compare'),
+            env, False)
+        return continuation.run(stack)
+
+
+class Parse(Function):
+    def call(self, args):
+        check_args(u'parse', args, 1, 1)
+        program_string = args[0]
+
+        if not isinstance(program_string, String):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to parse must be a string, but got: %s"
+                % program_string.repr())
+
+        tokens = lex(program_string.as_unicode())
+
+        if isinstance(tokens, TrifleExceptionInstance):
+            return tokens
+        
+        return parse(tokens)
+
+
+# todo: consider allowing the user to pass in an environment for sandboxing
+class Eval(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'eval', args, 1, 1)
+
+        from evaluator import Frame, expand_all_macros
+
+        # Evaluate our argument, expanding its macros first. If we've
+        # evaluated it before, expansion gives us the same Lists, so
+        # we reuse their compiled forms. It's in tail position, so it
+        # replaces the frame of our call, and Eval.call will not be
+        # called again.
+        expression = expand_all_macros(args[0], env)
+        stack.replace(Frame(expression, env))
+        return None
+
+class Call(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'call', args, 2, 2)
+        function = args[0]
+        arguments = args[1]
+
+        # Sadly, RPython doesn't support isinstance(x, (A, B)).
+        if not (isinstance(function, Function) or isinstance(function, FunctionWithEnv)
+                or isinstance(function, Lambda)):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to call must be a function, but got: %s"
+                % function.repr())
+
+        if not isinstance(arguments, List):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the second argument to call must be a list, but got: %s"
+                % arguments.repr())
+
+        from evaluator import call_frame
+
+        # Call the function. This is a tail call, so the new frame
+        # replaces the frame of our call.
+        stack.replace(call_frame(function, arguments.values, env))
+        return None
+
+
+# todo: rename to DefinedPredicate
+class Defined(FunctionWithEnv):
+    def call(self, args, env, stack):
+        check_args(u'defined?', args, 1, 1)
+        symbol = args[0]
+
+        if not isinstance(symbol, Symbol):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to defined? must be a symbol, but got: %s"
+                % symbol.repr())
+
+        if env.contains(symbol):
+            return TRUE
+        else:
+            return FALSE
+
+
+# TODO: error on a file we can't write to
+# TODO: error when we run out of file handles
+# TODO: other errors the file system can throw at us
+class Open(Function):
+    def call(self, args):
+        check_args(u'open', args, 2, 2)
+        path = args[0]
+
+        if not isinstance(path, String):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to open must be a string, but got: %s"
+                % path.repr())
 
         flag = args[1]
 
@@ -1388,7 +3094,47 @@ class Read(Function):
                 u"the first argument to read must be a file handle, but got: %s"
                 % handle.repr())
 
-        return Bytestring([ord(c) for c in handle.file_handle.read()])
+        return Bytestring.frombytes(handle.file_handle.read())
+
+
+class ReadForms(Function):
+    def call(self, args):
+        check_args(u'read-forms', args, 1, 1)
+        handle = args[0]
+
+        if not isinstance(handle, FileHandle):
+            return TrifleExceptionInstance(
+                wrong_type,
+                u"the first argument to read-forms must be a file handle, but got: %s"
+                % handle.repr())
+
+        if handle.is_closed:
+            return TrifleExceptionInstance(
+                changing_closed_handle,
+                u"File handle for %s is already closed." % handle.file_name.decode('utf-8'))
+
+        if handle.mode.symbol_name != u"read":
+            return TrifleExceptionInstance(
+                value_error,
+                u"%s is a write-only file handle, you can't read from it."
+                % handle.repr())
+
+        # We read the file in chunks, so we never hold all its text
+        # or tokens at once.
+        reader = Reader(handle.file_handle)
+        expressions = []
+
+        while True:
+            expression = reader.read_expression()
+            if expression is None:
+                break
+
+            if isinstance(expression, TrifleExceptionInstance):
+                return expression
+
+            expressions.append(expression)
+
+        return List(expressions)
 
 
 class Write(Function):
@@ -1421,7 +3167,7 @@ class Write(Function):
                 u"the second argument to write! must be a bytes, but got: %s"
                 % to_write.repr())
 
-        handle.write("".join([chr(c) for c in to_write.byte_value]))
+        handle.write(to_write.as_bytes())
 
         return NULL
 
@@ -1460,7 +3206,7 @@ class Encode(Function):
                 % string.repr())
 
         string_as_bytestring = string.as_unicode().encode('utf-8')
-        return Bytestring([ord(c) for c in string_as_bytestring])
+        return Bytestring.frombytes(string_as_bytestring)
 
 
 # TODO: take a second argument that specifies the encoding.
@@ -1476,9 +3222,8 @@ class Decode(Function):
                 u"the first argument to decode must be bytes, but got: %s"
                 % bytestring.repr())
 
-        bytestring_chars = [chr(c) for c in bytestring.byte_value]
-        py_unicode = b"".join(bytestring_chars).decode('utf-8')
-        return String([char for char in py_unicode])
+        py_unicode = bytestring.as_bytes().decode('utf-8')
+        return String.fromunicode(py_unicode)
 
 
 # TODO: take an extra argument for return codes (and check against the maximum legal value).
@@ -1490,13 +3235,11 @@ class Exit(Function):
 
 
 class Try(Special):
-    def call(self, args, env, stack):
+    def check(self, args):
         # TODO: multiple catch blocks, finally, resuming.
         check_args(u'try', args, 5, 5)
 
-        body = args[0]
         catch_keyword = args[1]
-        raw_exception_type = args[2]
         exception_binding = args[3]
 
         if not isinstance(catch_keyword, Keyword) or catch_keyword.symbol_name != u"catch":
@@ -1511,6 +3254,12 @@ class Try(Special):
                 u"The fourth argument to try must be a symbol, but got: %s"
                 % exception_binding.repr())
 
+        return None
+
+    def call(self, args, env, stack):
+        body = args[0]
+        raw_exception_type = args[2]
+
         frame = stack.peek()
         from evaluator import Frame
 
@@ -1587,7 +3336,7 @@ class Message(Function):
                 u"The first argument to message must be an exception, but got: %s"
                 % exception.repr())
 
-        return String(list(exception.message))
+        return String.fromunicode(exception.message)
 
 
 class ExceptionType(Function):
@@ -1608,4 +3357,4 @@ class ExceptionType(Function):
 class Printable(Function):
     def call(self, args):
         check_args(u'printable', args, 1, 1)
-        return String(list(args[0].repr()))
+        return String.fromunicode(args[0].repr())
@@ -0,0 +1,36 @@
+"""Built-in functions that take a function argument (e.g. map) can't
+call it directly, because calling a lambda means evaluating its body
+on the current stack. Instead, the built-in stores a Continuation on
+its call frame and pushes a frame for the call. When the call
+returns, the evaluator passes the result to the continuation's resume
+method, and the built-in carries on from where it left off.
+
+"""
+
+
+class Continuation(object):
+    """The state of a built-in function that is waiting for the result
+    of a call. The evaluator passes the result to resume.
+
+    """
+    def ready(self):
+        """Can the evaluator resume us now? Continuations that suspend
+        the current task (see tasks.py) return False until whatever
+        they're waiting for has happened.
+
+        """
+        return True
+
+
+def call_with_continuation(stack, continuation, function, arguments, environment):
+    """Call function with this Python list of evaluated arguments. We
+    don't return a value: the evaluator will call continuation.resume
+    with the result. The caller should return None so the evaluator
+    evaluates the call.
+
+    """
+    from evaluator import call_frame
+
+    stack.peek().continuation = continuation
+    stack.push(call_frame(function, arguments, environment))
+
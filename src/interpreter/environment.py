@@ -1,16 +1,26 @@
+from rpython.rlib.jit import unroll_safe
+
 from built_ins import (
     Add, Subtract, Multiply, Divide, Mod, Div,
     LessThan, Same, Equal,
-    Quote, SetSymbol, Let, If, While,
-    LambdaFactory, DefineMacro, ExpandMacro, FreshSymbol,
-    Length, SymbolPredicate, ListPredicate,
+    Quote, SetSymbol, Let, If, Do, While,
+    LambdaFactory, DefineMacro, ExpandMacro, ExpandAllMacros,
+    MacroExpansionCounts,
+    FreshSymbol,
+    Length, SymbolPredicate, ListPredicate, RangePredicate,
     HashmapPredicate, StringPredicate,
     BytestringPredicate, CharacterPredicate,
     GetIndex, SetIndex, Insert,
+    EmptyPredicate, Append, Copy, Rest, Join, JoinMutate, RangeFactory,
+    Map, Filter, Sort, SortMutate,
+    LazyMapFactory, LazyFilterFactory, TakeFactory, DropFactory,
+    Realize, Next, LazyPredicate, ReadLines,
+    GeneratorFactory, Yield,
+    Spawn, JoinTask, TaskPredicate, Sleep, YieldNow, Poll,
     GetKey, SetKey, GetItems,
     Printable, Input, Exit,
     Call, Parse, Eval, Defined, Try,
-    Open, Close, Read, Write, Flush,
+    Open, Close, Read, ReadForms, Write, Flush,
     Encode, Decode,
     Throw, Message, ExceptionType,
 )
@@ -18,30 +28,45 @@ from errors import (
     error, stack_overflow, no_such_variable, parse_failed,
     lex_failed, value_error, wrong_type,
     wrong_argument_number, division_by_zero,
-    file_not_found, changing_closed_handle,
+    file_not_found, changing_closed_handle, deadlock,
 )
 from trifle_types import (
-    String, Stdout)
-from almost_python import list
+    String, Stdout, Symbol)
+
+
+def binding_names(bindings):
+    return sorted([Symbol.from_id(symbol_id).symbol_name
+                   for symbol_id in bindings.keys()])
 
 
 class Scope(object):
+    """The variables defined in a scope. bindings is a dict of symbol
+    ids to values, but all the methods take Symbols.
+
+    """
     def __init__(self, bindings):
         self.bindings = bindings
 
     def __repr__(self):
-        return "<%s: %r>" % (self.__class__.__name__, sorted(self.bindings.keys()))
+        return "<%s: %r>" % (self.__class__.__name__, binding_names(self.bindings))
 
     def contains(self, symbol):
-        return symbol in self.bindings
+        return symbol.symbol_id in self.bindings
 
     def get(self, symbol):
         # Note this raises KeyError if the variable name is not
         # present, unlike .get on dict objects.
-        return self.bindings[symbol]
+        return self.bindings[symbol.symbol_id]
+
+    def lookup(self, symbol):
+        """Return the value of this variable, or None if it isn't
+        defined in this scope.
+
+        """
+        return self.bindings.get(symbol.symbol_id, None)
 
     def set(self, symbol, value):
-        self.bindings[symbol] = value
+        self.bindings[symbol.symbol_id] = value
 
 
 # TODO: This is also used inside try-catch, so we should find a better
@@ -53,6 +78,60 @@ class LetScope(Scope):
     """
     pass
 
+class ArgumentScope(Scope):
+    """The scope created when we call a lambda or macro. The parameters
+    are stored in a fixed-size list, in the order given by the
+    function's parameter_symbols, so we don't need to build a dict for
+    every call.
+
+    Any other variables defined in the function body (e.g. with
+    set-symbol!) are stored in bindings.
+
+    """
+    def __init__(self, symbols, values):
+        Scope.__init__(self, {})
+        self.symbols = symbols
+        self.values = values
+
+    def __repr__(self):
+        return "<%s: %r>" % (self.__class__.__name__,
+                             [symbol.symbol_name for symbol in self.symbols] +
+                             binding_names(self.bindings))
+
+    @unroll_safe
+    def slot(self, symbol):
+        """Return the index of this parameter in self.values, or -1."""
+        for index, parameter in enumerate(self.symbols):
+            if parameter is symbol:
+                return index
+
+        return -1
+
+    def contains(self, symbol):
+        return self.slot(symbol) >= 0 or symbol.symbol_id in self.bindings
+
+    def get(self, symbol):
+        index = self.slot(symbol)
+        if index >= 0:
+            return self.values[index]
+
+        return self.bindings[symbol.symbol_id]
+
+    def lookup(self, symbol):
+        index = self.slot(symbol)
+        if index >= 0:
+            return self.values[index]
+
+        return self.bindings.get(symbol.symbol_id, None)
+
+    def set(self, symbol, value):
+        index = self.slot(symbol)
+        if index >= 0:
+            self.values[index] = value
+        else:
+            self.bindings[symbol.symbol_id] = value
+
+
 class Environment(object):
     """All variable bindings are stored in an environment. It handles
     nested scope by using a list of dicts, where the first dict is for
@@ -66,16 +145,30 @@ class Environment(object):
         return "<Environment %r>" % self.scopes
 
     # we can't use __get__ and __set__ in RPython, so we use normal methods
-    def get(self, variable_name):
+    def get(self, symbol):
         # Note this raises KeyError if the variable name is not
         # present, unlike .get on dict objects.
+        value = self.lookup(symbol)
+
+        if value is None:
+            raise KeyError(u"Could not find '%s' in environment" % symbol.symbol_name)
+
+        return value
+
+    @unroll_safe
+    def lookup(self, symbol):
+        """Return the value of this variable, or None if it isn't
+        defined. This only searches each scope once, so it's faster
+        than calling contains() then get().
 
+        """
         # We search scopes starting at the innermost.
         for scope in reversed(self.scopes):
-            if scope.contains(variable_name):
-                return scope.get(variable_name)
+            value = scope.lookup(symbol)
+            if value is not None:
+                return value
 
-        raise KeyError(u"Could not find '%s' in environment" % variable_name)
+        return None
 
     def globals_only(self):
         """Return a new environment that only includes variables defined
@@ -84,9 +177,10 @@ class Environment(object):
         """
         return Environment([self.scopes[0]])
 
+    @unroll_safe
     def set(self, symbol, value):
-        assert isinstance(symbol, unicode)
-        
+        assert isinstance(symbol, Symbol)
+
         # If the variable is already defined, update it in the
         # innermost scope that it is defined in.
         for scope in reversed(self.scopes):
@@ -98,16 +192,13 @@ class Environment(object):
         for scope in reversed(self.scopes):
             if not isinstance(scope, LetScope):
                 scope.set(symbol, value)
+                return
 
-    def set_global(self, variable_name, value):
-        self.scopes[0].set(variable_name, value)
-
-    def contains(self, variable_name):
-        for scope in reversed(self.scopes):
-            if scope.contains(variable_name):
-                return True
+    def set_global(self, symbol, value):
+        self.scopes[0].set(symbol, value)
 
-        return False
+    def contains(self, symbol):
+        return self.lookup(symbol) is not None
 
     def with_nested_scope(self, inner_scope):
         """Return a new environment that shares all the outer scopes with this
@@ -117,24 +208,39 @@ class Environment(object):
         return Environment(self.scopes + [inner_scope])
 
 
+def by_symbol_id(values_by_name):
+    """Given a dict of names to values, return a dict of symbol ids to
+    values.
+
+    """
+    values_by_id = {}
+    for name, value in values_by_name.items():
+        values_by_id[Symbol.intern(name).symbol_id] = value
+    return values_by_id
+
+
 # TODO: expose this as a runtime variable
-special_expressions = {
+# Special expressions, keyed by the symbol_id of their name.
+special_expressions = by_symbol_id({
     u'let': Let(),
     u'if': If(),
+    u'do': Do(),
     u'while': While(),
     u'lambda': LambdaFactory(),
     u'macro': DefineMacro(),
     u'expand-macro': ExpandMacro(),
+    u'expand-all-macros': ExpandAllMacros(),
     u'quote': Quote(),
     u'try': Try(),
-}
+    u'generator': GeneratorFactory(),
+})
 
 
 def fresh_environment():
     """Return a new environment that only contains the built-ins.
 
     """
-    return Environment([Scope({
+    return Environment([Scope(by_symbol_id({
         # Functions.
         u'+': Add(),
         u'-': Subtract(),
@@ -146,6 +252,7 @@ def fresh_environment():
         u'length': Length(),
         u'symbol?': SymbolPredicate(),
         u'list?': ListPredicate(),
+        u'range?': RangePredicate(),
         u'hashmap?': HashmapPredicate(),
         u'string?': StringPredicate(),
         u'bytestring?': BytestringPredicate(),
@@ -153,6 +260,31 @@ def fresh_environment():
         u'get-index': GetIndex(),
         u'set-index!': SetIndex(),
         u'insert!': Insert(),
+        u'empty?': EmptyPredicate(),
+        u'append!': Append(),
+        u'copy': Copy(),
+        u'rest': Rest(),
+        u'join': Join(),
+        u'join!': JoinMutate(),
+        u'range': RangeFactory(),
+        u'map': Map(),
+        u'filter': Filter(),
+        u'sort': Sort(),
+        u'sort!': SortMutate(),
+        u'lazy?': LazyPredicate(),
+        u'lazy-map': LazyMapFactory(),
+        u'lazy-filter': LazyFilterFactory(),
+        u'take': TakeFactory(),
+        u'drop': DropFactory(),
+        u'realize': Realize(),
+        u'next!': Next(),
+        u'yield': Yield(),
+        u'spawn': Spawn(),
+        u'join-task': JoinTask(),
+        u'task?': TaskPredicate(),
+        u'sleep': Sleep(),
+        u'yield-now': YieldNow(),
+        u'poll': Poll(),
         u'get-key': GetKey(),
         u'set-key!': SetKey(),
         u'get-items': GetItems(),
@@ -170,6 +302,8 @@ def fresh_environment():
         u'open': Open(),
         u'close!': Close(),
         u'read': Read(),
+        u'read-forms': ReadForms(),
+        u'read-lines': ReadLines(),
         u'write!': Write(),
         u'flush!': Flush(),
         u'encode': Encode(),
@@ -177,6 +311,7 @@ def fresh_environment():
         u'throw': Throw(),
         u'message': Message(),
         u'exception-type': ExceptionType(),
+        u'macro-expansion-counts': MacroExpansionCounts(),
 
         # Exception types.
         u'error': error,
@@ -190,10 +325,11 @@ def fresh_environment():
         u'division-by-zero': division_by_zero,
         u'file-not-found': file_not_found,
         u'changing-closed-handle': changing_closed_handle,
+        u'deadlock': deadlock,
 
         # Constants
-        u'VERSION': String(list(u"0.12")),
+        u'VERSION': String.fromunicode(u"0.12"),
 
         # Standard I/O.
         u'stdout': Stdout(),
-    })])
+    }))])
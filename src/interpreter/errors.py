@@ -27,6 +27,10 @@ class LexFailed(InternalError):
     pass
 
 
+class IncomparableValues(InternalError):
+    pass
+
+
 
 """External errors. These may be thrown and caught by users.
 
@@ -80,3 +84,6 @@ file_not_found = TrifleExceptionType(error, u"file-not-found")
 
 # TODO: find a better name here
 changing_closed_handle = TrifleExceptionType(error, u"changing-closed-handle")
+
+
+deadlock = TrifleExceptionType(error, u"deadlock")
@@ -1,16 +1,19 @@
+from rpython.rlib.jit import JitDriver, unroll_safe
+
 from trifle_types import (
-    List, Bytestring, Hashmap, Character, Symbol,
+    List, Range, Bytestring, Hashmap, Character, Symbol,
     Integer, Float, Fraction,
     Null, NULL,
     Function, FunctionWithEnv, Lambda, Macro, Boolean,
     Keyword, String,
-    TrifleExceptionInstance, TrifleExceptionType)
+    TrifleExceptionInstance, TrifleExceptionType, LazySequence,
+    parameter_symbols, identity_dict)
 from errors import (
     error, wrong_type, no_such_variable, stack_overflow,
     ArityError, wrong_argument_number, value_error)
-from almost_python import zip
-from environment import Scope, LetScope, special_expressions
+from environment import ArgumentScope, LetScope, special_expressions
 from parameters import is_variable_arity, check_parameters
+from tasks import Task, scheduler
 
 
 # TODO: allow users to change this at runtime.
@@ -21,6 +24,10 @@ class Stack(object):
     def __init__(self):
         self.values = []
 
+        # If this stack belongs to a task, how many more steps it
+        # may take before we switch to another task. 0 means no limit.
+        self.steps_left = 0
+
     def __repr__(self):
         return "<Stack: %r>\n" % "\n".join(map(repr, self.values))
 
@@ -31,14 +38,35 @@ class Stack(object):
     def pop(self):
         return self.values.pop()
 
+    def replace(self, value):
+        """Replace the top frame with this one. We use this for calls in
+        tail position, so the caller's frame doesn't stay on the stack
+        whilst the callee is evaluated.
+
+        """
+        self.values[-1] = value
+
     def peek(self):
         return self.values[-1]
 
     def is_empty(self):
         return not bool(self.values)
 
+    def use_step(self):
+        """Count a loop iteration or function call. Return True if
+        we've used up the current slice.
+
+        """
+        if self.steps_left > 0:
+            self.steps_left -= 1
+            return self.steps_left == 0
+
+        return False
+
 
 class Frame(object):
+    _immutable_fields_ = ['expression', 'environment', 'as_block']
+
     def __init__(self, expression, environment, as_block=False):
         # The expression we're evaluating, e.g. (if x y 2)
         self.expression = expression
@@ -68,6 +96,15 @@ class Frame(object):
         # Is this a try expression that will catch certain error types?
         self.catch_error = None
 
+        # Is this the body of a lambda we've just called? The JIT
+        # treats entering a function body as a loop header.
+        self.is_function_body = False
+
+        # If a built-in function called from this frame is waiting
+        # for the result of a call it made, the Continuation that
+        # resumes it.
+        self.continuation = None
+
     def __repr__(self):
         return ("expession: %r,\tindex: %d,\tas_block: %s,\tevalled: %r" %
                 (self.expression, self.expression_index, self.as_block,
@@ -90,6 +127,7 @@ def evaluate_all(expressions, environment):
     return result
 
 
+@unroll_safe
 def is_error_instance(error_instance, error_type):
     """Is the type of error_instance the same as error_type, or inherit from it?
 
@@ -122,40 +160,227 @@ def is_thrown_exception(value, exception_type):
         return not value.caught
 
 
+class CompiledExpression(object):
+    """Everything we can work out about a List expression without
+    evaluating it. We compute this once per List and store it on the
+    List, so evaluating the same code again (e.g. a loop body or a
+    function body) doesn't repeat the work.
+
+    """
+    _immutable_fields_ = ['special', 'arguments',
+                          'error_type', 'error_message']
+
+    def __init__(self, special, arguments, error_type=None, error_message=u""):
+        # The special expression object, if this is a special
+        # expression, or None for function and macro calls.
+        self.special = special
+
+        # The unevaluated arguments to the special expression.
+        self.arguments = arguments
+
+        # If the expression is malformed, we store the error so we can
+        # create a fresh exception every time it's evaluated.
+        self.error_type = error_type
+        self.error_message = error_message
+
+        # If this is a macro call, the macro we expanded and the
+        # result. Expansions only depend on the macro and the
+        # unevaluated arguments, so we only need to expand again if
+        # the macro is redefined or this List is modified.
+        self.macro = None
+        self.macro_expansion = None
+
+
+class MacroCounts(object):
+    """How many macro calls we have expanded, and how many times we
+    reused a previous expansion.
+
+    """
+    def __init__(self):
+        self.expansions = 0
+        self.cache_hits = 0
+
+
+macro_counts = MacroCounts()
+
+
+# If a list is read by this many cached macro expansions, we stop
+# caching expansions that read it, so it can't keep every call site
+# that uses it alive.
+MAX_DEPENDENT_CALLS = 100
+
+
+class MacroReads(object):
+    """The Lists that the macro we're expanding has passed to a
+    function or spliced with unquote*, or None if we aren't expanding
+    a macro.
+
+    """
+    def __init__(self):
+        self.lists = None
+
+    def note(self, value):
+        if self.lists is not None and isinstance(value, List):
+            self.lists[value] = True
+
+    def note_arguments(self, arguments):
+        """Built-in functions may read any list they're given."""
+        if self.lists is not None:
+            for argument in arguments:
+                self.note(argument)
+
+
+macro_reads = MacroReads()
+
+
+def compile_expression(expression):
+    """Return the CompiledExpression for this List, computing it if we
+    haven't evaluated this List before.
+
+    """
+    compiled = expression.compiled
+    if compiled is None:
+        compiled = _compile_expression(expression)
+        expression.compiled = compiled
+
+    return compiled
+
+
+def _compile_expression(expression):
+    list_elements = expression.values
+
+    if not list_elements:
+        return CompiledExpression(
+            None, [], value_error, u"Can't evaluate an empty list.")
+
+    head = list_elements[0]
+
+    if isinstance(head, Symbol) and head.symbol_id in special_expressions:
+        special_expression = special_expressions[head.symbol_id]
+        raw_arguments = list_elements[1:]
+
+        try:
+            check_error = special_expression.check(raw_arguments)
+        except ArityError as e:
+            return CompiledExpression(
+                special_expression, raw_arguments,
+                wrong_argument_number, e.message)
+
+        if check_error is not None:
+            assert isinstance(check_error, TrifleExceptionInstance)
+            return CompiledExpression(
+                special_expression, raw_arguments,
+                check_error.exception_type, check_error.message)
+
+        return CompiledExpression(special_expression, raw_arguments)
+
+    return CompiledExpression(None, [])
+
+
+def get_printable_location(expression_index, expression):
+    return "%s at index %d" % (expression.repr().encode('utf-8'), expression_index)
+
+
+# The position in the program is the expression we're evaluating and
+# how far through it we are, so these are our green variables.
+jitdriver = JitDriver(
+    greens=['expression_index', 'expression'],
+    reds=['frame', 'stack'],
+    get_printable_location=get_printable_location,
+)
+
+
 def evaluate(expression, environment):
     """Evaluate the given expression in the given environment.
 
+    At the top level, we evaluate it as a task, so any other tasks
+    get a turn too. If we're already running a task (e.g. we're
+    expanding a macro), we just evaluate it.
+
     """
     stack = Stack()
     stack.push(Frame(expression, environment))
 
+    if scheduler.current is not None:
+        return evaluate_stack(stack)
+
+    return scheduler.run(Task(stack))
+
+
+def call_frame(function, arguments, environment):
+    """Return a Frame that calls function with this Python list of
+    arguments. The arguments have already been evaluated, so we don't
+    evaluate them again.
+
+    """
+    frame = Frame(List([function] + arguments), environment)
+    frame.expression_index = len(arguments) + 1
+    frame.evalled = [function] + arguments
+    return frame
+
+
+def evaluate_stack(stack):
+    """Evaluate the frames on this stack until it's empty, and return
+    the result of the bottom frame.
+
+    If the stack belongs to a task, we return None when the task has
+    used up its slice or has to wait. Calling evaluate_stack again
+    carries on from where we stopped.
+
+    """
     # We evaluate expressions by pushing them on the stack, then
     # iterating through the elements of the list, evaluating as
     # appropriate. This ensures recursion in the Trifle program does
     # not require recursion in the interpreter.
-    while stack:
+    while True:
+        frame = stack.peek()
+        expression = frame.expression
+        expression_index = frame.expression_index
+
+        jitdriver.jit_merge_point(
+            expression_index=expression_index, expression=expression,
+            frame=frame, stack=stack)
 
         if len(stack.values) > MAX_STACK_DEPTH:
             result = TrifleExceptionInstance(
                 # TODO: write a better exception message.
                 stack_overflow, u"Stack overflow"
             )
+        elif frame.continuation is not None:
+            # A built-in function made a call, which has now returned.
+            continuation = frame.continuation
+            if not continuation.ready():
+                # The task is waiting, so let the scheduler run
+                # another one.
+                return None
+
+            frame.continuation = None
+
+            try:
+                result = continuation.resume(frame.evalled.pop(), stack)
+            except ArityError as e:
+                result = TrifleExceptionInstance(
+                    wrong_argument_number, e.message)
+
         else:
-            frame = stack.peek()
+            if isinstance(expression, List):
+                if frame.as_block:
+                    # A block is just a list of expressions, so we
+                    # never treat it as a special expression.
+                    result = evaluate_block(stack)
 
-            if isinstance(frame.expression, List):
-                list_elements = frame.expression.values
+                else:
+                    compiled = compile_expression(expression)
 
-                if list_elements:
-                    head = list_elements[0]
-                    raw_arguments = list_elements[1:]
+                    if compiled.error_type is not None:
+                        result = TrifleExceptionInstance(
+                            compiled.error_type, compiled.error_message)
 
                     # Handle special expressions.
-                    if isinstance(head, Symbol) and head.symbol_name in special_expressions:
-                        special_expression = special_expressions[head.symbol_name]
-
+                    elif compiled.special is not None:
                         try:
-                            result = special_expression.call(raw_arguments, frame.environment, stack)
+                            result = compiled.special.call(
+                                compiled.arguments, frame.environment, stack)
                         except ArityError as e:
                             result = TrifleExceptionInstance(
                                 wrong_argument_number, e.message)
@@ -169,17 +394,36 @@ def evaluate(expression, environment):
                                 e.message
                             )
 
-                else:
-                    result = TrifleExceptionInstance(
-                        value_error, u"Can't evaluate an empty list."
-                    )
-
             else:
                 result = evaluate_value(frame.expression, frame.environment)
 
         # Returning None means we have work left to do, but a Trifle value means
         # we're done with this frame.
-        if not result is None:
+        if result is None:
+            top_frame = stack.peek()
+
+            if top_frame is frame and frame.expression_index < expression_index:
+                # We've jumped backwards in the current frame, which
+                # only happens at the end of a while loop body.
+                if stack.use_step():
+                    return None
+
+                jitdriver.can_enter_jit(
+                    expression_index=frame.expression_index,
+                    expression=frame.expression,
+                    frame=frame, stack=stack)
+
+            elif top_frame.is_function_body and top_frame.expression_index == 0:
+                # We've just entered the body of a lambda.
+                if stack.use_step():
+                    return None
+
+                jitdriver.can_enter_jit(
+                    expression_index=top_frame.expression_index,
+                    expression=top_frame.expression,
+                    frame=top_frame, stack=stack)
+
+        else:
 
             if is_thrown_exception(result, error):
                 # We search any try blocks starting from the
@@ -199,7 +443,7 @@ def evaluate(expression, environment):
                         catch_body = frame.expression.values[5]
                         
                         catch_body_scope = LetScope({
-                            exception_symbol.symbol_name: result
+                            exception_symbol.symbol_id: result
                         })
                         catch_env = frame.environment.with_nested_scope(catch_body_scope)
 
@@ -222,40 +466,34 @@ def evaluate(expression, environment):
 
 
 # todo: this would be simpler if `values` was also a trifle List
-def build_scope(name, parameters, values):
+def build_scope(name, parameters, symbols, values):
     """Build a single scope where every value in values (a python list) is
     bound to a symbol according to the parameters List given.
 
+    symbols is the layout of the scope, as computed by
+    trifle_types.parameter_symbols.
+
     If the parameters list contains `:rest foo`, any remaining arguments
     are passed a list in the named parameter.
 
     """
-    varargs = is_variable_arity(parameters)
-
-    if varargs:
-        # The only negative slice supported by RPython is -1, so we
-        # have to do it twice.
-        normal_parameters = parameters.values[:-1][:-1]
-    else:
-        normal_parameters = parameters.values
-
     # Ensure we have the right number of arguments:
     check_parameters(name, parameters, List(values))
 
-    scope = Scope({})
-    for variable, value in zip(normal_parameters, values):
-        scope.set(variable.symbol_name,  value)
-
     # todoc: varargs on macros
     # todo: consistently use the terms 'parameters' and 'arguments'
-    if varargs:
-        # Create a Trifle list of any remaining arguments.
-        remaining_args = List(values[len(normal_parameters):])
-
-        # Assign it to the variable args symbol.
-        scope.set(parameters.values[-1].symbol_name, remaining_args)
+    if is_variable_arity(parameters):
+        normal_parameter_count = len(symbols) - 1
+        assert normal_parameter_count >= 0
+
+        # Create a Trifle list of any remaining arguments, and assign
+        # it to the variable args symbol.
+        scope_values = values[:normal_parameter_count]
+        scope_values.append(List(values[normal_parameter_count:]))
+    else:
+        scope_values = values
 
-    return scope
+    return ArgumentScope(symbols, scope_values)
 
 
 def expand_macro(macro, arguments, environment):
@@ -264,12 +502,347 @@ def expand_macro(macro, arguments, environment):
 
     """
     # Build a new environment to evaluate with.
-    inner_scope = build_scope(macro.name, macro.arguments, arguments)
+    inner_scope = build_scope(
+        macro.name, macro.arguments, macro.parameter_symbols, arguments)
     macro_env = environment.globals_only().with_nested_scope(inner_scope)
 
     return evaluate_all(macro.body, macro_env)
 
 
+def expand_macro_call(macro, expression, environment):
+    """Expand this macro call (a List whose head evaluated to macro),
+    reusing the previous expansion at this call site if there is one.
+
+    """
+    assert isinstance(expression, List)
+    compiled = compile_expression(expression)
+
+    # Redefining a macro creates a new Macro object, so this also
+    # ensures we don't use expansions from an old definition.
+    if compiled.macro is macro:
+        macro_counts.cache_hits += 1
+        return compiled.macro_expansion
+
+    # Record the lists the expansion reads, since the expansion
+    # depends on their contents. We don't need to record lists that
+    # the expansion just includes, since mutating them changes the
+    # expanded code too.
+    outer_reads = macro_reads.lists
+    macro_reads.lists = identity_dict()
+    try:
+        expanded = expand_macro(macro, expression.values[1:], environment)
+    finally:
+        reads = macro_reads.lists
+        macro_reads.lists = outer_reads
+    macro_counts.expansions += 1
+
+    # Don't cache errors, so we get a fresh exception next time.
+    if is_thrown_exception(expanded, error):
+        return expanded
+
+    read_lists = reads.keys()
+    for read_list in read_lists:
+        dependent_calls = read_list.dependent_calls
+        if dependent_calls is not None and len(dependent_calls) >= MAX_DEPENDENT_CALLS:
+            return expanded
+
+    compiled.macro = macro
+    compiled.macro_expansion = expanded
+
+    # Discard the cached expansion if any of those lists change.
+    for read_list in read_lists:
+        assert isinstance(read_list, List)
+        if read_list.dependent_calls is None:
+            read_list.dependent_calls = identity_dict()
+        read_list.dependent_calls[expression] = True
+
+    return expanded
+
+
+# Macros can expand to calls of themselves (e.g. a macro that recurses
+# in one branch of an `if`), so we stop expanding ahead of time after
+# this many nested expansions and leave the rest until run time.
+MAX_EXPANSION_DEPTH = 100
+
+
+def evaluate_program(expressions, environment):
+    """Evaluate a trifle List of top-level expressions in the given
+    environment, expanding all the macros in each expression
+    immediately before we evaluate it.
+
+    """
+    result = NULL
+
+    for expression in expressions.values:
+        expanded = expand_all_macros(expression, environment)
+        result = evaluate(expanded, environment)
+
+        if is_thrown_exception(result, error):
+            return result
+
+    return result
+
+
+def expand_all_macros(expression, environment):
+    """Return expression with every macro call expanded, recursively.
+
+    We don't modify expression: we build new Lists where we've
+    expanded something, and reuse the original values elsewhere. If
+    we expand the same expression again, we reuse the Lists we built
+    last time, unless they need to change.
+
+    Macro calls that we can't expand (e.g. the macro isn't defined
+    yet, or expansion throws an error) are left as they are, so they
+    will be expanded (or throw the error) when evaluated.
+
+    """
+    return _expand_all(expression, environment, {}, 0)
+
+
+def _expand_all(expression, environment, bound, depth):
+    """bound is a dict of the ids of symbols that are bound locally, so
+    may shadow global macros.
+
+    """
+    if not isinstance(expression, List) or not expression.values:
+        return expression
+
+    head = expression.values[0]
+
+    if isinstance(head, Symbol):
+        if head.symbol_id in special_expressions:
+            return _expand_special(expression, head.symbol_name, environment, bound, depth)
+
+        if head.symbol_id not in bound and depth < MAX_EXPANSION_DEPTH:
+            value = environment.lookup(head)
+
+            if isinstance(value, Macro):
+                # Reuse the expansion of this call site if we've
+                # already expanded it.
+                try:
+                    expanded = expand_macro_call(value, expression, environment)
+                except ArityError:
+                    return expression
+
+                if is_thrown_exception(expanded, error):
+                    return expression
+
+                return _expand_all(expanded, environment, bound, depth + 1)
+
+    return _expand_elements(expression, 0, environment, bound, depth)
+
+
+def _expand_elements(expression, start, environment, bound, depth):
+    """Expand every element of this List from index start onwards,
+    returning the same List if nothing changed.
+
+    """
+    values = expression.values
+    new_values = []
+    changed = False
+
+    for index, value in enumerate(values):
+        if index >= start:
+            new_value = _expand_all(value, environment, bound, depth)
+            if new_value is not value:
+                changed = True
+            new_values.append(new_value)
+        else:
+            new_values.append(value)
+
+    if changed:
+        return _rebuild(expression, new_values)
+    return expression
+
+
+def _rebuild(expression, new_values):
+    """Return a List of new_values to use in place of expression. If
+    we built the same List last time we expanded expression, we return
+    that, so repeated expansion doesn't discard its caches.
+
+    """
+    previous = expression.expanded_form
+    if previous is not None and len(previous.values) == len(new_values):
+        same = True
+        for index in range(len(new_values)):
+            if previous.values[index] is not new_values[index]:
+                same = False
+                break
+
+        if same:
+            return previous
+
+    rebuilt = List(new_values)
+    expression.expanded_form = rebuilt
+    return rebuilt
+
+
+def _with_bound(bound, symbols):
+    new_bound = bound.copy()
+    for symbol in symbols:
+        new_bound[symbol.symbol_id] = True
+    return new_bound
+
+
+def _expand_special(expression, name, environment, bound, depth):
+    """Expand any macro calls in the arguments to a special expression
+    that will be evaluated. If the expression is malformed, we leave it
+    alone and let the special expression report the error at run time.
+
+    """
+    values = expression.values
+
+    if name == u"quote":
+        if len(values) == 2:
+            quoted = _expand_unquoted(values[1], environment, bound, depth)
+            if quoted is not values[1]:
+                return _rebuild(expression, [values[0], quoted])
+        return expression
+
+    elif (name == u"if" or name == u"do" or name == u"while" or
+          name == u"generator"):
+        return _expand_elements(expression, 1, environment, bound, depth)
+
+    elif name == u"lambda":
+        if len(values) < 2 or not isinstance(values[1], List):
+            return expression
+
+        parameters = values[1]
+        assert isinstance(parameters, List)
+        body_bound = _with_bound(bound, parameter_symbols(parameters))
+        return _expand_elements(expression, 2, environment, body_bound, depth)
+
+    elif name == u"macro":
+        if len(values) < 3 or not isinstance(values[2], List):
+            return expression
+
+        # Macro bodies are evaluated with only the globals and the
+        # macro parameters.
+        parameters = values[2]
+        assert isinstance(parameters, List)
+        body_bound = _with_bound({}, parameter_symbols(parameters))
+        return _expand_elements(expression, 3, environment, body_bound, depth)
+
+    elif name == u"let":
+        if len(values) < 2 or not isinstance(values[1], List):
+            return expression
+
+        bindings = values[1]
+        assert isinstance(bindings, List)
+
+        # Each binding can see the bindings before it.
+        let_bound = bound.copy()
+        new_bindings = []
+        changed = False
+
+        for index, value in enumerate(bindings.values):
+            if index % 2 == 0:
+                if not isinstance(value, Symbol):
+                    return expression
+                new_bindings.append(value)
+            else:
+                new_value = _expand_all(value, environment, let_bound, depth)
+                if new_value is not value:
+                    changed = True
+                new_bindings.append(new_value)
+
+                # The symbol isn't bound until its value has been
+                # evaluated.
+                symbol = bindings.values[index - 1]
+                assert isinstance(symbol, Symbol)
+                let_bound[symbol.symbol_id] = True
+
+        if changed:
+            bindings = _rebuild(bindings, new_bindings)
+        new_values = [values[0], bindings]
+        for value in values[2:]:
+            new_value = _expand_all(value, environment, let_bound, depth)
+            if new_value is not value:
+                changed = True
+            new_values.append(new_value)
+
+        if changed:
+            return _rebuild(expression, new_values)
+        return expression
+
+    elif name == u"try":
+        # (try BODY :catch TYPE SYMBOL CATCH-BODY)
+        if len(values) != 6 or not isinstance(values[4], Symbol):
+            return expression
+
+        exception_symbol = values[4]
+        assert isinstance(exception_symbol, Symbol)
+
+        body = _expand_all(values[1], environment, bound, depth)
+        exception_type = _expand_all(values[3], environment, bound, depth)
+        catch_bound = _with_bound(bound, [exception_symbol])
+        catch_body = _expand_all(values[5], environment, catch_bound, depth)
+
+        if body is values[1] and exception_type is values[3] and catch_body is values[5]:
+            return expression
+
+        return _rebuild(expression, [values[0], body, values[2], exception_type,
+                                     values[4], catch_body])
+
+    # The arguments to other special expressions (e.g. expand-macro)
+    # aren't evaluated, so there's nothing to expand.
+    return expression
+
+
+def _expand_unquoted(quoted, environment, bound, depth):
+    """Expand macro calls inside (unquote ...) and (unquote* ...) in a
+    quoted expression, since those are evaluated.
+
+    """
+    if not isinstance(quoted, List) or not quoted.values:
+        return quoted
+
+    values = quoted.values
+    head = values[0]
+
+    if (isinstance(head, Symbol) and len(values) == 2 and
+            (head.symbol_name == u"unquote" or head.symbol_name == u"unquote*")):
+        argument = _expand_all(values[1], environment, bound, depth)
+        if argument is values[1]:
+            return quoted
+        return _rebuild(quoted, [head, argument])
+
+    new_values = []
+    changed = False
+    for value in values:
+        new_value = _expand_unquoted(value, environment, bound, depth)
+        if new_value is not value:
+            changed = True
+        new_values.append(new_value)
+
+    if changed:
+        return _rebuild(quoted, new_values)
+    return quoted
+
+
+def evaluate_block(stack):
+    """Given a stack, where the top element is a block (a List of
+    expressions, such as a lambda body), evaluate each expression and
+    return the value of the last.
+
+    """
+    frame = stack.peek()
+    expressions = frame.expression.values
+    raw_expression = expressions[frame.expression_index]
+
+    if frame.expression_index == len(expressions) - 1:
+        # The last expression in a block is in tail position, so
+        # its value is our value.
+        stack.replace(Frame(raw_expression, frame.environment))
+        return None
+
+    stack.push(Frame(raw_expression, frame.environment))
+
+    frame.expression_index += 1
+    return None
+
+
+@unroll_safe
 def evaluate_function_call(stack):
     """Given a stack, where the the top element is a single Trifle call
     (either a function or a macro), execute it iteratively.
@@ -279,77 +852,77 @@ def evaluate_function_call(stack):
     environment = frame.environment
     expression = frame.expression
 
-    if frame.expression_index == 1:
-        # If the head of the list evaluated to a macro, we skip
-        # evaluating the arguments. Otherwise, continue as evaluating
-        # as normal.
-        evalled_head = frame.evalled[-1]
-        macro_arguments = frame.expression.values[1:]
-        
-        if isinstance(evalled_head, Macro):
-            expanded = expand_macro(evalled_head, macro_arguments, environment)
+    # Evaluate the remaining elements of this list (we work
+    # left-to-right). Lists need a new frame, but we evaluate other
+    # values (symbols and literals) immediately.
+    while True:
+        if frame.expression_index == 1:
+            # If the head of the list evaluated to a macro, we skip
+            # evaluating the arguments. Otherwise, continue as evaluating
+            # as normal.
+            evalled_head = frame.evalled[-1]
 
-            # If macro expansion throws an error, terminate, returning that error.
-            if is_thrown_exception(expanded, error):
-                return expanded
-                
-            stack.push(Frame(expanded, environment))
+            if isinstance(evalled_head, Macro):
+                expanded = expand_macro_call(evalled_head, expression, environment)
 
-            # Ensure we don't evaluate any of arguments to the macro.
-            frame.expression_index = len(expression.values) + 1
-            return None
+                # If macro expansion throws an error, terminate, returning that error.
+                if is_thrown_exception(expanded, error):
+                    return expanded
 
-    if frame.expression_index < len(expression.values):
-        # Evaluate the remaining elements of this list (we work left-to-right).
-        raw_argument = expression.values[frame.expression_index]
-        stack.push(Frame(raw_argument, environment))
+                # The expanded code replaces the macro call entirely.
+                stack.replace(Frame(expanded, environment))
+                return None
 
+        if frame.expression_index >= len(expression.values):
+            break
+
+        raw_argument = expression.values[frame.expression_index]
         frame.expression_index += 1
-        return None
 
-    elif frame.expression_index == len(expression.values):
-        # We've evalled all the elements of the list.
+        if isinstance(raw_argument, List):
+            stack.push(Frame(raw_argument, environment))
+            return None
 
-        # This list doesn't represent a function call, rather it's
-        # just a lambda body. We just want the last result.
-        if frame.as_block:
-            return frame.evalled[-1]
-        
-        # We've evaluated the function and its arguments, now call the
-        # function with the evalled arguments.
-        function = frame.evalled[0]
-        arguments = frame.evalled[1:]
+        value = evaluate_value(raw_argument, environment)
+        if is_thrown_exception(value, error):
+            return value
 
-        if isinstance(function, Function):
-            return function.call(arguments)
+        frame.evalled.append(value)
 
-        elif isinstance(function, FunctionWithEnv):
-            return function.call(arguments, environment, stack)
+    # We've evaluated the function and its arguments, now call the
+    # function with the evalled arguments.
+    function = frame.evalled[0]
+    arguments = frame.evalled[1:]
 
-        elif isinstance(function, Lambda):
-            # Build a new environment to evaluate with.
-            inner_scope = build_scope(u"<lambda>", function.arguments, arguments)
+    if isinstance(function, Function):
+        macro_reads.note_arguments(arguments)
+        return function.call(arguments)
 
-            lambda_env = function.env.with_nested_scope(inner_scope)
+    elif isinstance(function, FunctionWithEnv):
+        macro_reads.note_arguments(arguments)
+        return function.call(arguments, environment, stack)
 
-            # Evaluate the lambda's body in our new environment.
-            # TODO: by replacing the stack here, we could do TCO.
-            stack.push(Frame(function.body, lambda_env, as_block=True))
+    elif isinstance(function, Lambda):
+        # Build a new environment to evaluate with.
+        inner_scope = build_scope(
+            u"<lambda>", function.arguments, function.parameter_symbols, arguments)
 
-            frame.expression_index += 1
-            return None
+        lambda_env = function.env.with_nested_scope(inner_scope)
 
-        else:
-            # todoc: this error
-            return TrifleExceptionInstance(
-                wrong_type,
-                u"You can only call functions or macros, but got: %s"
-                % function.repr())
+        # Evaluate the lambda's body in our new environment. We
+        # don't need the call frame any more, so we replace it,
+        # ensuring tail calls run in constant stack space.
+        body_frame = Frame(function.body, lambda_env, as_block=True)
+        body_frame.is_function_body = True
+        stack.replace(body_frame)
+        return None
 
     else:
-        # We had a lambda body or expanded macro and we've now evalled
-        # it, so we're done.
-        return frame.evalled[-1]
+        # todoc: this error
+        return TrifleExceptionInstance(
+            wrong_type,
+            u"You can only call functions or macros, but got: %s"
+            % function.repr())
 
 
 def evaluate_value(value, environment):
@@ -368,13 +941,12 @@ def evaluate_value(value, environment):
         
     # String and bytestring literals should evaluate to a copy of
     # themselves, so we can safely use string literals in function
-    # bodies and then mutate them.
+    # bodies and then mutate them. We only copy the contents when
+    # either is mutated.
     elif isinstance(value, String):
-        char_list = value.string
-        return String([char for char in char_list])
+        return value.shared_copy()
     elif isinstance(value, Bytestring):
-        byte_list = value.byte_value
-        return Bytestring([byte for byte in byte_list])
+        return value.shared_copy()
     # Likewise for hashmap literals.
     # TODO: Should this be a deep copy?
     elif isinstance(value, Hashmap):
@@ -384,6 +956,10 @@ def evaluate_value(value, environment):
         
     elif isinstance(value, Character):
         return value
+    elif isinstance(value, Range):
+        return value
+    elif isinstance(value, LazySequence):
+        return value
     elif isinstance(value, Lambda):
         return value
     elif isinstance(value, Function):
@@ -397,13 +973,16 @@ def evaluate_value(value, environment):
     elif isinstance(value, Macro):
         return value
     elif isinstance(value, Symbol):
-        symbol_name = value.symbol_name
-        if environment.contains(symbol_name):
-            return environment.get(symbol_name)
-        else:
+        variable_value = environment.lookup(value)
+
+        if variable_value is None:
             # TODO: suggest variables with similar spelling.
             return TrifleExceptionInstance(
                 no_such_variable,
-                u"No such variable defined: '%s'" % symbol_name)
+                u"No such variable defined: '%s'" % value.symbol_name)
+
+        return variable_value
+    elif isinstance(value, Task):
+        return value
     else:
         assert False, "I don't know how to evaluate that value: %s" % value
@@ -1,6 +1,3 @@
-# Sadly, re isn't available in rpython.
-from rpython.rlib.rsre import rsre_core
-from rpython.rlib.rsre.rpy import get_code
 from rpython.rlib.rbigint import rbigint as RBigInt
 
 from trifle_types import (
@@ -13,74 +10,51 @@ from trifle_types import (
 from errors import LexFailed, division_by_zero, lex_failed
 
 
-# Note this an incomplete list and is purely to give us convenient
-# constants.
-WHITESPACE = 'whitespace'
-COMMENT = 'comment'
-OPEN_PAREN = 'open-paren'
-CLOSE_PAREN = 'close-paren'
-OPEN_CURLY_PAREN = 'open-curly-paren'
-CLOSE_CURLY_PAREN = 'close-curly-paren'
-INTEGER = 'integer'
-FRACTION = 'fraction'
-SYMBOL = 'symbol'
-KEYWORD = 'keyword'
-STRING = 'string'
-CHARACTER = 'character'
-BYTESTRING = 'bytestring'
-FLOAT = 'float'
-BOOLEAN = 'boolean'
-NULL_TYPE = 'null type'
-ATOM = 'atom'
-HASH_LITERAL = 'hash_literal'
-
-# Tokens are used to split strings into coarse categories.
-TOKENS = [
-    (WHITESPACE, get_code(r"(,|\s)+")),
-    (COMMENT, get_code(";[^\n]*")),
-    (OPEN_PAREN, get_code(r"\(")),
-    (CLOSE_PAREN, get_code(r"\)")),
-    (OPEN_CURLY_PAREN, get_code(r"\{")),
-    (CLOSE_CURLY_PAREN, get_code(r"\}")),
-
-    (ATOM, get_code('[:a-zA-Z0-9*/+?!<>=_.-]+')),
-    (STRING, get_code(r'"([^"\\]|\\\\|\\n|\\")*\"')),
-    (CHARACTER, get_code(r"'([^'\\]|\\\\|\\n|\\')'")),
-
-    (BYTESTRING, get_code(r'#bytes\("[a-zA-Z0-9\\]*"\)')),
-
-    (HASH_LITERAL, get_code('#[a-zA-Z]*')),
-]
-
-# After splitting, we lex properly.
-LEXEMES = [
-    (OPEN_PAREN, get_code(r"\(")),
-    (CLOSE_PAREN, get_code(r"\)")),
-    (OPEN_CURLY_PAREN, get_code(r"\{")),
-    (CLOSE_CURLY_PAREN, get_code(r"\}")),
-
-    (STRING, get_code(r'"([^"\\]|\\\\|\\n|\\")*\"$')),
-    (BYTESTRING, get_code(r'#bytes\("[a-zA-Z0-9\\]*"\)')),
-
-    # Either: '\\', '\n', '\'' or a simple character between quotes: 'x'
-    (CHARACTER, get_code(r"'([^'\\]|\\\\|\\n|\\')'")),
-
-    (FLOAT, get_code(r"-?[0-9_]+\.[0-9_]+$")),
+"""We lex in a single pass over the source, keeping an index into it
+rather than slicing off each token. We look at the first character to
+decide what kind of token we're lexing, then consume the whole token
+and convert it to a Trifle value.
 
-    # TODO: support 0x123, 0o123
-    (INTEGER, get_code('-?[0-9][0-9_]*$')),
+"""
+
+BYTESTRING_PREFIX = u'#bytes("'
+
+
+def is_whitespace(char):
+    # Commas are whitespace, so (1, 2) is the same as (1 2).
+    return (char == u' ' or char == u',' or char == u'\n' or char == u'\t' or
+            char == u'\r' or char == u'\f' or char == u'\v')
+
+
+def is_letter(char):
+    return u'a' <= char <= u'z' or u'A' <= char <= u'Z'
 
-    (FRACTION, get_code('-?[0-9_]+/[0-9_]+$')),
 
-    (BOOLEAN, get_code('(#true|#false)$')),
-    (NULL_TYPE, get_code('#null$')),
-    
+def is_digit(char):
+    return u'0' <= char <= u'9'
+
+
+def is_symbol_start(char):
     # todoc: exactly what syntax we accept for symbols
-    (SYMBOL, get_code('[a-zA-Z*/+?!<>=_-][a-zA-Z0-9*/+?!<>=_-]*$')),
-    (KEYWORD, get_code(':[a-zA-Z*/+?!<>=_-][a-zA-Z0-9*/+?!<>=_-]*$')),
-]
+    return (is_letter(char) or char == u'*' or char == u'/' or char == u'+' or
+            char == u'?' or char == u'!' or char == u'<' or char == u'>' or
+            char == u'=' or char == u'_' or char == u'-')
+
 
-DIGITS = u'0123456789'
+def is_symbol_char(char):
+    return is_symbol_start(char) or is_digit(char)
+
+
+def is_atom_char(char):
+    """Atoms are symbols, keywords and numbers. We consume all the atom
+    characters, then decide what sort of atom we have.
+
+    """
+    return is_symbol_char(char) or char == u':' or char == u'.'
+
+
+def is_bytestring_char(char):
+    return is_letter(char) or is_digit(char) or char == u'\\'
 
 
 def remove_char(string, unwanted_char):
@@ -95,57 +69,33 @@ def remove_char(string, unwanted_char):
 
     return "".join(chars)
 
-def unescape_chars(string, quote_character):
-    """Convert a string with Trifle escape sequences in it to a Python
-    string.
-
-    >>> unescape_chars(u'\\"')
-    u'"'
-
-    """
-    chars = []
-
-    while string:
-        if string.startswith(u'\\n'):
-            chars.append(u'\n')
-            string = string[2:]
-        elif string.startswith(u'\\\\'):
-            chars.append(u'\\')
-            string = string[2:]
-        elif string.startswith(u'\\%s' % quote_character):
-            chars.append(quote_character)
-            string = string[2:]
-        else:
-            chars.append(string[0])
-            string = string[1:]
-        
-    return chars
-
 
 def unescape_bytestring_chars(string):
     """Convert a string with Trifle bytestring escape sequences to a Python
-    list.
+    list of bytes.
 
-    >>> unescape_chars(u'ab\\x00')
-    [97, 98, 0]
+    >>> unescape_bytestring_chars(u'ab\\x00')
+    ['a', 'b', '\\x00']
 
     """
     chars = []
+    i = 0
+    length = len(string)
+
+    while i < length:
+        if string[i] == u'\\' and i + 1 < length and string[i + 1] == u'\\':
+            chars.append('\\')
+            i += 2
 
-    while string:
-        if string.startswith(u"\\\\"):
-            chars.append(ord('\\'))
-            string = string[2:]
-        
         # Convert hexadecimal escapes. E.g. \xFF -> 255
         # TODOC
-        elif string.startswith(u'\\'):
-            if len(string) < 4:
+        elif string[i] == u'\\':
+            if i + 4 > length:
                 # TODO: we should give examples of valid escape sequences.
                 # (same for strings too)
-                raise LexFailed(u"Invalid hexadecimal escape sequence: %s" % string)
+                raise LexFailed(u"Invalid hexadecimal escape sequence: %s" % string[i:])
 
-            hexadecimal = string[1:4]
+            hexadecimal = string[i + 1:i + 4]
 
             valid_chars = [
                 u'a', u'b', u'c', u'd', u'e', u'f',
@@ -157,178 +107,340 @@ def unescape_bytestring_chars(string):
                 or hexadecimal[2] not in valid_chars):
                 raise LexFailed(u"Invalid hexadecimal escape sequence: %s" % hexadecimal)
 
-            chars.append(int(hexadecimal[1:].encode('utf-8'), 16))
-            string = string[4:]
-                
+            chars.append(chr(int(hexadecimal[1:].encode('utf-8'), 16)))
+            i += 4
+
         else:
-            char = string[0].encode('utf-8')
+            char = string[i].encode('utf-8')
             # The [0] here is redundant, but RPython needs it to be
-            # certain that we only pass a single character to
-            # ord(). It can't see that one_char.encode('utf-8) has a length of 1.
-            chars.append(ord(char[0]))
-            string = string[1:]
-        
+            # certain that we only store a single character. It can't
+            # see that one_char.encode('utf-8) has a length of 1.
+            chars.append(char[0])
+            i += 1
+
     return chars
 
 
-def split_tokens(text):
-    """Given the raw text of a trifle program, split it into things that
-    look like tokens.
+def starts_with_at(text, prefix, start):
+    """Does text contain prefix at index start? RPython's startswith
+    doesn't accept a start index.
 
     """
-    tokens = []
+    if start + len(prefix) > len(text):
+        return False
 
-    while text:
-        found_match = False
-    
-        for token, regexp in TOKENS:
-            match = rsre_core.match(regexp, text)
-            if match:
-                found_match = True
-                matched_text = text[:match.match_end]
-                text = text[match.match_end:]
-
-                if token in [WHITESPACE, COMMENT]:
-                    pass
-                else:
-                    tokens.append(matched_text)
-                
-                break
+    for i in range(len(prefix)):
+        if text[start + i] != prefix[i]:
+            return False
+
+    return True
+
+
+def is_prefix_at_end(text, prefix, start):
+    """Is text[start:] a proper prefix of prefix?"""
+    if len(text) - start >= len(prefix):
+        return False
 
-        if not found_match:
-            # TODO: It would be nice to suggest where open
-            # brackets/quotation marks started, to give the user a hint.
-            raise LexFailed(u"Could not lex remainder: '%s'" % text)
+    for i in range(start, len(text)):
+        if text[i] != prefix[i - start]:
+            return False
 
-    return tokens
+    return True
 
 
-def _lex(tokens):
-    """Given a Python list of unicodes that look roughly like tokens, lex
-    them. Returns a Trifle exception if they aren't valid tokens.
+def unescape_char(text, i, quote_character):
+    """text[i] is a backslash inside a string or character literal.
+    Return the character that the escape sequence represents.
 
     """
-    lexed_tokens = []
-
-    for token in tokens:
-        found_match = False
-    
-        for lexeme_name, regexp in LEXEMES:
-            match = rsre_core.match(regexp, token)
-            if match:
-                found_match = True
-
-                if lexeme_name == OPEN_PAREN:
-                    lexed_tokens.append(OpenParen())
-                elif lexeme_name == CLOSE_PAREN:
-                    lexed_tokens.append(CloseParen())
-                    
-                elif lexeme_name == OPEN_CURLY_PAREN:
-                    lexed_tokens.append(OpenCurlyParen())
-                elif lexeme_name == CLOSE_CURLY_PAREN:
-                    lexed_tokens.append(CloseCurlyParen())
-
-                elif lexeme_name == BOOLEAN:
-                    if token == u'#true':
-                        lexed_tokens.append(TRUE)
-                    else:
-                        lexed_tokens.append(FALSE)
-                elif lexeme_name == NULL_TYPE:
-                    lexed_tokens.append(NULL)
-                    
-                elif lexeme_name == INTEGER:
-                    integer_string = remove_char(token, "_")
-
-                    # TODO: validate that the integer string is only numbers
-                    lexed_tokens.append(Integer.fromstr(integer_string))
-                        
-                elif lexeme_name == FLOAT:
-                    float_string = remove_char(token, "_")
+    if i + 1 < len(text):
+        escaped = text[i + 1]
+        if escaped == u'n':
+            return u'\n'
+        elif escaped == u'\\':
+            return u'\\'
+        elif escaped == quote_character:
+            return quote_character
+
+    raise LexFailed(u"Invalid escape sequence")
+
+
+def is_number(token, start, separator):
+    """Does token have the form [0-9_]+ SEPARATOR [0-9_]+ from index
+    start onwards? If separator is empty, just check for [0-9_]+.
+
+    """
+    seen_separator = False
+    digits_before = 0
+    digits_after = 0
+
+    for i in range(start, len(token)):
+        char = token[i]
+        if is_digit(char) or char == u'_':
+            if seen_separator:
+                digits_after += 1
+            else:
+                digits_before += 1
+        elif separator and char == separator and not seen_separator:
+            seen_separator = True
+        else:
+            return False
+
+    if separator:
+        return seen_separator and digits_before > 0 and digits_after > 0
+    return digits_before > 0
+
+
+def is_symbol(token, start):
+    if start >= len(token) or not is_symbol_start(token[start]):
+        return False
+
+    for i in range(start + 1, len(token)):
+        if not is_symbol_char(token[i]):
+            return False
+
+    return True
+
+
+def lex_atom(token):
+    """Convert an atom (a run of atom characters) to a number, symbol or
+    keyword. Returns a TrifleExceptionInstance if it isn't valid.
+
+    """
+    number_start = 0
+    if token[0] == u'-':
+        number_start = 1
+
+    if is_number(token, number_start, u'.'):
+        float_string = remove_char(token, "_")
+        try:
+            return Float(float(float_string))
+        except ValueError:
+            return TrifleExceptionInstance(
+                lex_failed, u"Invalid float: '%s'" % token)
+
+    # TODO: support 0x123, 0o123
+    elif (number_start < len(token) and is_digit(token[number_start]) and
+          is_number(token, number_start, u'')):
+        integer_string = remove_char(token, "_")
+        return Integer.fromstr(integer_string)
+
+    elif is_number(token, number_start, u'/'):
+        fraction_string = remove_char(token, "_")
+        fraction_parts = fraction_string.split('/')
+        numerator = fraction_parts[0]
+        denominator = fraction_parts[1]
+
+        # E.g. _/1
+        if numerator in ["", "-"] or not denominator:
+            return TrifleExceptionInstance(
+                lex_failed, u"Invalid fraction: '%s'" % token)
+
+        numerator = RBigInt.fromstr(numerator)
+        denominator = RBigInt.fromstr(denominator)
+
+        if denominator.eq(RBigInt.fromint(0)):
+            return TrifleExceptionInstance(
+                division_by_zero,
+                u"Can't have fraction denominator of zero: '%s'" % token)
+
+        fraction = Fraction(numerator, denominator)
+
+        if fraction.denominator.eq(RBigInt.fromint(1)):
+            return Integer.frombigint(fraction.numerator)
+        else:
+            return fraction
+
+    elif is_symbol(token, 0):
+        return Symbol.intern(token)
+    elif token[0] == u':' and is_symbol(token, 1):
+        # todoc
+        return Keyword.intern(token[1:])
+
+    return TrifleExceptionInstance(
+        lex_failed, u"Could not lex token: '%s'" % token)
+
+
+def lex_hash_literal(token):
+    if token == u'#true':
+        return TRUE
+    elif token == u'#false':
+        return FALSE
+    elif token == u'#null':
+        return NULL
+
+    return TrifleExceptionInstance(
+        lex_failed, u"Could not lex token: '%s'" % token)
+
+
+def could_not_lex(text, start):
+    # TODO: It would be nice to suggest where open
+    # brackets/quotation marks started, to give the user a hint.
+    return TrifleExceptionInstance(
+        lex_failed, u"Could not lex remainder: '%s'" % text[start:])
+
+
+def lex_tokens(text, final):
+    """Lex as much of text as we can. Returns a tuple (tokens, error,
+    consumed): a Python list of tokens, a TrifleExceptionInstance if
+    the text isn't valid (or None), and the number of characters we
+    lexed.
+
+    If final is False, text is the start of a longer program (see
+    reader.py). We stop before any token that reaches the end of
+    text, since it might continue in the text that follows.
+
+    """
+    tokens = []
+    length = len(text)
+    i = 0
+
+    while i < length:
+        char = text[i]
+        start = i
+
+        if is_whitespace(char):
+            i += 1
+
+        elif char == u';':
+            # Comments continue until the end of the line.
+            while i < length and text[i] != u'\n':
+                i += 1
+
+            if i == length and not final:
+                return tokens, None, start
+
+        elif char == u'(':
+            tokens.append(OpenParen())
+            i += 1
+        elif char == u')':
+            tokens.append(CloseParen())
+            i += 1
+        elif char == u'{':
+            tokens.append(OpenCurlyParen())
+            i += 1
+        elif char == u'}':
+            tokens.append(CloseCurlyParen())
+            i += 1
+
+        elif is_atom_char(char):
+            while i < length and is_atom_char(text[i]):
+                i += 1
+
+            if i == length and not final:
+                return tokens, None, start
+
+            token = lex_atom(text[start:i])
+            if isinstance(token, TrifleExceptionInstance):
+                return tokens, token, start
+            tokens.append(token)
+
+        elif char == u'"':
+            chars = []
+            i += 1
+
+            while i < length and text[i] != u'"':
+                if text[i] == u'\\':
+                    if i + 1 == length and not final:
+                        return tokens, None, start
+
                     try:
-                        lexed_tokens.append(Float(float(float_string)))
-                    except ValueError:
-                        return TrifleExceptionInstance(
-                            lex_failed, u"Invalid float: '%s'" % token)
-
-                elif lexeme_name == FRACTION:
-                    fraction_string = remove_char(token, "_")
-                    fraction_parts = fraction_string.split('/')
-                    numerator = fraction_parts[0]
-                    denominator = fraction_parts[1]
-
-                    # TODO: validate that the fraction string is only numbers
-                    numerator = RBigInt.fromstr(numerator)
-                    denominator = RBigInt.fromstr(denominator)
-
-                    if denominator.eq(RBigInt.fromint(0)):
-                        return TrifleExceptionInstance(
-                            division_by_zero,
-                            u"Can't have fraction denominator of zero: '%s'" % token)
-
-                    fraction = Fraction(numerator, denominator)
-
-                    if fraction.denominator.eq(RBigInt.fromint(1)):
-                        lexed_tokens.append(Integer(fraction.numerator))
-                    else:
-                        lexed_tokens.append(fraction)
-
-                elif lexeme_name == SYMBOL:
-                    lexed_tokens.append(Symbol(token))
-                elif lexeme_name == KEYWORD:
-                    # todoc
-                    lexed_tokens.append(Keyword(token[1:]))
-                elif lexeme_name == BYTESTRING:
-                    string_end = match.match_end - 2
-
-                    # This is always true, but RPython doesn't support
-                    # negative indexes on slices and can't prove the
-                    # slice is non-negative.
-                    if string_end >= 0:
-                        contents = token[8:string_end]
-                    else:
-                        # Unreachable.
-                        contents = u""
-
-                    lexed_tokens.append(Bytestring(unescape_bytestring_chars(contents)))
-                    
-                elif lexeme_name == STRING:
-                    string_end = match.match_end - 1
-
-                    # This is always true, but RPython doesn't support
-                    # negative indexes on slices and can't prove the
-                    # slice is non-negative.
-                    if string_end >= 0:
-                        
-                        string_contents = token[1:string_end]
-
-                        lexed_tokens.append(String(unescape_chars(string_contents, u'"')))
-                elif lexeme_name == CHARACTER:
-
-                    # TODO: use unescape_chars
-                    if token == u"'\\n'":
-                        lexed_tokens.append(Character(u'\n'))
-                    elif token == u"'\\\\'":
-                        lexed_tokens.append(Character(u'\\'))
-                    elif token == u"'\\''":
-                        lexed_tokens.append(Character(u"'"))
-                    else:
-                        lexed_tokens.append(Character(token[1]))
+                        chars.append(unescape_char(text, i, u'"'))
+                    except LexFailed:
+                        return tokens, could_not_lex(text, start), start
+                    i += 2
                 else:
-                    assert False, u"Unrecognised token '%s'" % token
-                
-                break
+                    chars.append(text[i])
+                    i += 1
+
+            if i >= length:
+                if not final:
+                    return tokens, None, start
+                return tokens, could_not_lex(text, start), start
+
+            tokens.append(String(chars))
+            i += 1
+
+        elif char == u"'":
+            # Either: '\\', '\n', '\'' or a simple character between quotes: 'x'
+            if i + 1 < length and text[i + 1] == u'\\':
+                end = i + 3
+            else:
+                end = i + 2
+
+            if end >= length and not final:
+                return tokens, None, start
+
+            if i + 1 < length and text[i + 1] == u'\\':
+                try:
+                    character = unescape_char(text, i + 1, u"'")
+                except LexFailed:
+                    return tokens, could_not_lex(text, start), start
+            elif i + 1 < length and text[i + 1] != u"'":
+                character = text[i + 1]
+            else:
+                return tokens, could_not_lex(text, start), start
+
+            if end >= length or text[end] != u"'":
+                return tokens, could_not_lex(text, start), start
+
+            tokens.append(Character.fromchar(character))
+            i = end + 1
+
+        elif char == u'#':
+            # We might only have the start of a bytestring.
+            if not final and is_prefix_at_end(text, BYTESTRING_PREFIX, i):
+                return tokens, None, start
+
+            # Bytestrings may only contain ASCII letters, digits and
+            # escape sequences.
+            if starts_with_at(text, BYTESTRING_PREFIX, i):
+                contents_start = i + len(BYTESTRING_PREFIX)
+                contents_end = contents_start
+                while contents_end < length and is_bytestring_char(text[contents_end]):
+                    contents_end += 1
+
+                if contents_end + 2 > length and not final:
+                    return tokens, None, start
+
+                if starts_with_at(text, u'")', contents_end):
+                    try:
+                        byte_value = unescape_bytestring_chars(
+                            text[contents_start:contents_end])
+                    except LexFailed as e:
+                        return tokens, TrifleExceptionInstance(lex_failed, e.message), start
 
-        if not found_match:
-            return TrifleExceptionInstance(
-                lex_failed, u"Could not lex token: '%s'" % token)
+                    tokens.append(Bytestring(byte_value))
+                    i = contents_end + 2
+                    continue
+
+            # Otherwise, we have #true, #false or #null.
+            i += 1
+            while i < length and is_letter(text[i]):
+                i += 1
+
+            if i == length and not final:
+                return tokens, None, start
+
+            token = lex_hash_literal(text[start:i])
+            if isinstance(token, TrifleExceptionInstance):
+                return tokens, token, start
+            tokens.append(token)
+
+        else:
+            return tokens, could_not_lex(text, i), start
 
-    return List(lexed_tokens)
+    return tokens, None, length
 
 
 def lex(text):
-    try:
-        raw_tokens = split_tokens(text)
-        return _lex(raw_tokens)
-    except LexFailed as e:
-        return TrifleExceptionInstance(
-            lex_failed, e.message)
+    """Given the raw text of a trifle program, return a Trifle List of
+    tokens. Returns a Trifle exception if the text isn't valid.
+
+    """
+    tokens, error, _ = lex_tokens(text, True)
+
+    if error is not None:
+        return error
+
+    return List(tokens)
@@ -0,0 +1,143 @@
+from trifle_types import TrifleExceptionInstance
+from errors import lex_failed
+from lexer import lex_tokens
+from trifle_parser import Parser
+
+
+"""A Reader returns the top-level expressions in a file one at a
+time, reading the file in chunks. We only keep the text we haven't
+lexed yet and the expression we're currently parsing, so we can start
+evaluating a large program before we've read all of it.
+
+"""
+
+CHUNK_SIZE = 64 * 1024
+
+
+def complete_utf8_length(data):
+    """Return the length of the longest prefix of data that doesn't end
+    part-way through a UTF-8 encoded character.
+
+    """
+    length = len(data)
+
+    # UTF-8 characters are at most four bytes, so only the last three
+    # bytes can be part of an incomplete character.
+    i = length - 1
+    while i >= 0 and i >= length - 3:
+        byte = ord(data[i])
+
+        # Continuation bytes have the form 10xxxxxx.
+        if byte & 0xC0 != 0x80:
+            if byte >= 0xF0:
+                char_length = 4
+            elif byte >= 0xE0:
+                char_length = 3
+            elif byte >= 0xC0:
+                char_length = 2
+            else:
+                char_length = 1
+
+            if i + char_length > length:
+                return i
+            return length
+
+        i -= 1
+
+    return length
+
+
+class Reader(object):
+    def __init__(self, file_handle, chunk_size=CHUNK_SIZE):
+        # Any object with a .read(size) method, usually an open file.
+        self.file_handle = file_handle
+        self.initial_chunk_size = chunk_size
+        self.chunk_size = chunk_size
+
+        # Bytes at the end of the last chunk that aren't a complete
+        # UTF-8 character yet.
+        self.undecoded = ""
+        # Text that we haven't lexed yet, because it might be the
+        # start of a longer token.
+        self.text = u""
+
+        self.tokens = []
+        self.token_index = 0
+        self.parser = Parser()
+
+        # A lex error after self.tokens, which we return once we've
+        # parsed the tokens before it.
+        self.lex_error = None
+
+        self.finished_reading = False
+
+    def read_chunk(self):
+        """Read the next chunk of the file, and lex as much of our text as
+        we can.
+
+        """
+        data = self.file_handle.read(self.chunk_size)
+
+        if data:
+            data = self.undecoded + data
+            split = complete_utf8_length(data)
+            assert split >= 0
+            self.undecoded = data[split:]
+            data = data[:split]
+        else:
+            self.finished_reading = True
+            data = self.undecoded
+            self.undecoded = ""
+
+        try:
+            self.text += data.decode('utf-8')
+        except UnicodeDecodeError:
+            self.tokens = []
+            self.token_index = 0
+            self.lex_error = TrifleExceptionInstance(
+                lex_failed, u"Source code is not valid UTF-8.")
+            return
+
+        tokens, lex_error, consumed = lex_tokens(self.text, self.finished_reading)
+
+        if consumed == 0:
+            # A single token longer than our chunk size. Read bigger
+            # chunks so we don't lex its start over and over.
+            self.chunk_size *= 2
+        else:
+            self.chunk_size = self.initial_chunk_size
+
+        self.text = self.text[consumed:]
+        self.tokens = tokens
+        self.token_index = 0
+        self.lex_error = lex_error
+
+    def read_expression(self):
+        """Return the next top-level expression in the file, or None if
+        there are no more. Returns a TrifleExceptionInstance if the
+        file can't be lexed or parsed.
+
+        """
+        while True:
+            while self.token_index < len(self.tokens):
+                token = self.tokens[self.token_index]
+                self.token_index += 1
+
+                parse_error = self.parser.push(token)
+                if parse_error is not None:
+                    return parse_error
+
+                if self.parser.is_complete():
+                    expressions = self.parser.take_expressions()
+                    if expressions:
+                        return expressions[0]
+
+            if self.lex_error is not None:
+                return self.lex_error
+
+            if self.finished_reading:
+                if not self.parser.is_complete():
+                    return self.parser.unclosed_error()
+                return None
+
+            self.read_chunk()
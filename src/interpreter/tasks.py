@@ -0,0 +1,329 @@
+"""Tasks let us interleave several Trifle computations in a single OS
+thread. Every task has its own Stack, and the scheduler runs the tasks
+that are ready round robin, giving each one a slice of TASK_STEPS
+steps (loop iterations and function calls) before moving on.
+
+A task that has to wait for something (a timer, another task or a file
+descriptor) stores a Wait on its top frame. When the evaluator finds a
+Wait that isn't ready, it stops, and the scheduler switches to another
+task. If no task can run, the scheduler sleeps until a timer expires
+or a file descriptor becomes ready. Before the interpreter exits, it
+runs any tasks that haven't finished.
+
+"""
+import time
+
+from rpython.rlib import rpoll
+
+from trifle_types import TrifleType, TrifleExceptionInstance, NULL
+from errors import error, deadlock
+from continuations import Continuation
+
+
+# How many loop iterations and function calls a task may make before
+# we switch to another task.
+TASK_STEPS = 1000
+
+
+class Task(TrifleType):
+    def __init__(self, stack):
+        self.stack = stack
+        self.finished = False
+
+        # The value the task returned, or the error it threw.
+        self.result = None
+
+    def finish(self, result):
+        self.finished = True
+        self.result = result
+
+        # Let the frames be garbage collected.
+        self.stack = None
+
+    def waiting_on(self):
+        """Return the Wait this task is suspended on, or None if it's
+        runnable.
+
+        """
+        continuation = self.stack.peek().continuation
+        if isinstance(continuation, Wait):
+            return continuation
+        return None
+
+    def repr(self):
+        return u"<task>"
+
+
+class Wait(Continuation):
+    """A continuation that suspends the current task until ready()
+    returns True.
+
+    """
+    def __init__(self):
+        # If the task can wake up at a known time, the time.time() it
+        # wakes, otherwise -1.
+        self.wake_time = -1.0
+
+        # If the task is waiting for a file descriptor, the descriptor
+        # and the poll events it's waiting for, otherwise -1.
+        self.fd = -1
+        self.events = 0
+
+    def resume(self, result, stack):
+        # The value of the built-in that waited.
+        return NULL
+
+
+class SleepWait(Wait):
+    def __init__(self, wake_time):
+        Wait.__init__(self)
+        self.wake_time = wake_time
+
+    def ready(self):
+        return time.time() >= self.wake_time
+
+
+class YieldWait(Wait):
+    """Give up the rest of the current slice, but stay runnable."""
+    def __init__(self):
+        Wait.__init__(self)
+        self.suspended = False
+
+    def ready(self):
+        # The evaluator checks first, and we need it to stop. After
+        # that, we can carry on.
+        if self.suspended:
+            return True
+
+        self.suspended = True
+        return False
+
+
+class PollWait(Wait):
+    def __init__(self, fd, events):
+        Wait.__init__(self)
+        self.fd = fd
+        self.events = events
+
+    def ready(self):
+        return poll_ready(self.fd, self.events, 0)
+
+
+class TaskWait(Wait):
+    def __init__(self, task):
+        Wait.__init__(self)
+        self.task = task
+
+        # Set by the scheduler if every task is waiting for another
+        # task, so this one will never finish.
+        self.deadlocked = False
+
+    def ready(self):
+        return self.task.finished or self.deadlocked
+
+    def resume(self, result, stack):
+        if self.deadlocked:
+            return TrifleExceptionInstance(
+                deadlock,
+                u"Every task is waiting for another task to finish")
+
+        return task_result(self.task)
+
+
+def task_result(task):
+    """Return the result of this finished task. If it threw an error,
+    we throw a fresh copy of it, since every task that joins it might
+    catch it separately.
+
+    """
+    from evaluator import is_thrown_exception
+
+    result = task.result
+    if is_thrown_exception(result, error):
+        assert isinstance(result, TrifleExceptionInstance)
+        return TrifleExceptionInstance(result.exception_type, result.message)
+
+    return result
+
+
+def poll_ready(fd, events, timeout):
+    """Wait up to timeout milliseconds (forever if timeout is -1) for
+    this file descriptor to be ready. Errors and hangups count as
+    ready, so the task can find out about them.
+
+    """
+    try:
+        return len(rpoll.poll({fd: events}, timeout)) > 0
+    except rpoll.PollError:
+        # E.g. we were interrupted by a signal, so check again later.
+        return False
+
+
+def wait_on(stack, wait):
+    """Suspend the task running this stack until wait is ready. The
+    calling built-in should return None.
+
+    """
+    frame = stack.peek()
+    frame.continuation = wait
+
+    # The evaluator passes the last value in evalled to resume, so
+    # give it a placeholder.
+    frame.evalled.append(NULL)
+    return None
+
+
+class Scheduler(object):
+    def __init__(self):
+        # Every task that hasn't finished, in the order we run them.
+        self.tasks = []
+
+        # The task whose slice we're in, if any.
+        self.current = None
+
+    def spawn(self, stack):
+        task = Task(stack)
+        self.tasks.append(task)
+
+        # The current task may have been running without a limit,
+        # since there was no other task to switch to.
+        current = self.current
+        if current is not None and current.stack.steps_left == 0:
+            current.stack.steps_left = TASK_STEPS
+
+        return task
+
+    def is_current(self, stack):
+        """Is this the stack of the task we're running? Other stacks
+        (e.g. when we expand a macro) must finish before we return to
+        the task, so they can't wait.
+
+        """
+        return self.current is not None and self.current.stack is stack
+
+    def run(self, main):
+        """Run the tasks until main has finished, and return its
+        result. Other tasks that haven't finished will carry on next
+        time we run.
+
+        """
+        self.tasks.append(main)
+
+        while True:
+            ran_task = self.run_round()
+
+            if main.finished:
+                break
+
+            if not ran_task and not self.wait_for_event():
+                # Nothing can wake up main, so give it an error.
+                wait = main.waiting_on()
+                assert isinstance(wait, TaskWait)
+                wait.deadlocked = True
+
+        return main.result
+
+    def run_all(self):
+        """Run the tasks until they have all finished. We call this
+        before exiting, so tasks spawned near the end of the program
+        still run.
+
+        """
+        while self.tasks:
+            ran_task = self.run_round()
+
+            if not ran_task and not self.wait_for_event():
+                # Every task is waiting for another task, so give
+                # them all an error.
+                for task in self.tasks:
+                    wait = task.waiting_on()
+                    assert isinstance(wait, TaskWait)
+                    wait.deadlocked = True
+
+    def run_round(self):
+        """Give every task that's ready a slice. Return True if we ran
+        any tasks.
+
+        """
+        ran_task = False
+
+        # Tasks may spawn other tasks, which we run next round.
+        for task in self.tasks[:]:
+            wait = task.waiting_on()
+            if wait is not None and not wait.ready():
+                continue
+
+            self.run_slice(task)
+            ran_task = True
+
+        self.tasks = [task for task in self.tasks if not task.finished]
+        return ran_task
+
+    def run_slice(self, task):
+        from evaluator import evaluate_stack
+
+        stack = task.stack
+        self.current = task
+
+        # If this is the only task, let it run until it finishes or
+        # waits.
+        if len(self.tasks) > 1:
+            stack.steps_left = TASK_STEPS
+
+        result = None
+        completed = False
+        try:
+            result = evaluate_stack(stack)
+            completed = True
+        finally:
+            stack.steps_left = 0
+            self.current = None
+
+            # If evaluation raised (e.g. exit! raises SystemExit), the
+            # task can't carry on.
+            if not completed:
+                self.tasks.remove(task)
+
+        if result is not None:
+            task.finish(result)
+
+    def wait_for_event(self):
+        """Every task is waiting, so sleep until one of them can run.
+        Return False if none of them are waiting for a timer or a file
+        descriptor, so they'll never run.
+
+        """
+        wake_time = -1.0
+        fds = {}
+
+        for task in self.tasks:
+            wait = task.waiting_on()
+            assert wait is not None
+
+            if wait.wake_time >= 0 and (wake_time < 0 or wait.wake_time < wake_time):
+                wake_time = wait.wake_time
+
+            if wait.fd >= 0:
+                fds[wait.fd] = fds.get(wait.fd, 0) | wait.events
+
+        if wake_time < 0 and not fds:
+            return False
+
+        timeout = -1
+        if wake_time >= 0:
+            seconds = max(wake_time - time.time(), 0.0)
+            # Round up, so we don't wake up just before the timer.
+            timeout = int(seconds * 1000) + 1
+
+        if fds:
+            try:
+                rpoll.poll(fds, timeout)
+            except rpoll.PollError:
+                pass
+        else:
+            time.sleep(timeout / 1000.0)
+
+        return True
+
+
+scheduler = Scheduler()
@@ -37,67 +37,104 @@ def list_to_hashmap(trifle_list):
     return hashmap
 
 
-def parse_inner(tokens, top_level, expecting_list):
-    parsed_expressions = List()
-    saw_closing_paren = False
+class Parser(object):
+    """Builds expressions from tokens, one token at a time.
 
-    # TODO: This could cause a stack overflow for deeply nested literals.
-    while tokens:
-        token = tokens.pop(0)
+    We keep an explicit stack of the lists and hashmaps that we
+    haven't closed yet, rather than recursing, so deeply nested
+    literals can't overflow the stack.
 
+    """
+    def __init__(self):
+        # The elements of each container we haven't closed yet,
+        # starting with the top level.
+        self.open_elements = [[]]
+        # For each container, whether it's a list (rather than a hashmap).
+        self.expecting_lists = [True]
+
+    def push(self, token):
+        """Add this token to the expressions we're building. Returns a
+        TrifleExceptionInstance if the token isn't valid here, or None.
+
+        """
         if isinstance(token, OpenParen):
-            parsed = parse_inner(tokens, top_level=False, expecting_list=True)
-
-            if isinstance(parsed, TrifleExceptionInstance):
-                return parsed
+            self.open_elements.append([])
+            self.expecting_lists.append(True)
 
-            parsed_expressions.append(parsed)
         elif isinstance(token, OpenCurlyParen):
-            parsed = parse_inner(tokens, top_level=False, expecting_list=False)
+            self.open_elements.append([])
+            self.expecting_lists.append(False)
 
-            if isinstance(parsed, TrifleExceptionInstance):
-                return parsed
-                
-            parsed_expressions.append(parsed)
         elif isinstance(token, CloseParen):
-            if top_level:
+            if len(self.open_elements) == 1:
                 return TrifleExceptionInstance(
                     parse_failed,
                     u'Closing ) has no matching opening (.')
-            elif not expecting_list:
+            elif not self.expecting_lists[-1]:
                 return TrifleExceptionInstance(
                     parse_failed,
                     u'Closing ) does not match opening {.')
-            else:
-                saw_closing_paren = True
-                break
+
+            self.expecting_lists.pop()
+            parsed = List(self.open_elements.pop())
+            self.open_elements[-1].append(parsed)
+
         elif isinstance(token, CloseCurlyParen):
-            if top_level:
+            if len(self.open_elements) == 1:
                 return TrifleExceptionInstance(
                     parse_failed,
                     u'Closing } has no matching opening {.')
-            elif expecting_list:
+            elif self.expecting_lists[-1]:
                 return TrifleExceptionInstance(
                     parse_failed,
                     u'Closing } does not match opening (.')
-            else:
-                saw_closing_paren = True
-                break
+
+            self.expecting_lists.pop()
+            hashmap = list_to_hashmap(List(self.open_elements.pop()))
+            if isinstance(hashmap, TrifleExceptionInstance):
+                return hashmap
+
+            self.open_elements[-1].append(hashmap)
+
         else:
-            parsed_expressions.append(token)
+            self.open_elements[-1].append(token)
+
+        return None
 
-    if not top_level and not saw_closing_paren:
+    def is_complete(self):
+        """Have we closed every list and hashmap?"""
+        return len(self.open_elements) == 1
+
+    def unclosed_error(self):
         return TrifleExceptionInstance(
             parse_failed, u'Open paren was not closed.')
 
-    if expecting_list:
-        return parsed_expressions
-    else:
-        return list_to_hashmap(parsed_expressions)
+    def take_expressions(self):
+        """Return the top-level expressions we've finished, and forget
+        them.
+
+        """
+        expressions = self.open_elements[0]
+        self.open_elements[0] = []
+        return expressions
 
 
 def parse(tokens):
-    return parse_inner(tokens.values, top_level=True, expecting_list=True)
+    """Parse a Trifle List of tokens into a List of top-level expressions.
+    Returns a TrifleExceptionInstance if the tokens aren't balanced.
+
+    """
+    parser = Parser()
+
+    for token in tokens.values:
+        parse_error = parser.push(token)
+        if parse_error is not None:
+            return parse_error
+
+    if not parser.is_complete():
+        return parser.unclosed_error()
+
+    return List(parser.take_expressions())
 
 
 def parse_one(tokens):
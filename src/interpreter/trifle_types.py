@@ -1,6 +1,8 @@
 import os
 from rpython.rlib.rbigint import rbigint as RBigInt
-from rpython.rlib.objectmodel import r_dict
+from rpython.rlib.objectmodel import r_dict, compute_identity_hash
+from rpython.rlib.rarithmetic import string_to_int, ovfcheck
+from rpython.rlib.rstring import ParseStringOverflowError
 
 """Note that 'types' is part of the python standard library, so we're
 forced to name this file trifle_types.
@@ -17,36 +19,33 @@ def is_equal(x, y):
     lists and hashmaps.
 
     """
-    # TODO: Once we have proper interning, we should be able to use `x
-    # is y` for symbols and keywords.
-    if isinstance(x, Symbol):
-        if isinstance(y, Symbol):
-            return x.symbol_name == y.symbol_name
-
-        return False
-
-    elif isinstance(x, Keyword):
-        if isinstance(y, Keyword):
-            return x.symbol_name == y.symbol_name
-
-        return False
-
-    elif isinstance(x, Float):
+    # Symbols and keywords are interned, so they're only equal if
+    # they're the same object. We handle them in the `x is y` case
+    # at the end.
+    if isinstance(x, Float):
         if isinstance(y, Float):
             return x.float_value == y.float_value
 
         elif isinstance(y, Integer):
             # TODO: potentially y could be too big for floats.
-            return x.float_value == y.bigint_value.tofloat()
+            return x.float_value == y.tofloat()
 
         return False
 
     elif isinstance(x, Integer):
         if isinstance(y, Integer):
+            if x.is_small() and y.is_small():
+                return x.int_value == y.int_value
+
+            # Integers are always small if they fit in a machine word,
+            # so a small integer never equals a big one.
+            if x.is_small() or y.is_small():
+                return False
+
             return x.bigint_value.eq(y.bigint_value)
 
         elif isinstance(y, Float):
-            return x.bigint_value.tofloat() == y.float_value
+            return x.tofloat() == y.float_value
 
         return False
 
@@ -90,6 +89,31 @@ def is_equal(x, y):
                     return False
             return True
 
+        elif isinstance(y, Range):
+            return is_equal(y, x)
+
+        return False
+
+    # A range is equal to any range or list with the same elements.
+    elif isinstance(x, Range):
+        if isinstance(y, Range):
+            if x.length != y.length:
+                return False
+            if x.length == 0:
+                return True
+            if x.start != y.start:
+                return False
+            return x.length == 1 or x.step == y.step
+
+        elif isinstance(y, List):
+            if x.length != len(y.values):
+                return False
+
+            for i in range(x.length):
+                if not is_equal(Integer.fromint(x.get(i)), y.values[i]):
+                    return False
+            return True
+
         return False
 
     elif isinstance(x, Hashmap):
@@ -160,7 +184,17 @@ NULL = Null()
 
 
 class Integer(TrifleType):
+    """An arbitrary size integer. Integers that fit in a machine word
+    are stored in int_value, so arithmetic on them doesn't allocate
+    an RBigInt. Larger integers are stored in bigint_value.
+
+    We always use int_value when the value fits, so is_small() tells
+    us exactly whether the value fits in a machine word.
+
+    """
     def repr(self):
+        if self.bigint_value is None:
+            return unicode(str(self.int_value))
         return unicode(self.bigint_value.str())
 
     def __eq__(self, other):
@@ -171,20 +205,58 @@ class Integer(TrifleType):
         if self.__class__ != other.__class__:
             return False
 
-        return self.bigint_value.eq(other.bigint_value)
+        return self.as_bigint().eq(other.as_bigint())
 
-    def __init__(self, value):
-        assert isinstance(value, RBigInt)
-        self.bigint_value = value
+    def __init__(self, int_value, bigint_value=None):
+        """Don't call this directly, use Integer.fromint or
+        Integer.frombigint.
+
+        """
+        self.int_value = int_value
+        self.bigint_value = bigint_value
+
+    def is_small(self):
+        return self.bigint_value is None
+
+    def as_bigint(self):
+        if self.bigint_value is None:
+            return RBigInt.fromint(self.int_value)
+        return self.bigint_value
+
+    def tofloat(self):
+        if self.bigint_value is None:
+            return float(self.int_value)
+        return self.bigint_value.tofloat()
 
     @staticmethod
     def fromstr(s):
-        return Integer(RBigInt.fromdecimalstr(s))
+        try:
+            return Integer.fromint(string_to_int(s))
+        except ParseStringOverflowError:
+            return Integer(0, RBigInt.fromdecimalstr(s))
 
     @staticmethod
     def fromint(num):
         assert isinstance(num, int), "Expected Python int but got: %s" % num
-        return Integer(RBigInt.fromint(num))
+        if CACHED_INTEGER_MIN <= num <= CACHED_INTEGER_MAX:
+            return CACHED_INTEGERS[num - CACHED_INTEGER_MIN]
+        return Integer(num)
+
+    @staticmethod
+    def frombigint(value):
+        assert isinstance(value, RBigInt)
+        try:
+            return Integer.fromint(value.toint())
+        except OverflowError:
+            return Integer(0, value)
+
+
+# Integers are immutable, so we share a single instance for each
+# commonly used value rather than allocating a new one each time.
+CACHED_INTEGER_MIN = -5
+CACHED_INTEGER_MAX = 1024
+
+CACHED_INTEGERS = [Integer(num) for num in range(CACHED_INTEGER_MIN, CACHED_INTEGER_MAX + 1)]
 
 
 def greatest_common_divisor(a, b):
@@ -242,19 +314,43 @@ class Float(TrifleType):
 
 
 class Symbol(TrifleType):
+    """Symbols are interned, so there's only one Symbol with a given
+    name. Each symbol has a small integer id, which scopes use as the
+    key for variables bound to this symbol.
+
+    """
     def repr(self):
         return self.symbol_name
 
     def __repr__(self):
         return "<%s: %s>" % (self.__class__.__name__, self.symbol_name)
 
-    def __init__(self, symbol_name):
+    def __init__(self, symbol_name, symbol_id):
+        """Don't call this directly, use Symbol.intern."""
         assert isinstance(symbol_name, unicode)
         self.symbol_name = symbol_name
+        self.symbol_id = symbol_id
+
+    @staticmethod
+    def intern(symbol_name):
+        assert isinstance(symbol_name, unicode)
+
+        symbol = SYMBOL_TABLE.symbols.get(symbol_name, None)
+        if symbol is None:
+            symbol = Symbol(symbol_name, len(SYMBOL_TABLE.symbols_by_id))
+            SYMBOL_TABLE.symbols[symbol_name] = symbol
+            SYMBOL_TABLE.symbols_by_id.append(symbol)
+
+        return symbol
+
+    @staticmethod
+    def from_id(symbol_id):
+        return SYMBOL_TABLE.symbols_by_id[symbol_id]
 
 
 # TODOC
 class Keyword(TrifleType):
+    """Like symbols, keywords are interned."""
     def repr(self):
         return u":%s" % self.symbol_name
 
@@ -262,9 +358,32 @@ class Keyword(TrifleType):
         return "<%s: %s>" % (self.__class__.__name__, self.symbol_name)
 
     def __init__(self, symbol_name):
+        """Don't call this directly, use Keyword.intern."""
         assert isinstance(symbol_name, unicode)
         self.symbol_name = symbol_name
 
+    @staticmethod
+    def intern(symbol_name):
+        assert isinstance(symbol_name, unicode)
+
+        keyword = SYMBOL_TABLE.keywords.get(symbol_name, None)
+        if keyword is None:
+            keyword = Keyword(symbol_name)
+            SYMBOL_TABLE.keywords[symbol_name] = keyword
+
+        return keyword
+
+
+class SymbolTable(object):
+    """Every symbol and keyword we have created, by name."""
+    def __init__(self):
+        self.symbols = {}
+        self.symbols_by_id = []
+        self.keywords = {}
+
+
+SYMBOL_TABLE = SymbolTable()
+
 
 class Character(TrifleType):
     def repr(self):
@@ -278,22 +397,59 @@ class Character(TrifleType):
             return u"'%s'" % self.character
 
     def __repr__(self):
-        return "<%s: %s>" % (self.__class__.__name__, self.character)
+        return "<%s: %s>" % (self.__class__.__name__, self.character.encode("utf-8"))
 
     def __init__(self, character):
+        """Don't call this directly, use Character.fromchar."""
         assert isinstance(character, unicode)
         assert len(character) == 1
 
         self.character = character
 
+    @staticmethod
+    def fromchar(character):
+        assert isinstance(character, unicode)
+        assert len(character) == 1
+
+        if ord(character[0]) < CACHED_CHARACTER_LIMIT:
+            return CACHED_CHARACTERS[ord(character[0])]
+        return Character(character)
+
+
+# Like integers, characters are immutable, so we share an instance
+# for each Latin-1 character.
+CACHED_CHARACTER_LIMIT = 256
+
+CACHED_CHARACTERS = [Character(unichr(code)) for code in range(CACHED_CHARACTER_LIMIT)]
+
 
 def hash_trifle_type(trifle_value):
     if isinstance(trifle_value, Integer):
+        if trifle_value.is_small():
+            # A small integer never equals a big one, so we don't need
+            # to hash them consistently.
+            return trifle_value.int_value
         return trifle_value.bigint_value.hash()
     else:
         assert False, "TODO: hash more Trifle types."
 
 
+def is_same_object(x, y):
+    return x is y
+
+
+def identity_hash(value):
+    return compute_identity_hash(value)
+
+
+def identity_dict():
+    """Return an empty dict whose keys are Trifle values compared by
+    identity, rather than with is_equal.
+
+    """
+    return r_dict(is_same_object, identity_hash)
+
+
 class Hashmap(TrifleType):
     def __init__(self):
         self.dict = r_dict(is_equal, hash_trifle_type)
@@ -311,6 +467,11 @@ class Hashmap(TrifleType):
 
 
 class String(TrifleType):
+    """A mutable string. We store a list of unicode chars, which RPython
+    compiles to a resizable array of 32-bit code points, so indexing
+    is O(1) and appending is amortized O(1).
+
+    """
     def repr(self):
         printable_chars = []
         for char in self.string:
@@ -329,7 +490,9 @@ class String(TrifleType):
         return '<String: %s>' % self.repr()
 
     def as_unicode(self):
-        return u"".join(self.string)
+        if self.unicode_value is None:
+            self.unicode_value = u"".join(self.string)
+        return self.unicode_value
 
     def __init__(self, string):
         """We expect a list of unicode chars."""
@@ -339,8 +502,57 @@ class String(TrifleType):
 
         self.string = string
 
+        # If True, another String may be using the same list, so we
+        # must copy it before we mutate it.
+        self.shared = False
+
+        # Our contents as a unicode object, so we only build it once
+        # when we use the same string repeatedly for I/O, parsing or
+        # file names. None if we haven't built it since the last mutation.
+        self.unicode_value = None
+
+    @staticmethod
+    def fromunicode(text):
+        string = String([char for char in text])
+        string.unicode_value = text
+        return string
+
+    def shared_copy(self):
+        """Return a String with the same contents, which shares our
+        list of characters until either of us is mutated.
+
+        """
+        self.shared = True
+        copy = String(self.string)
+        copy.shared = True
+        copy.unicode_value = self.unicode_value
+        return copy
+
+    # Any code that mutates a string should do so with these methods,
+    # so we copy shared characters first.
+    def set_index(self, index, char):
+        self.unshare()
+        self.string[index] = char
+        self.unicode_value = None
+
+    def insert(self, index, char):
+        self.unshare()
+        self.string.insert(index, char)
+        self.unicode_value = None
+
+    def unshare(self):
+        if self.shared:
+            self.string = [char for char in self.string]
+            self.shared = False
+
 
 class List(TrifleType):
+    # The evaluator caches its analysis of a list when it's evaluated
+    # as code (see evaluator.compile_expression). The JIT can
+    # constant-fold reads of `compiled`, since we only change it when
+    # the list is mutated.
+    _immutable_fields_ = ['compiled?']
+
     def __init__(self, values=None):
         if values is None:
             self.values = []
@@ -348,8 +560,49 @@ class List(TrifleType):
             assert isinstance(values, list)
             self.values = values
 
+        self.compiled = None
+
+        # Macro calls (Lists) whose cached expansion read this list,
+        # as an identity_dict with the calls as keys.
+        self.dependent_calls = None
+
+        # The List we built from this one the last time we expanded
+        # the macros inside it (see evaluator.expand_all_macros).
+        self.expanded_form = None
+
+    # Any code that mutates a list should do so with these methods,
+    # so we discard any stale compiled form.
     def append(self, value):
         self.values.append(value)
+        self.mutated()
+
+    def set_index(self, index, value):
+        self.values[index] = value
+        self.mutated()
+
+    def insert(self, index, value):
+        self.values.insert(index, value)
+        self.mutated()
+
+    def set_values(self, values):
+        self.values = values
+        self.mutated()
+
+    def mutated(self):
+        # Writing to a quasi-immutable field invalidates any JIT code
+        # that depends on it, so only write when we need to.
+        if self.compiled is not None:
+            self.compiled = None
+
+        self.expanded_form = None
+
+        # Those macro calls need expanding again. We clear the dict
+        # first, so we stop if the lists contain each other.
+        dependent_calls = self.dependent_calls
+        if dependent_calls is not None:
+            self.dependent_calls = None
+            for call in dependent_calls.keys():
+                call.mutated()
 
     # TODO: fix infinite loop for lists that contain themselves
     def repr(self):
@@ -358,20 +611,58 @@ class List(TrifleType):
 
 
 class Bytestring(TrifleType):
+    """A mutable sequence of bytes. We store a list of single-byte
+    chars, which RPython compiles to a resizable char array, so we
+    can convert to and from the strs that file I/O uses without
+    boxing each byte.
+
+    """
     def __init__(self, byte_value):
+        """We expect a list of single-byte strs."""
         assert isinstance(byte_value, list), "Expected a list, but got: %s" % byte_value
         if byte_value:
-            assert isinstance(byte_value[0], int)
+            assert isinstance(byte_value[0], str)
         self.byte_value = byte_value
 
+        # As with String, we copy shared bytes before mutating them.
+        self.shared = False
+
+    @staticmethod
+    def frombytes(data):
+        return Bytestring([char for char in data])
+
+    def as_bytes(self):
+        return "".join(self.byte_value)
+
+    def get_byte(self, index):
+        return ord(self.byte_value[index])
+
+    def shared_copy(self):
+        self.shared = True
+        copy = Bytestring(self.byte_value)
+        copy.shared = True
+        return copy
+
+    def set_index(self, index, byte):
+        self.unshare()
+        self.byte_value[index] = chr(byte)
+
+    def insert(self, index, byte):
+        self.unshare()
+        self.byte_value.insert(index, chr(byte))
+
+    def unshare(self):
+        if self.shared:
+            self.byte_value = [char for char in self.byte_value]
+            self.shared = False
+
     def repr(self):
         SMALLEST_PRINTABLE_CHAR = ' '
         LARGEST_PRINTABLE_CHAR = '~'
 
         printable_chars = []
 
-        for char_code in self.byte_value:
-            char = chr(char_code)
+        for char in self.byte_value:
             if SMALLEST_PRINTABLE_CHAR <= char <= LARGEST_PRINTABLE_CHAR:
                 if char == "\\":
                     printable_chars.append("\\\\")
@@ -385,6 +676,88 @@ class Bytestring(TrifleType):
         return u'#bytes("%s")' % ("".join(printable_chars)).decode('utf-8')
 
 
+def range_length(start, stop, step):
+    """Return the number of integers in range(start, stop, step).
+    Raises OverflowError if the range has more than sys.maxint items.
+
+    """
+    assert step != 0
+
+    if step > 0:
+        if start >= stop:
+            return 0
+        distance = ovfcheck(stop - start)
+        return (distance - 1) // step + 1
+    else:
+        if start <= stop:
+            return 0
+        distance = ovfcheck(start - stop)
+        return (distance - 1) // ovfcheck(-step) + 1
+
+
+class Range(TrifleType):
+    """An immutable sequence of the integers from start up to (but not
+    including) stop, separated by step. We compute each element when
+    it's accessed, so a range uses constant memory.
+
+    """
+    _immutable_fields_ = ['start', 'stop', 'step', 'length']
+
+    def __init__(self, start, stop, step):
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.length = range_length(start, stop, step)
+
+    def get(self, index):
+        return self.start + index * self.step
+
+    def repr(self):
+        if self.step == 1:
+            return u"(range %d %d)" % (self.start, self.stop)
+        return u"(range %d %d %d)" % (self.start, self.stop, self.step)
+
+
+class Exhausted(TrifleType):
+    """Returned by LazySequence.pull when there are no elements left.
+    This is never a Trifle value.
+
+    """
+    def repr(self):
+        return u"<exhausted>"
+
+
+EXHAUSTED = Exhausted()
+
+
+class LazySequence(TrifleType):
+    """A sequence whose elements are computed one at a time by
+    next_element, when they're asked for. Lazy sequences can only be
+    iterated over once.
+
+    Computing an element may mean calling a Trifle function, so pull
+    takes the stack and a Continuation. We return the next element,
+    EXHAUSTED, or a thrown exception. If we had to make a call
+    instead, we return None, and continuation.resume will be called
+    with the element (or EXHAUSTED) later.
+
+    """
+    def __init__(self):
+        # An element we computed early, e.g. for empty?.
+        self.peeked = None
+
+    def pull(self, stack, continuation):
+        peeked = self.peeked
+        if peeked is not None:
+            self.peeked = None
+            return peeked
+
+        return self.next_element(stack, continuation)
+
+    def repr(self):
+        return u"<lazy sequence>"
+
+
 class FileHandle(TrifleType):
     def __init__(self, file_name, file_handle, file_mode):
         self.is_closed = False
@@ -405,6 +778,9 @@ class FileHandle(TrifleType):
     def write(self, string):
         self.file_handle.write(string)
 
+    def fileno(self):
+        return self.file_handle.fileno()
+
     def repr(self):
         return u'#file-handle("%s")' % self.file_name.decode('utf-8')
 
@@ -417,7 +793,7 @@ class Stdout(FileHandle):
     def __init__(self):
         self.file_name = ""
         self.is_closed = False
-        self.mode = Keyword(u'write')
+        self.mode = Keyword.intern(u'write')
 
     def close(self):
         self.is_closed = True
@@ -436,6 +812,9 @@ class Stdout(FileHandle):
     def write(self, string):
         os.write(STDOUT_FILE_DESCRIPTOR, string)
 
+    def fileno(self):
+        return STDOUT_FILE_DESCRIPTOR
+
     def repr(self):
         return u'#file-handle(stdout)'
 
@@ -464,6 +843,15 @@ class FunctionWithEnv(TrifleType):
 
 
 # todo: could we define interpreter Function classes in terms of Lambda?
+def parameter_symbols(parameters):
+    """Given a valid parameter List, return a Python list of the
+    symbols it binds. `:rest` is not a variable.
+
+    """
+    return [param for param in parameters.values
+            if isinstance(param, Symbol)]
+
+
 class Lambda(TrifleType):
     """A user defined function. Holds a reference to the current lexical
     environment, so we support closures.
@@ -474,6 +862,10 @@ class Lambda(TrifleType):
         self.body = body
         self.env = env
 
+        # The variables bound when we call this lambda, in the order
+        # they're stored in the call's scope.
+        self.parameter_symbols = parameter_symbols(arguments)
+
     def repr(self):
         # todo: we can be more helpful than this
         return u"<lambda>"
@@ -533,6 +925,8 @@ class Macro(TrifleType):
         self.arguments = arguments
         self.body = body
 
+        self.parameter_symbols = parameter_symbols(arguments)
+
     def repr(self):
         # todo: we can be more helpful than this
         return u"<macro>"
@@ -543,6 +937,17 @@ class Special(TrifleType):
     unevaluated, but at run time.
 
     """
+    def check(self, args):
+        """Check that the unevaluated arguments are well formed. This
+        only depends on the syntax of the expression, so the evaluator
+        calls it once per expression rather than on every step.
+
+        Return an error, raise ArityError, or return None if the
+        arguments are fine.
+
+        """
+        return None
+
     def repr(self):
         # todo: we can be more helpful than this
         return u"<special expression>"
@@ -0,0 +1,37 @@
+"""Time lexing synthetic programs of increasing size, to check that
+the lexer scales linearly. Run with:
+
+$ PYTHONPATH=pypy python2 lexer_benchmark.py
+
+"""
+import time
+
+from interpreter.lexer import lex
+from interpreter.trifle_types import TrifleExceptionInstance
+
+
+# A line of typical tokens.
+LINE = u'(foo-bar 123 -4.5 1/3 "a \\"string\\"" \'c\' :key #true #null) ; comment\n'
+
+SIZES = [10 * 1000, 1000 * 1000, 10 * 1000 * 1000]
+
+
+def synthetic_program(size):
+    return LINE * (size // len(LINE))
+
+
+def main():
+    for size in SIZES:
+        program = synthetic_program(size)
+
+        start = time.time()
+        result = lex(program)
+        elapsed = time.time() - start
+
+        assert not isinstance(result, TrifleExceptionInstance)
+        print "%9d chars: %7.3fs (%.2f us/char)" % (
+            len(program), elapsed, elapsed * 1000000 / len(program))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,13 +9,17 @@
 import sys
 import os
 
-from rpython.rtyper.module.ll_os_environ import getenv_llimpl
-
 from interpreter.lexer import lex
 from interpreter.trifle_parser import parse
-from interpreter.evaluator import evaluate_all, is_thrown_exception
+from interpreter.reader import Reader
+from interpreter.evaluator import (
+    evaluate, evaluate_program, expand_all_macros, is_thrown_exception)
 from interpreter.environment import fresh_environment
+from interpreter.trifle_types import (
+    List, Hashmap, String, Bytestring, Symbol, TrifleExceptionInstance)
+from interpreter.built_ins import FreshSymbol
 from interpreter.errors import error
+from interpreter.tasks import scheduler
 
 
 def get_contents(filename):
@@ -25,48 +29,101 @@ def get_contents(filename):
     """
     fp = os.open(filename, os.O_RDONLY, 0777)
 
-    program_contents = ""
+    chunks = []
     while True:
         read = os.read(fp, 4096)
         if len(read) == 0:
             break
-        program_contents += read
+        chunks.append(read)
     os.close(fp)
 
-    return program_contents.decode('utf-8')
+    return "".join(chunks).decode('utf-8')
+
+
+def copy_tree(expression):
+    """Return a copy of this parse tree that doesn't share any mutable
+    values (or cached compilation) with the original.
+
+    """
+    if isinstance(expression, List):
+        return List([copy_tree(item) for item in expression.values])
+    elif isinstance(expression, Hashmap):
+        hashmap = Hashmap()
+        for key, value in expression.dict.items():
+            hashmap.dict[key] = copy_tree(value)
+        return hashmap
+    elif isinstance(expression, String):
+        return String(list(expression.string))
+    elif isinstance(expression, Bytestring):
+        return Bytestring(list(expression.byte_value))
+
+    return expression
+
+
+def freeze_prelude(code):
+    """Lex, parse and evaluate the prelude. Return a List of its
+    top-level expressions with every macro expanded, and the number of
+    fresh symbols used when expanding them.
+
+    This isn't RPython: we call it at import time, so the prelude is
+    baked into the translated binary as prebuilt constants.
+
+    """
+    parse_tree = parse(lex(code))
+    assert not isinstance(parse_tree, TrifleExceptionInstance), "Could not parse prelude: %s" % parse_tree.repr()
+
+    env = fresh_environment()
+    expressions = []
+    for expression in parse_tree.values:
+        expanded = expand_all_macros(expression, env)
+        expressions.append(copy_tree(expanded))
+
+        result = evaluate(expanded, env)
+        assert not is_thrown_exception(result, error), "Error when evaluating prelude: %s" % result.repr()
+
+    return List(expressions), env.get(Symbol.intern(u'fresh-symbol')).count
+
+
+PRELUDE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "prelude.tfl")
+PRELUDE_EXPRESSIONS, PRELUDE_FRESH_SYMBOLS = freeze_prelude(
+    get_contents(PRELUDE_PATH))
 
 
 def env_with_prelude():
     """Return a fresh environment where the prelude has already been
     evaluated.
 
-    """
-    # todo: document TRIFLEPATH
-    # todo: should we inline the prelude, so changing TRIFLEPATH doens't break this?
-    trifle_path = getenv_llimpl("TRIFLEPATH") or "."
-    prelude_path = os.path.join(trifle_path, "prelude.tfl")
-    
-    # Trifle equivalent of PYTHONPATH.
-    try:
-        code = get_contents(prelude_path)
-    except OSError:
-        # TODO: work out which error occurred (not found/wrong
-        # permissions/other) and be more helpful.
-        print "Could not find prelude.tfl. Have you set TRIFLEPATH?"
-        raise
-
-    # TODO: either of these could return errors, and we should handle that.
-    lexed_tokens = lex(code)
-    parse_tree = parse(lexed_tokens)
+    The prelude was lexed, parsed and macro-expanded when this module
+    was imported, so we only need to evaluate it.
 
+    """
     env = fresh_environment()
-    result = evaluate_all(parse_tree, env)
 
-    assert not is_thrown_exception(result, error), "Error when evaluating prelude: %s" % result
+    # Don't reuse the fresh symbols in the expanded prelude.
+    fresh_symbol = env.get(Symbol.intern(u'fresh-symbol'))
+    assert isinstance(fresh_symbol, FreshSymbol)
+    fresh_symbol.count = PRELUDE_FRESH_SYMBOLS
+
+    for expression in PRELUDE_EXPRESSIONS.values:
+        result = evaluate(expression, env)
+        assert not is_thrown_exception(result, error), "Error when evaluating prelude: %s" % result
 
     return env
 
 
+def finish_tasks():
+    """Run any tasks that the program spawned but didn't join, so they
+    finish before we exit.
+
+    """
+    try:
+        scheduler.run_all()
+    except SystemExit:
+        # A task called exit!, so we don't run the others.
+        pass
+
+
 USAGE = """Usage:
 ./trifle -i <code snippet>
 ./trifle <path to script>"""
@@ -88,38 +145,42 @@ def entry_point(argv):
             print 'No such file: %s' % filename
             return 2
 
-        try:
-            env = env_with_prelude()
-        except OSError:
-            return 2
-        code = get_contents(filename)
-        lexed_tokens = lex(code)
-
-        if is_thrown_exception(lexed_tokens, error):
-            print u'Uncaught error: %s: %s' % (
-                lexed_tokens.exception_type.name,
-                lexed_tokens.message)
-            return 1
+        env = env_with_prelude()
 
-        parse_tree = parse(lexed_tokens)
+        # We evaluate each top-level expression as soon as we've read
+        # it, so we never hold the whole program in memory.
+        source = open(filename, 'r')
+        reader = Reader(source)
         try:
-            result = evaluate_all(parse_tree, env)
+            while True:
+                expression = reader.read_expression()
+                if expression is None:
+                    break
+
+                if is_thrown_exception(expression, error):
+                    print u'Uncaught error: %s: %s' % (
+                        expression.exception_type.name,
+                        expression.message)
+                    return 1
 
-            if is_thrown_exception(result, error):
-                # TODO: a proper stack trace.
-                print u'Uncaught error: %s: %s' % (result.exception_type.name,
-                                          result.message)
-                return 1
+                result = evaluate_program(List([expression]), env)
+
+                if is_thrown_exception(result, error):
+                    # TODO: a proper stack trace.
+                    print u'Uncaught error: %s: %s' % (result.exception_type.name,
+                                              result.message)
+                    return 1
         except SystemExit:
-            return 0
+            pass
+        finally:
+            source.close()
+
+        finish_tasks()
         return 0
     
     elif len(argv) == 3:
         if argv[1] == '-i':
-            try:
-                env = env_with_prelude()
-            except OSError:
-                return 2
+            env = env_with_prelude()
             code_snippet = argv[2].decode('utf-8')
             lexed_tokens = lex(code_snippet)
 
@@ -132,7 +193,7 @@ def entry_point(argv):
             parse_tree = parse(lexed_tokens)
 
             try:
-                result = evaluate_all(parse_tree, env)
+                result = evaluate_program(parse_tree, env)
 
                 if is_thrown_exception(result, error):
                     # TODO: a proper stack trace.
@@ -143,7 +204,9 @@ def entry_point(argv):
                     print result.repr().encode('utf-8')
                 
             except SystemExit:
-                return 0
+                pass
+
+            finish_tasks()
             return 0
             
     print USAGE
@@ -154,5 +217,11 @@ def target(*args):
     return entry_point, None
 
 
+def jitpolicy(driver):
+    """Used by RPython when we build with -Ojit."""
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
+
 if __name__ == '__main__':
     entry_point(sys.argv)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import unittest
 import os
+import sys
+from cStringIO import StringIO
 
 from rpython.rlib.rbigint import rbigint as RBigInt
 
@@ -8,6 +10,7 @@ from mock import patch, Mock
 
 from interpreter.lexer import lex
 from interpreter.trifle_parser import parse_one, parse
+from interpreter.reader import Reader
 from interpreter.built_ins import Add, SetSymbol, If
 from interpreter.trifle_types import (
     Hashmap, List, Integer, Float, Fraction,
@@ -16,13 +19,16 @@ from interpreter.trifle_types import (
     TRUE, FALSE, NULL,
     FileHandle, Bytestring,
     TrifleExceptionInstance)
-from interpreter.evaluator import evaluate, is_thrown_exception
+from interpreter.evaluator import (
+    evaluate, is_thrown_exception, expand_all_macros, expand_macro_call,
+    MAX_DEPENDENT_CALLS)
 from interpreter.errors import (
     error, lex_failed, parse_failed, missing_key,
     file_not_found, value_error, stack_overflow,
     division_by_zero, wrong_type, no_such_variable,
     changing_closed_handle, wrong_argument_number)
 from interpreter.environment import Environment, Scope, fresh_environment
+from interpreter.tasks import scheduler
 
 """Trifle unit tests. These are intended to be run with CPython, and
 no effort has been made to make them RPython friendly.
@@ -30,6 +36,11 @@ no effort has been made to make them RPython friendly.
 """
 
 class BuiltInTestCase(unittest.TestCase):
+    def setUp(self):
+        # Don't let unfinished tasks from another test run in this one.
+        scheduler.tasks = []
+        scheduler.current = None
+
     def eval(self, program, env=None):
         """Evaluate this program in a fresh environment. Returns the result of
         the last expression.
@@ -165,24 +176,35 @@ class FractionLexTest(BuiltInTestCase, LexTestCase):
         self.assertTrifleError(
             lex(u"1/3/4"), lex_failed)
 
+    def test_lex_fraction_without_digits(self):
+        self.assertTrifleError(
+            lex(u"_/3"), lex_failed)
+
 
 class SymbolLexTest(BuiltInTestCase, LexTestCase):
     def test_lex_symbol(self):
-        self.assertLexResult(u"x", Symbol(u'x'))
+        self.assertLexResult(u"x", Symbol.intern(u'x'))
+
+        self.assertLexResult(u"x1", Symbol.intern(u'x1'))
+
+        self.assertLexResult(u"foo?", Symbol.intern(u'foo?'))
 
-        self.assertLexResult(u"x1", Symbol(u'x1'))
+        self.assertLexResult(u"foo!", Symbol.intern(u'foo!'))
 
-        self.assertLexResult(u"foo?", Symbol(u'foo?'))
+        self.assertLexResult(u"foo_bar", Symbol.intern(u'foo_bar'))
 
-        self.assertLexResult(u"foo!", Symbol(u'foo!'))
+        self.assertLexResult(u"FOOBAR", Symbol.intern(u'FOOBAR'))
 
-        self.assertLexResult(u"foo_bar", Symbol(u'foo_bar'))
+        self.assertLexResult(u"<=", Symbol.intern(u'<='))
 
-        self.assertLexResult(u"FOOBAR", Symbol(u'FOOBAR'))
+        self.assertLexResult(u"_", Symbol.intern(u'_'))
 
-        self.assertLexResult(u"<=", Symbol(u'<='))
+    def test_lex_symbol_interned(self):
+        tokens = lex(u"foo foo bar")
+        self.assertIs(tokens.values[0], tokens.values[1])
+        self.assertIsNot(tokens.values[0], tokens.values[2])
 
-        self.assertLexResult(u"_", Symbol(u'_'))
+        self.assertIs(tokens.values[0], Symbol.from_id(tokens.values[0].symbol_id))
 
     def test_lex_invalid_symbol(self):
         self.assertTrifleError(
@@ -191,7 +213,11 @@ class SymbolLexTest(BuiltInTestCase, LexTestCase):
 
 class KeywordLexTest(BuiltInTestCase, LexTestCase):
     def test_lex_keyword(self):
-        self.assertLexResult(u":x", Keyword(u'x'))
+        self.assertLexResult(u":x", Keyword.intern(u'x'))
+
+    def test_lex_keyword_interned(self):
+        tokens = lex(u":foo :foo")
+        self.assertIs(tokens.values[0], tokens.values[1])
 
     def test_lex_invalid_keyword(self):
         self.assertTrifleError(
@@ -306,12 +332,12 @@ class CharacterLexTest(BuiltInTestCase, LexTestCase):
 
 class BytestringLexTest(BuiltInTestCase, LexTestCase):
     def test_lex_bytestring(self):
-        self.assertLexResult(u'#bytes("foo")', Bytestring([ord(c) for c in 'foo']))
+        self.assertLexResult(u'#bytes("foo")', Bytestring(list('foo')))
 
     def test_lex_multiple_bytestrings(self):
         self.assertEqual(
             lex(u'#bytes("foo") #bytes("bar")').values[1],
-            Bytestring([ord(c) for c in 'bar']))
+            Bytestring(list('bar')))
 
     def test_lex_invalid_byte(self):
         self.assertTrifleError(
@@ -322,12 +348,12 @@ class BytestringLexTest(BuiltInTestCase, LexTestCase):
         self.assertTrifleError(
             lex(u'#bytes("\\")'), lex_failed)
 
-        self.assertLexResult(u'#bytes("\\\\")', Bytestring([ord('\\')]))
+        self.assertLexResult(u'#bytes("\\\\")', Bytestring(['\\']))
 
     def test_lex_escaped_byte(self):
-        self.assertLexResult(u'#bytes("\\xff")', Bytestring([255]))
+        self.assertLexResult(u'#bytes("\\xff")', Bytestring(['\xff']))
 
-        self.assertLexResult(u'#bytes("\\xFF")', Bytestring([255]))
+        self.assertLexResult(u'#bytes("\\xFF")', Bytestring(['\xff']))
 
     def test_lex_invalid_escaped_byte(self):
         # Not hexadecimal characters:
@@ -379,6 +405,37 @@ class ParsingTest(BuiltInTestCase):
                          List([Integer.fromint(1), Integer.fromint(2),
                                Integer.fromint(3)]))
 
+    def test_parse_nested(self):
+        self.assertEqual(parse_one(lex(u"(1 (2 {3 4}) ())")),
+                         List([Integer.fromint(1),
+                               List([Integer.fromint(2),
+                                     parse_one(lex(u"{3 4}"))]),
+                               List()]))
+
+    def test_parse_deeply_nested(self):
+        depth = 100000
+        parsed = parse_one(lex(u"(" * depth + u")" * depth))
+
+        for _ in range(depth - 1):
+            self.assertEqual(len(parsed.values), 1)
+            parsed = parsed.values[0]
+
+        self.assertEqual(parsed, List())
+
+    def test_parse_unclosed(self):
+        self.assertTrifleError(
+            parse_one(lex(u"(1 (2)")), parse_failed)
+
+    def test_parse_unopened(self):
+        self.assertTrifleError(
+            parse_one(lex(u"(1) 2)")), parse_failed)
+
+    def test_parse_does_not_consume_tokens(self):
+        tokens = lex(u"(1 2)")
+        parse(tokens)
+
+        self.assertEqual(len(tokens.values), 4)
+
 
 class EvaluatingTypesTest(BuiltInTestCase):
     # TODO: this should be a syntax error.
@@ -400,6 +457,12 @@ class EvaluatingTypesTest(BuiltInTestCase):
             self.eval(u"123"),
             Integer.fromint(123))
 
+    def test_small_integers_shared(self):
+        self.assertIs(self.eval(u"(+ 1 2)"), Integer.fromint(3))
+        self.assertIs(self.eval(u"(length (quote (1 2)))"), Integer.fromint(2))
+
+        self.assertIsNot(Integer.fromint(100000), Integer.fromint(100000))
+
     def test_eval_float(self):
         self.assertEqual(
             self.eval(u"123.4"),
@@ -418,7 +481,7 @@ class EvaluatingTypesTest(BuiltInTestCase):
     def test_eval_keyword(self):
         self.assertEqual(
             self.eval(u":foo"),
-            Keyword(u"foo"))
+            Keyword.intern(u"foo"))
 
     def test_eval_string(self):
         self.assertEqual(
@@ -428,7 +491,7 @@ class EvaluatingTypesTest(BuiltInTestCase):
     def test_eval_bytes(self):
         self.assertEqual(
             self.eval(u'#bytes("foobar")'),
-            Bytestring([ord(c) for c in "foobar"]))
+            Bytestring(list("foobar")))
 
     def test_eval_character(self):
         self.assertEqual(
@@ -461,7 +524,7 @@ class ReprTest(BuiltInTestCase):
         self.assertEqual(hashmap_val.repr(), '{1 2, 3 4}')
 
     def test_bytes_repr(self):
-        bytes_val = Bytestring([ord(c) for c in "\\ souffl\xc3\xa9"])
+        bytes_val = Bytestring(list("\\ souffl\xc3\xa9"))
 
         self.assertEqual(
             bytes_val.repr(),
@@ -611,6 +674,21 @@ class EvaluatingLambdaTest(BuiltInTestCase):
         self.assertEvalError(
             u"((lambda () (set-symbol! (quote x) 2)) x)", no_such_variable)
 
+    def test_lambda_scope_doesnt_leak_globally(self):
+        self.assertEqual(
+            self.eval(u"((lambda () (set-symbol! (quote y) 2))) (defined? (quote y))"),
+            FALSE)
+
+    def test_set_parameter(self):
+        self.assertEqual(
+            self.eval(u"((lambda (x) (set-symbol! (quote x) 2) x) 1)"),
+            Integer.fromint(2))
+
+    def test_closure_sees_outer_parameter(self):
+        self.assertEqual(
+            self.eval(u"(((lambda (x y) (lambda (z) (+ x y z))) 1 2) 3)"),
+            Integer.fromint(6))
+
     def test_closure_variables(self):
         """Ensure that we can update closure variables inside a lambda.
 
@@ -622,14 +700,36 @@ class EvaluatingLambdaTest(BuiltInTestCase):
     # TODO: also test for stack overflow inside macros.
     def test_stack_overflow(self):
         self.assertEvalError(
-            u"(set-symbol! (quote f) (lambda () (f))) (f)", stack_overflow)
+            u"(set-symbol! (quote f) (lambda () (+ 1 (f)))) (f)", stack_overflow)
+
+    def test_tail_call(self):
+        """Calls in tail position shouldn't grow the stack.
+
+        """
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote f) (lambda (n) (if (< n 1) n (f (- n 1)))))"
+                      u"(f 1000)"),
+            Integer.fromint(0))
+
+    def test_tail_call_mutual_recursion(self):
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote even) (lambda (n) (if (< n 1) #true (odd (- n 1)))))"
+                      u"(set-symbol! (quote odd) (lambda (n) (if (< n 1) #false (even (- n 1)))))"
+                      u"(even 1001)"),
+            FALSE)
+
+    def test_tail_call_last_body_expression(self):
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote f) (lambda (n) 1 (if (< n 1) n (f (- n 1)))))"
+                      u"(f 1000)"),
+            Integer.fromint(0))
 
 
 class FreshSymbolTest(BuiltInTestCase):
     def test_fresh_symbol(self):
         self.assertEqual(
             self.eval(u"(fresh-symbol)"),
-            Symbol(u"1-unnamed"))
+            Symbol.intern(u"1-unnamed"))
 
     def test_fresh_symbol_wrong_arg_number(self):
         self.assertEvalError(
@@ -640,7 +740,7 @@ class SetSymbolTest(BuiltInTestCase):
     def test_set_symbol(self):
         self.assertEqual(
             self.eval(u"(set-symbol! (quote x) (quote y)) x"),
-            Symbol(u"y"))
+            Symbol.intern(u"y"))
 
     def test_set_symbol_wrong_arg_number(self):
         self.assertEvalError(
@@ -662,6 +762,12 @@ class LetTest(BuiltInTestCase):
             self.eval(u"(let (x 1) x)"),
             Integer.fromint(1))
 
+    def test_let_tail_call(self):
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote f) (lambda (n) (let (m (- n 1)) 1 (if (< m 1) m (f m)))))"
+                      u"(f 1000)"),
+            Integer.fromint(0))
+
     def test_let_access_previous_bindings(self):
         self.assertEqual(
             self.eval(u"(let (x 1 y (+ x 1)) y)"),
@@ -739,7 +845,7 @@ class QuoteTest(BuiltInTestCase):
             Integer.fromint(3))
 
     def test_unquote_nested(self):
-        expected = List([Symbol(u'x'), Integer.fromint(1)])
+        expected = List([Symbol.intern(u'x'), Integer.fromint(1)])
         
         self.assertEqual(
             self.eval(u"(set-symbol! (quote x) 1) (quote (x (unquote x)))"),
@@ -766,6 +872,13 @@ class QuoteTest(BuiltInTestCase):
         self.assertEvalError(
             u"(quote (list (unquote*)))", wrong_argument_number)
 
+    def test_unquote_error(self):
+        self.assertEvalError(
+            u"(quote (x (unquote i-dont-exist)))", no_such_variable)
+
+        self.assertEvalError(
+            u"(quote (x (unquote* i-dont-exist)))", no_such_variable)
+
     def test_unquote_star_wrong_type(self):
         self.assertEvalError(
             u"(quote (list (unquote* 1)))", wrong_type)
@@ -795,6 +908,17 @@ class AddTest(BuiltInTestCase):
         self.assertEqual(self.eval(u"(+ 1 2)"),
                          Integer.fromint(3))
 
+    def test_add_overflow(self):
+        result = self.eval(u"(+ %d 1)" % sys.maxint)
+        self.assertFalse(result.is_small())
+        self.assertEqual(result, Integer.frombigint(
+            RBigInt.fromint(sys.maxint).add(RBigInt.fromint(1))))
+
+        # Results that fit in a machine word are small again.
+        result = self.eval(u"(+ %d 1 -1)" % sys.maxint)
+        self.assertTrue(result.is_small())
+        self.assertEqual(result, Integer.fromint(sys.maxint))
+
     def test_add_floats(self):
         self.assertEqual(self.eval(u"(+ 1.0 2.0)"),
                          Float(3.0))
@@ -819,6 +943,9 @@ class AddTest(BuiltInTestCase):
         self.assertEvalError(
             u"(+ +)", wrong_type)
 
+        self.assertEvalError(
+            u"(+ 1 #null)", wrong_type)
+
 
 class SubtractTest(BuiltInTestCase):
     def test_subtract(self):
@@ -831,6 +958,17 @@ class SubtractTest(BuiltInTestCase):
         self.assertEqual(self.eval(u"(- 5 2)"),
                          Integer.fromint(3))
 
+    def test_subtract_overflow(self):
+        minimum = -sys.maxint - 1
+
+        self.assertEqual(
+            self.eval(u"(- %d 1)" % minimum),
+            Integer.frombigint(RBigInt.fromint(minimum).sub(RBigInt.fromint(1))))
+
+        self.assertEqual(
+            self.eval(u"(- %d)" % minimum),
+            Integer.frombigint(RBigInt.fromint(minimum).neg()))
+
     def test_subtract_floats(self):
         self.assertEqual(self.eval(u"(- 1.0)"),
                          Float(-1.0))
@@ -861,6 +999,9 @@ class SubtractTest(BuiltInTestCase):
         self.assertEvalError(
             u"(- -)", wrong_type)
 
+        self.assertEvalError(
+            u"(- 1.0 #null)", wrong_type)
+
 
 class MultiplyTest(BuiltInTestCase):
     def test_multiply(self):
@@ -873,6 +1014,11 @@ class MultiplyTest(BuiltInTestCase):
         self.assertEqual(self.eval(u"(* 2 3)"),
                          Integer.fromint(6))
 
+    def test_multiply_overflow(self):
+        self.assertEqual(
+            self.eval(u"(* %d 2)" % sys.maxint),
+            Integer.frombigint(RBigInt.fromint(sys.maxint).mul(RBigInt.fromint(2))))
+
     def test_multiply_floats(self):
         self.assertEqual(self.eval(u"(* 2.0 3.0)"),
                          Float(6.0))
@@ -880,6 +1026,9 @@ class MultiplyTest(BuiltInTestCase):
         self.assertEqual(self.eval(u"(* 2 3.0)"),
                          Float(6.0))
 
+        self.assertEqual(self.eval(u"(* 2.0 3)"),
+                         Float(6.0))
+
         self.assertEqual(self.eval(u"(* 1/2 1.0)"),
                          Float(0.5))
 
@@ -941,6 +1090,22 @@ class ModTest(BuiltInTestCase):
         self.assertEqual(self.eval(u"(mod 11 10)"),
                          Integer.fromint(1))
 
+    def test_mod_negative(self):
+        self.assertEqual(self.eval(u"(mod -1 10)"),
+                         Integer.fromint(9))
+
+        self.assertEqual(self.eval(u"(mod 1 -10)"),
+                         Integer.fromint(-9))
+
+    def test_mod_big(self):
+        self.assertEqual(self.eval(u"(mod 100000000000000000000 7)"),
+                         Integer.fromint(2))
+
+    def test_mod_overflow(self):
+        self.assertEqual(
+            self.eval(u"(mod %d -1)" % (-sys.maxint - 1)),
+            Integer.fromint(0))
+
     def test_mod_by_zero(self):
         self.assertEvalError(
             u"(mod 1 0)", division_by_zero)
@@ -968,6 +1133,12 @@ class DivTest(BuiltInTestCase):
         self.assertEqual(self.eval(u"(div -5 2)"),
                          Integer.fromint(-3))
 
+    def test_div_overflow(self):
+        minimum = -sys.maxint - 1
+        self.assertEqual(
+            self.eval(u"(div %d -1)" % minimum),
+            Integer.frombigint(RBigInt.fromint(minimum).neg()))
+
     def test_div_by_zero(self):
         self.assertEvalError(
             u"(div 1 0)", division_by_zero)
@@ -987,6 +1158,28 @@ class DivTest(BuiltInTestCase):
             u"(div 1 2 3)", wrong_argument_number)
 
 
+class DoTest(BuiltInTestCase):
+    def test_do(self):
+        self.assertEqual(
+            self.eval(u"(do 1 2)"),
+            Integer.fromint(2))
+
+    def test_do_evaluation_order(self):
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote x) 1)"
+                      u"(do (set-symbol! (quote x) 2) x)"),
+            Integer.fromint(2))
+
+    def test_do_no_args(self):
+        self.assertEqual(self.eval(u"(do)"), NULL)
+
+    def test_do_tail_call(self):
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote f) (lambda (n) (if (< n 1) n (do 1 (f (- n 1))))))"
+                      u"(f 1000)"),
+            Integer.fromint(0))
+
+
 class IfTest(BuiltInTestCase):
     def test_if(self):
         self.assertEqual(
@@ -1095,6 +1288,15 @@ class SameTest(BuiltInTestCase):
             self.eval(u"(same? (quote a) (quote a))"),
             TRUE)
 
+        self.assertEqual(
+            self.eval(u"(same? (quote a) (quote b))"),
+            FALSE)
+
+    def test_keyword_same(self):
+        self.assertEqual(
+            self.eval(u"(same? :a :a)"),
+            TRUE)
+
     def test_list_same(self):
         self.assertEqual(
             self.eval(u"(set-symbol! (quote x) (quote ())) (same? x x)"),
@@ -1151,10 +1353,10 @@ class EqualTest(BuiltInTestCase):
 
         """
         env = fresh_environment()
-        env.set(u'true1', Boolean(True))
-        env.set(u'true2', Boolean(True))
-        env.set(u'false1', Boolean(False))
-        env.set(u'false2', Boolean(False))
+        env.set(Symbol.intern(u'true1'), Boolean(True))
+        env.set(Symbol.intern(u'true2'), Boolean(True))
+        env.set(Symbol.intern(u'false1'), Boolean(False))
+        env.set(Symbol.intern(u'false2'), Boolean(False))
         
         self.assertEqual(
             self.eval(u"(equal? true1 true2)", env),
@@ -1179,6 +1381,15 @@ class EqualTest(BuiltInTestCase):
             self.eval(u"(equal? 1 2)"),
             FALSE)
 
+    def test_big_integers(self):
+        self.assertEqual(
+            self.eval(u"(equal? 100000000000000000000 100000000000000000000)"),
+            TRUE)
+
+        self.assertEqual(
+            self.eval(u"(equal? (+ %d 1) 1)" % sys.maxint),
+            FALSE)
+
     def test_floats_same(self):
         self.assertEqual(
             self.eval(u"(equal? 1.0 1.0)"),
@@ -1347,6 +1558,15 @@ class LessThanTest(BuiltInTestCase):
             self.eval(u"(< 3 2)"),
             FALSE)
 
+    def test_less_than_big_integers(self):
+        self.assertEqual(
+            self.eval(u"(< 1 100000000000000000000)"),
+            TRUE)
+
+        self.assertEqual(
+            self.eval(u"(< 100000000000000000000 -100000000000000000000)"),
+            FALSE)
+
     def test_less_than_floats(self):
         self.assertEqual(
             self.eval(u"(< 1 2.0)"),
@@ -1356,6 +1576,10 @@ class LessThanTest(BuiltInTestCase):
             self.eval(u"(< 3.0 2.0)"),
             FALSE)
 
+        self.assertEqual(
+            self.eval(u"(< 2.0 3.0)"),
+            TRUE)
+
     def test_less_than_fractions(self):
         self.assertEqual(
             self.eval(u"(< 1 3/2)"),
@@ -1429,6 +1653,15 @@ class GetIndexTest(BuiltInTestCase):
             self.eval(u'(get-index "abc" 0)'),
             Character(u'a'))
 
+    def test_get_index_string_shared(self):
+        self.assertIs(
+            self.eval(u'(get-index "abc" 0)'),
+            self.eval(u'(get-index "abc" 0)'))
+
+        self.assertEqual(
+            self.eval(u'(get-index "☃" 0)'),
+            Character(u'☃'))
+
     def test_get_index_negative_index(self):
         self.assertEqual(
             self.eval(u"(get-index (quote (2 3)) -1)"),
@@ -1438,6 +1671,13 @@ class GetIndexTest(BuiltInTestCase):
         self.assertEvalError(
             u"(get-index (quote (2 3)) -3)", value_error)
 
+    def test_get_index_big_index(self):
+        self.assertEvalError(
+            u"(get-index (quote (2 3)) 100000000000000000000)", value_error)
+
+        self.assertEvalError(
+            u"(get-index (quote (2 3)) -100000000000000000000)", value_error)
+
     def test_get_index_typeerror(self):
         self.assertEvalError(
             u"(get-index #null 0)", wrong_type)
@@ -1479,12 +1719,50 @@ class SetIndexTest(BuiltInTestCase):
             expected)
 
     def test_set_index_bytestring(self):
-        expected = Bytestring([ord(c) for c in "bbc"])
+        expected = Bytestring(list("bbc"))
         
         self.assertEqual(
             self.eval(u'(set-symbol! (quote x) #bytes("abc")) (set-index! x 0 98) x'),
             expected)
 
+    def test_set_index_string_literal(self):
+        """Mutating the value of a string literal shouldn't change the
+        literal, or other values from it.
+
+        """
+        env = fresh_environment()
+        self.eval(
+            u'(set-symbol! (quote f) (lambda () "abc"))'
+            u'(set-symbol! (quote x) (f))'
+            u'(set-symbol! (quote y) (f))'
+            u'(set-index! x 0 \'z\')', env)
+
+        self.assertEqual(self.eval(u'x', env), String(list(u"zbc")))
+        self.assertEqual(self.eval(u'y', env), String(list(u"abc")))
+        self.assertEqual(self.eval(u'(f)', env), String(list(u"abc")))
+
+    def test_set_index_string_as_unicode(self):
+        """We cache the unicode value of a string, so check we don't
+        use a stale value after mutation.
+
+        """
+        env = fresh_environment()
+        self.eval(u'(set-symbol! (quote x) "(+ 1 2)") (parse x)', env)
+
+        self.assertEqual(
+            self.eval(u"(set-index! x 1 '*') (eval (get-index (parse x) 0))", env),
+            Integer.fromint(2))
+
+    def test_set_index_bytestring_literal(self):
+        env = fresh_environment()
+        self.eval(
+            u'(set-symbol! (quote f) (lambda () #bytes("abc")))'
+            u'(set-symbol! (quote x) (f))'
+            u'(set-index! x 0 98)', env)
+
+        self.assertEqual(self.eval(u'x', env), Bytestring(list("bbc")))
+        self.assertEqual(self.eval(u'(f)', env), Bytestring(list("abc")))
+
     def test_set_index_bytestring_type_error(self):
         self.assertEvalError(
             u'(set-index! #bytes("a") 0 #null)', wrong_type)
@@ -1564,7 +1842,17 @@ class InsertTest(BuiltInTestCase):
     def test_insert_bytestring(self):
         self.assertEqual(
             self.eval(u'(set-symbol! (quote x) #bytes("a")) (insert! x 1 98) x'),
-            Bytestring([ord(c) for c in "ab"]))
+            Bytestring(list("ab")))
+
+    def test_insert_string_literal(self):
+        env = fresh_environment()
+        self.eval(
+            u'(set-symbol! (quote f) (lambda () "a"))'
+            u'(set-symbol! (quote x) (f))'
+            u'(insert! x 1 \'b\')', env)
+
+        self.assertEqual(self.eval(u'x', env), String(list(u"ab")))
+        self.assertEqual(self.eval(u'(f)', env), String(list(u"a")))
 
     def test_insert_bytestring_invalid_type(self):
         self.assertEvalError(
@@ -1620,6 +1908,11 @@ class GetKeyTest(BuiltInTestCase):
             self.eval(u"(get-key {1 2} 1)"),
             Integer.fromint(2))
 
+    def test_get_key_big_integer(self):
+        self.assertEqual(
+            self.eval(u"(get-key {100000000000000000000 2} 100000000000000000000)"),
+            Integer.fromint(2))
+
     def test_get_key_missing(self):
         self.assertEvalError(
             u"(get-key {1 2} 0)", missing_key)
@@ -1685,9 +1978,8 @@ class GetItemsTest(BuiltInTestCase):
 
 class EnvironmentVariablesTest(BuiltInTestCase):
     def test_evaluate_variable(self):
-        env = Environment([Scope({
-            u'x': Integer.fromint(1),
-        })])
+        env = Environment([Scope({})])
+        env.set(Symbol.intern(u'x'), Integer.fromint(1))
         self.assertEqual(evaluate(parse_one(lex(u"x")), env),
                          Integer.fromint(1))
 
@@ -1756,7 +2048,7 @@ class CallTest(BuiltInTestCase):
         """
         self.assertEqual(
             self.eval(u"(call (lambda (x) x) (quote (y)))"),
-            Symbol(u'y')
+            Symbol.intern(u'y')
         )
 
     def test_call_arg_number(self):
@@ -1787,6 +2079,144 @@ class EvalTest(BuiltInTestCase):
             Integer.fromint(1)
         )
 
+    def test_eval_after_set_index(self):
+        """We cache information about code we've evaluated, so ensure
+        that we notice when the code is modified.
+
+        """
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote code) (quote (do 1 2)))"
+                      u"(eval code)"
+                      u"(set-index! code 0 (quote +))"
+                      u"(eval code)"),
+            Integer.fromint(3)
+        )
+
+    def test_eval_after_insert(self):
+        self.assertEqual(
+            self.eval(u"(set-symbol! (quote code) (quote (if #true 1)))"
+                      u"(try (eval code) :catch error e #null)"
+                      u"(insert! code 3 2)"
+                      u"(eval code)"),
+            Integer.fromint(1)
+        )
+
+    def test_eval_malformed_repeatedly(self):
+        self.assertEvalError(
+            u"(set-symbol! (quote f) (lambda () (if)))"
+            u"(try (f) :catch error e #null)"
+            u"(f)",
+            wrong_argument_number
+        )
+
+
+class ExpandAllMacrosTest(BuiltInTestCase):
+    def assertExpandsTo(self, program, expected):
+        self.assertEqual(
+            self.eval(u"(macro inc (x) (quote (+ (unquote x) 1)))" + program),
+            parse_one(lex(expected)))
+
+    def test_expand_all_macros(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (inc 2))", u"(+ 2 1)")
+
+    def test_expand_nested(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (if #true (inc (inc 1)) 2))",
+            u"(if #true (+ (+ 1 1) 1) 2)")
+
+    def test_expand_inside_quote(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (quote (inc 1)))",
+            u"(quote (inc 1))")
+
+    def test_expand_unquote(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (quote (a (unquote (inc 1)))))",
+            u"(quote (a (unquote (+ 1 1))))")
+
+    def test_expand_lambda(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (lambda (x) (inc x)))",
+            u"(lambda (x) (+ x 1))")
+
+    def test_expand_generator(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (generator (yield (inc 1))))",
+            u"(generator (yield (+ 1 1)))")
+
+    def test_expand_shadowed(self):
+        """If a local variable has the same name as a macro, calls
+        refer to the local variable.
+
+        """
+        self.assertExpandsTo(
+            u"(expand-all-macros (lambda (inc) (inc 1)))",
+            u"(lambda (inc) (inc 1))")
+
+        self.assertExpandsTo(
+            u"(expand-all-macros (let (inc 1 y (inc 2)) (inc 3)))",
+            u"(let (inc 1 y (inc 2)) (inc 3))")
+
+    def test_expand_let(self):
+        self.assertExpandsTo(
+            u"(expand-all-macros (let (x (inc 1)) (inc x)))",
+            u"(let (x (+ 1 1)) (+ x 1))")
+
+    def test_expand_let_own_value(self):
+        """A let binding isn't in scope in its own value."""
+        self.assertExpandsTo(
+            u"(expand-all-macros (let (inc (inc 1)) inc))",
+            u"(let (inc (+ 1 1)) inc)")
+
+    def test_expand_again(self):
+        """Expanding the same expression again should give the same
+        Lists, so we keep their cached compiled forms.
+
+        """
+        env = fresh_environment()
+        self.eval(u"(macro inc (x) (quote (+ (unquote x) 1)))", env)
+        expression = parse_one(lex(u"(lambda (x) (if x (inc x) 0))"))
+
+        expanded = expand_all_macros(expression, env)
+        self.assertIs(expand_all_macros(expression, env), expanded)
+
+    def test_expand_again_after_mutation(self):
+        env = fresh_environment()
+        self.eval(u"(macro inc (x) (quote (+ (unquote x) 1)))", env)
+        expression = parse_one(lex(u"(lambda (x) (if x (inc x) 0))"))
+        expand_all_macros(expression, env)
+
+        expression.values[2].set_index(3, Integer.fromint(1))
+        self.assertEqual(
+            expand_all_macros(expression, env),
+            parse_one(lex(u"(lambda (x) (if x (+ x 1) 1))")))
+
+    def test_expand_recursive_macro(self):
+        self.assertEqual(
+            self.eval(u"(macro forever () (quote (forever)))"
+                      u"(expand-all-macros (forever))"),
+            parse_one(lex(u"(forever)")))
+
+    def test_expand_error(self):
+        """If a macro call can't be expanded, we leave it until it's
+        evaluated.
+
+        """
+        self.assertExpandsTo(
+            u"(expand-all-macros (if #false (inc) 1))",
+            u"(if #false (inc) 1)")
+
+    def test_expand_all_macros_arity(self):
+        self.assertEvalError(
+            u"(expand-all-macros)", wrong_argument_number)
+
+    def test_eval_expands_macros(self):
+        self.assertEqual(
+            self.eval(u"(macro inc (x) (quote (+ (unquote x) 1)))"
+                      u"(eval (quote (inc 1)))"),
+            Integer.fromint(2))
+
 
 class EvaluatingMacrosTest(BuiltInTestCase):
     def test_macro(self):
@@ -1816,6 +2246,97 @@ class EvaluatingMacrosTest(BuiltInTestCase):
             Integer.fromint(2)
         )
 
+    def test_macro_expanded_once(self):
+        """We should only expand a macro call once, and reuse the expansion
+        when the call is evaluated again.
+
+        """
+        self.assertEqual(
+            self.eval(
+                u"(set-symbol! (quote expansions) 0)"
+                u"(macro just-one () (set-symbol! (quote expansions) (+ expansions 1)) 1)"
+                u"(set-symbol! (quote f) (lambda () (just-one)))"
+                u"(f) (f) (f)"
+                u"expansions"),
+            Integer.fromint(1)
+        )
+
+    def test_macro_redefined(self):
+        self.assertEqual(
+            self.eval(
+                u"(macro foo () 1)"
+                u"(set-symbol! (quote f) (lambda () (foo)))"
+                u"(f)"
+                u"(macro foo () 2)"
+                u"(f)"),
+            Integer.fromint(2)
+        )
+
+    def test_macro_argument_mutated(self):
+        """We cache macro expansions, so ensure that we notice when a
+        list inside the arguments is modified.
+
+        """
+        self.assertEqual(
+            self.eval(
+                u"(set-symbol! (quote argument) (quote (1 2)))"
+                u"(set-symbol! (quote code) (quote (lambda () (first-of #null))))"
+                u"(set-index! (get-index code 2) 1 argument)"
+                # first-of isn't defined yet, so we expand it when f is called.
+                u"(set-symbol! (quote f) (eval code))"
+                u"(macro first-of (form) (get-index form 0))"
+                u"(f)"
+                u"(set-index! argument 0 5)"
+                u"(f)"),
+            Integer.fromint(5)
+        )
+
+    def test_macro_argument_not_read(self):
+        """If the expansion only includes an argument list, we don't need
+        to expand again when it's mutated.
+
+        """
+        env = fresh_environment()
+        self.eval(
+            u"(set-symbol! (quote argument) (quote (1 2)))"
+            u"(set-symbol! (quote code) (quote (lambda () (quoted #null))))"
+            u"(set-index! (get-index code 2) 1 argument)"
+            u"(set-symbol! (quote f) (eval code))"
+            u"(macro quoted (form) (quote (quote (unquote form))))"
+            u"(f)",
+            env)
+
+        argument = env.get(Symbol.intern(u'argument'))
+        self.assertIsNone(argument.dependent_calls)
+
+    def test_macro_dependent_calls_limited(self):
+        env = fresh_environment()
+        self.eval(u"(macro first-of (form) (get-index form 0))", env)
+        macro = env.get(Symbol.intern(u'first-of'))
+
+        argument = List([Integer.fromint(1)])
+        for _ in range(MAX_DEPENDENT_CALLS + 10):
+            call = List([Symbol.intern(u'first-of'), argument])
+            expand_macro_call(macro, call, env)
+
+        self.assertEqual(len(argument.dependent_calls), MAX_DEPENDENT_CALLS)
+
+    def test_macro_expansion_counts(self):
+        def count(counts, index):
+            return counts.values[index].int_value
+
+        before = self.eval(u"(macro-expansion-counts)")
+        after = self.eval(
+            u"(macro foo () 1)"
+            u"(set-symbol! (quote f) (lambda () (foo)))"
+            u"(f) (f) (f)"
+            u"(macro-expansion-counts)")
+
+        self.assertEqual(
+            count(after, 0) - count(before, 0), 1)
+        self.assertEqual(
+            count(after, 1) - count(before, 1), 2)
+
     def test_macro_bad_args_number(self):
         self.assertEvalError(
             u"(macro foo)", wrong_argument_number)
@@ -1845,7 +2366,7 @@ class ExpandMacroTest(BuiltInTestCase):
             self.eval(
                 u"(macro just-x (ignored-arg) (quote x))"
                 u"(expand-macro (just-x y))"),
-            Symbol(u'x'))
+            Symbol.intern(u'x'))
 
 
 class DefinedTest(BuiltInTestCase):
@@ -1945,7 +2466,7 @@ class ReadTest(BuiltInTestCase):
 
         self.assertEqual(
             result,
-            Bytestring([ord(c) for c in "foo"]))
+            Bytestring(list("foo")))
 
     def test_read_arity(self):
         self.assertEvalError(
@@ -1959,6 +2480,171 @@ class ReadTest(BuiltInTestCase):
             u"(read #null)", wrong_type)
 
 
+class ReaderTest(BuiltInTestCase):
+    def read_all(self, source, chunk_size):
+        reader = Reader(StringIO(source.encode('utf-8')), chunk_size)
+
+        expressions = []
+        while True:
+            expression = reader.read_expression()
+            if expression is None:
+                return List(expressions)
+            if isinstance(expression, TrifleExceptionInstance):
+                return expression
+            expressions.append(expression)
+
+    def test_tokens_across_chunks(self):
+        source = (u'(foo-bar 123 1.5 1/3 "a \\"string\\"" \'\\n\' '
+                  u'#bytes("a\\x00") #true :key) ; comment\n{1 2}')
+
+        for chunk_size in range(1, 10):
+            self.assertEqual(
+                self.read_all(source, chunk_size), parse(lex(source)))
+
+    def test_utf8_across_chunks(self):
+        # 'é' is two bytes in UTF-8, and '€' is three.
+        for chunk_size in range(1, 5):
+            self.assertEqual(
+                self.read_all(u'"flamb\xe9 \u20ac"', chunk_size),
+                List([String(list(u"flamb\xe9 \u20ac"))]))
+
+    def test_invalid_utf8(self):
+        reader = Reader(StringIO('"\xff"'))
+        self.assertTrifleError(reader.read_expression(), lex_failed)
+
+    def test_reads_lazily(self):
+        """We should return the first expression before we read the rest
+        of the file.
+
+        """
+        source = StringIO("(foo) " + "1 " * 1000)
+        reader = Reader(source, 10)
+
+        self.assertEqual(
+            reader.read_expression(), List([Symbol.intern(u'foo')]))
+        self.assertTrue(source.tell() < 100)
+
+    def test_expressions_before_error(self):
+        reader = Reader(StringIO('1 2 "foo'), 100)
+
+        self.assertEqual(reader.read_expression(), Integer.fromint(1))
+        self.assertEqual(reader.read_expression(), Integer.fromint(2))
+        self.assertTrifleError(reader.read_expression(), lex_failed)
+
+
+class ReadFormsTest(BuiltInTestCase):
+    def test_read_forms(self):
+        with open('test.tfl', 'w') as f:
+            f.write('(foo 1) "bar" ; comment\n{1 (2)}')
+
+        result = self.eval(u'(read-forms (open "test.tfl" :read))')
+        os.remove('test.tfl')
+
+        self.assertEqual(
+            result,
+            parse(lex(u'(foo 1) "bar" {1 (2)}')))
+
+    def test_read_forms_empty(self):
+        open('test.tfl', 'w').close()
+
+        result = self.eval(u'(read-forms (open "test.tfl" :read))')
+        os.remove('test.tfl')
+
+        self.assertEqual(result, List())
+
+    def test_read_forms_lex_error(self):
+        with open('test.tfl', 'w') as f:
+            f.write('(foo) "bar')
+
+        result = self.eval(u'(read-forms (open "test.tfl" :read))')
+        os.remove('test.tfl')
+
+        self.assertTrifleError(result, lex_failed)
+
+    def test_read_forms_parse_error(self):
+        with open('test.tfl', 'w') as f:
+            f.write('(foo) (bar')
+
+        result = self.eval(u'(read-forms (open "test.tfl" :read))')
+        os.remove('test.tfl')
+
+        self.assertTrifleError(result, parse_failed)
+
+    def test_read_forms_closed(self):
+        open('test.tfl', 'w').close()
+
+        result = self.eval(
+            u'(set-symbol! (quote f) (open "test.tfl" :read))'
+            u'(close! f)'
+            u'(read-forms f)')
+        os.remove('test.tfl')
+
+        self.assertTrifleError(result, changing_closed_handle)
+
+    def test_read_forms_write_handle(self):
+        self.assertEvalError(
+            u'(read-forms (open "/tmp/foo" :write))', value_error)
+
+
+class ReadLinesTest(BuiltInTestCase):
+    def test_read_lines(self):
+        with open('test.txt', 'w') as f:
+            f.write('foo\n\nbar')
+
+        result = self.eval(u'(realize (read-lines (open "test.txt" :read)))')
+        os.remove('test.txt')
+
+        self.assertEqual(
+            result,
+            List([Bytestring(list("foo")), Bytestring([]), Bytestring(list("bar"))]))
+
+    def test_read_lines_is_lazy(self):
+        """We only read as many lines as we're asked for."""
+        with open('test.txt', 'w') as f:
+            f.write('foo\nbar\nbaz\n')
+
+        result = self.eval(
+            u'(set-symbol! (quote f) (open "test.txt" :read))'
+            u'(realize (take 1 (read-lines f)))'
+            u'(read f)')
+        os.remove('test.txt')
+
+        self.assertEqual(result, Bytestring(list("bar\nbaz\n")))
+
+    def test_read_lines_closed(self):
+        with open('test.txt', 'w') as f:
+            f.write('foo\n')
+
+        result = self.eval(
+            u'(set-symbol! (quote f) (open "test.txt" :read))'
+            u'(set-symbol! (quote lines) (read-lines f))'
+            u'(close! f)'
+            u'(realize lines)')
+        os.remove('test.txt')
+
+        self.assertTrifleError(result, changing_closed_handle)
+
+    def test_read_lines_write_handle(self):
+        self.assertEvalError(
+            u'(read-lines (open "/tmp/foo" :write))', value_error)
+
+    def test_read_lines_arity(self):
+        self.assertEvalError(
+            u"(read-lines)", wrong_argument_number)
+
+    def test_read_lines_type_error(self):
+        self.assertEvalError(
+            u"(read-lines #null)", wrong_type)
+
+    def test_read_forms_arity(self):
+        self.assertEvalError(
+            u"(read-forms)", wrong_argument_number)
+
+    def test_read_forms_type_error(self):
+        self.assertEvalError(
+            u"(read-forms #null)", wrong_type)
+
+
 class WriteTest(BuiltInTestCase):
     def test_write(self):
         self.assertEqual(
@@ -2055,7 +2741,7 @@ class EncodeTest(BuiltInTestCase):
     def test_encode(self):
         self.assertEqual(
             self.eval(u'(encode "soufflé")'),
-            Bytestring([ord(c) for c in b"souffl\xc3\xa9"]))
+            Bytestring(list(b"souffl\xc3\xa9")))
     
     def test_encode_type_error(self):
         self.assertEvalError(
@@ -2141,6 +2827,104 @@ class ListPredicateTest(BuiltInTestCase):
             u'(list? #null #null)', wrong_argument_number)
 
 
+class RangePredicateTest(BuiltInTestCase):
+    def test_is_range(self):
+        self.assertEqual(
+            self.eval(u'(range? (range 3))'),
+            TRUE)
+
+    def test_is_not_range(self):
+        self.assertEqual(
+            self.eval(u'(range? (quote (0 1 2)))'),
+            FALSE)
+
+        self.assertEqual(
+            self.eval(u'(range? #null)'),
+            FALSE)
+
+    def test_is_range_arity(self):
+        self.assertEvalError(
+            u'(range?)', wrong_argument_number)
+
+        self.assertEvalError(
+            u'(range? #null #null)', wrong_argument_number)
+
+
+class LazyPredicateTest(BuiltInTestCase):
+    def test_is_lazy(self):
+        self.assertEqual(
+            self.eval(u'(lazy? (take 1 (quote (1 2))))'),
+            TRUE)
+
+    def test_is_not_lazy(self):
+        self.assertEqual(
+            self.eval(u'(lazy? (quote (1 2)))'),
+            FALSE)
+
+        self.assertEqual(
+            self.eval(u'(lazy? #null)'),
+            FALSE)
+
+    def test_is_lazy_arity(self):
+        self.assertEvalError(
+            u'(lazy?)', wrong_argument_number)
+
+        self.assertEvalError(
+            u'(lazy? #null #null)', wrong_argument_number)
+
+
+class TaskPredicateTest(BuiltInTestCase):
+    def test_is_task(self):
+        self.assertEqual(
+            self.eval(u'(task? (spawn (lambda () 1)))'),
+            TRUE)
+
+    def test_is_not_task(self):
+        self.assertEqual(
+            self.eval(u'(task? #null)'),
+            FALSE)
+
+
+class PollTest(BuiltInTestCase):
+    def test_poll(self):
+        """A task waiting for a file handle lets other tasks run."""
+        read_fd, write_fd = os.pipe()
+
+        env = fresh_environment()
+        env.set(Symbol.intern(u'reader'),
+                FileHandle("reader", os.fdopen(read_fd, 'r'), Keyword.intern(u'read')))
+        env.set(Symbol.intern(u'writer'),
+                FileHandle("writer", os.fdopen(write_fd, 'w'), Keyword.intern(u'write')))
+
+        # If poll didn't wait, reading would block forever.
+        result = self.eval(
+            u'(set-symbol! (quote t) (spawn (lambda () (poll reader) (read reader))))'
+            u'(write! writer #bytes("abc"))'
+            u'(close! writer)'
+            u'(join-task t)',
+            env)
+
+        self.assertEqual(result, Bytestring(list("abc")))
+
+    def test_poll_ready(self):
+        with open('test.txt', 'w') as f:
+            f.write('foo')
+
+        self.assertEqual(self.eval(u'(poll (open "test.txt" :read))'), NULL)
+        os.remove('test.txt')
+
+    def test_poll_closed(self):
+        self.assertEvalError(
+            u'(set-symbol! (quote f) (open "test.txt" :write))'
+            u'(close! f)'
+            u'(poll f)',
+            changing_closed_handle)
+        os.remove('test.txt')
+
+    def test_poll_wrong_type(self):
+        self.assertEvalError(u'(poll 1)', wrong_type)
+
+
 class HashmapPredicateTest(BuiltInTestCase):
     def test_is_hashmap(self):
         self.assertEqual(
@@ -2359,7 +3143,7 @@ class TryTest(BuiltInTestCase):
     def test_catch_stack_overflow(self):
         # Regression test.
         self.assertEqual(
-            self.eval(u"(set-symbol! (quote f) (lambda () (f)))"
+            self.eval(u"(set-symbol! (quote f) (lambda () (+ 1 (f))))"
                       u"(try (f) :catch error e #null)"),
             NULL)
 
@@ -1,16 +1,19 @@
+import os
 from copy import deepcopy
 
 from interpreter.trifle_types import (
     List, Bytestring, String, Character,
-    TrifleExceptionInstance,
+    TrifleExceptionInstance, Symbol,
     Integer, TRUE, FALSE, NULL)
 from interpreter.trifle_parser import parse_one, parse
 from interpreter.lexer import lex
 from interpreter.errors import (
-    error, value_error, wrong_type, wrong_argument_number)
-from interpreter.evaluator import evaluate, is_thrown_exception
+    error, value_error, wrong_type, wrong_argument_number, stack_overflow,
+    division_by_zero, deadlock)
+from interpreter.evaluator import (
+    evaluate, evaluate_program, is_thrown_exception)
 from interpreter.environment import Environment, Scope
-from main import env_with_prelude
+from main import env_with_prelude, get_contents
 
 from test_utils import (
     evaluate_with_prelude, mock_stdout_fd
@@ -29,15 +32,23 @@ the prelude very often.
 class PreludeTestCase(BuiltInTestCase):
     env = env_with_prelude()
 
-    def eval(self, program):
+    def eval(self, program, global_env=None):
         """Evaluate this program in a fresh environment with the prelude
         already included. Returns the result of the last expression.
 
+        If global_env is given, we copy its globals instead of the
+        prelude's.
+
         """
+        if global_env is None:
+            global_env = self.env
+
         # Fresh copy of the environment so tests don't interfere with one another.
         env = Environment([Scope({})])
-        global_scope = self.env.scopes[0]
-        for key, value in global_scope.bindings.iteritems():
+        global_scope = global_env.scopes[0]
+        for symbol_id, value in global_scope.bindings.iteritems():
+            key = Symbol.from_id(symbol_id)
+
             # We do a deep copy of mutable values.
             if isinstance(value, List):
                 env.set(key, deepcopy(value))
@@ -96,6 +107,16 @@ class FunctionTest(PreludeTestCase):
     def test_function_returns_null(self):
         self.assertEvalsTo(u"(function x () 1)", NULL)
 
+    def test_function_tail_call_in_macro(self):
+        """Macros expanding to a call in tail position, such as `when`,
+        shouldn't grow the stack.
+
+        """
+        self.assertEvalsTo(
+            u"(function count-down (n) (when (> n 0) (count-down (dec n))))"
+            u"(count-down 1000)",
+            NULL)
+
     # TODO: it would be nice to assert that these errors happen
     # at macro expansion, not during evaluation due to lambda being
     # robust.
@@ -171,6 +192,30 @@ class ForEachTest(PreludeTestCase):
             Integer.fromint(1))
 
 
+class ForEachLazyTest(PreludeTestCase):
+    def test_for_each_lazy(self):
+        self.assertEvalsTo(
+            u"(set! total 0)"
+            u"(for-each x (lazy-map inc (list 1 2 3)) (set! total (+ total x)))"
+            u"total",
+            Integer.fromint(9))
+
+    def test_for_each_lazy_lambda(self):
+        self.assertEvalsTo(
+            u"(set! seen (list))"
+            u"(for-each x (lazy-filter (lambda (x) (< x 3)) (range 5))"
+            u"  (append! seen x))"
+            u"seen",
+            self.eval(u"(list 0 1 2)"))
+
+    def test_for_each_lazy_consumes(self):
+        self.assertEvalsTo(
+            u"(set! xs (lazy-map inc (range 3)))"
+            u"(for-each x xs x)"
+            u"(empty? xs)",
+            TRUE)
+
+
 class LoopTest(PreludeTestCase):
     def test_loop(self):
         self.assertEqual(
@@ -199,23 +244,59 @@ class MapTest(PreludeTestCase):
     def test_map_bytestring(self):
         self.assertEqual(
             evaluate_with_prelude(parse_one(lex(u'(map (lambda (x) (+ x 1)) #bytes("abc"))'))),
-            Bytestring([ord(c) for c in "bcd"]))
+            Bytestring(list("bcd")))
 
     def test_map_string(self):
         self.assertEqual(
             evaluate_with_prelude(parse_one(lex(u'(map (lambda (x) \'z\') "abc")'))),
             String(list(u"zzz")))
 
+    def test_map_nested(self):
+        self.assertEvalsTo(
+            u"(map (lambda (x) (map inc x)) (list (list 1) (list 2 3)))",
+            self.eval(u"(list (list 2) (list 3 4))"))
+
+    def test_map_function_with_env(self):
+        self.assertEvalsTo(
+            u"(map eval (list (quote (+ 1 2)) 4))",
+            self.eval(u"(list 3 4)"))
+
+    def test_map_error_caught(self):
+        """Errors thrown by the function should unwind through map to an
+        enclosing try.
+
+        """
+        self.assertEvalsTo(
+            u"(try (map (lambda (x) (throw value-error \"foo\")) (list 1))"
+            u" :catch value-error e 2)",
+            Integer.fromint(2))
+
+    def test_map_try_inside_function(self):
+        self.assertEvalsTo(
+            u"(map (lambda (x) (try (/ 1 x) :catch division-by-zero e 0)) (list 0 1))",
+            self.eval(u"(list 0 1)"))
+
+    def test_map_stack_overflow(self):
+        """Calls made by map are on the same stack, so infinite recursion
+        through map is a stack overflow.
+
+        """
+        self.assertEvalError(
+            u"(set! f (lambda (x) (map f (list x)))) (f 1)", stack_overflow)
+
 
 class FilterTest(PreludeTestCase):
     def test_filter(self):
         self.assertEvalsTo(u"(filter (lambda (x) (equal? x 2)) (list 1 2 3))",
                            List([Integer.fromint(2)]))
 
+    def test_filter_not_boolean(self):
+        self.assertEvalError(u"(filter (lambda (x) 1) (list 1))", wrong_type)
+
     def test_map_bytestring(self):
         self.assertEqual(
             evaluate_with_prelude(parse_one(lex(u'(filter (lambda (x) (equal? x 98)) #bytes("abc"))'))),
-            Bytestring([ord("b")]))
+            Bytestring(['b']))
 
     def test_map_string(self):
         self.assertEqual(
@@ -321,7 +402,7 @@ class AppendTest(PreludeTestCase):
     def test_append_bytestring(self):
         self.assertEvalsTo(
             u'(set-symbol! (quote x) #bytes("a")) (append! x 98) x',
-            Bytestring([ord(c) for c in "ab"]))
+            Bytestring(list("ab")))
 
     def test_append_string(self):
         self.assertEvalsTo(
@@ -354,7 +435,7 @@ class PushTest(PreludeTestCase):
     def test_push_bytestring(self):
         self.assertEvalsTo(
             u'(set-symbol! (quote x) #bytes("bc")) (push! x 97) x',
-            Bytestring([ord(c) for c in b"abc"]))
+            Bytestring(list(b"abc")))
 
     def test_push_string(self):
         self.assertEvalsTo(
@@ -436,7 +517,7 @@ class RestTest(PreludeTestCase):
     def test_rest_bytestring(self):
         self.assertEqual(
             evaluate_with_prelude(parse_one(lex(u'(rest #bytes("abc"))'))),
-            Bytestring([ord(c) for c in b"bc"]))
+            Bytestring(list(b"bc")))
         
     def test_rest_string(self):
         self.assertEqual(
@@ -492,11 +573,441 @@ class RangeTest(PreludeTestCase):
     def test_range(self):
         self.assertEvalsTo(u"(range 5)", self.eval(u"(list 0 1 2 3 4)"))
 
+    def test_range_float(self):
+        self.assertEvalsTo(u"(range 2.5)", self.eval(u"(list 0 1 2)"))
+        self.assertEvalsTo(u"(range 5/2)", self.eval(u"(list 0 1 2)"))
+
+    def test_range_wrong_type(self):
+        self.assertEvalError(u"(range #null)", wrong_type)
+
     def test_range_(self):
         self.assertTrifleError(
             self.eval(u"(range -1)"),
             value_error)
 
+    def test_range_is_lazy(self):
+        self.assertEvalsTo(u"(range? (range 5))", TRUE)
+        self.assertEvalsTo(u"(list? (range 5))", FALSE)
+
+    def test_range_huge(self):
+        """Ranges don't store their elements, so we can create ranges
+        far larger than memory.
+
+        """
+        self.assertEvalsTo(
+            u"(length (range 1000000000000))", Integer.fromint(1000000000000))
+        self.assertEvalsTo(
+            u"(get-index (range 1000000000000) -1)", Integer.fromint(999999999999))
+
+    def test_range_too_big(self):
+        self.assertEvalError(u"(range 100000000000000000000)", value_error)
+        self.assertEvalError(u"(range 100000000000000000000.5)", value_error)
+
+    def test_range_start_stop(self):
+        self.assertEvalsTo(u"(range 2 5)", self.eval(u"(list 2 3 4)"))
+        self.assertEvalsTo(u"(range 5 2)", self.eval(u"(list)"))
+        self.assertEvalsTo(u"(range -2 1)", self.eval(u"(list -2 -1 0)"))
+
+    def test_range_step(self):
+        self.assertEvalsTo(u"(range 0 10 3)", self.eval(u"(list 0 3 6 9)"))
+        self.assertEvalsTo(u"(range 5 0 -2)", self.eval(u"(list 5 3 1)"))
+        self.assertEvalsTo(u"(range 0 5 -1)", self.eval(u"(list)"))
+        self.assertEvalsTo(u"(length (range 0 10 3))", Integer.fromint(4))
+
+    def test_range_step_errors(self):
+        self.assertEvalError(u"(range 0 5 0)", value_error)
+        self.assertEvalError(u"(range 0 2.5)", wrong_type)
+        self.assertEvalError(u"(range 0 5 1/2)", wrong_type)
+        self.assertEvalError(u"(range 0 5 1 1)", wrong_argument_number)
+
+    def test_range_printable(self):
+        self.assertEvalsTo(u"(printable (range 3))", String(list(u"(range 0 3)")))
+        self.assertEvalsTo(
+            u"(printable (range 5 0 -2))", String(list(u"(range 5 0 -2)")))
+
+    def test_range_equal(self):
+        self.assertEvalsTo(u"(equal? (range 3) (list 0 1 2))", TRUE)
+        self.assertEvalsTo(u"(equal? (list 0 1 2) (range 3))", TRUE)
+        self.assertEvalsTo(u"(equal? (range 3) (list 0 1))", FALSE)
+        self.assertEvalsTo(u"(equal? (range 0 3) (range 3))", TRUE)
+        self.assertEvalsTo(u"(equal? (range 0 5 2) (range 0 6 2))", TRUE)
+        self.assertEvalsTo(u"(equal? (range 0) (range 5 0))", TRUE)
+        self.assertEvalsTo(u"(equal? (range 0 5 2) (range 0 5))", FALSE)
+
+    def test_range_for_each(self):
+        self.assertEvalsTo(
+            u"(set! total 0) (for-each i (range 5) (set! total (+ total i))) total",
+            Integer.fromint(10))
+
+    def test_range_sequence_functions(self):
+        self.assertEvalsTo(
+            u"(map (lambda (x) (* x 2)) (range 3))", self.eval(u"(list 0 2 4)"))
+        self.assertEvalsTo(
+            u"(list? (map inc (range 3)))", TRUE)
+        self.assertEvalsTo(
+            u"(filter (lambda (x) (zero? (mod x 2))) (range 5))",
+            self.eval(u"(list 0 2 4)"))
+        self.assertEvalsTo(u"(rest (range 1 4))", self.eval(u"(range 2 4)"))
+        self.assertEvalsTo(u"(range? (rest (range 1 4)))", TRUE)
+        self.assertEvalsTo(u"(rest (range 3 0 -1))", self.eval(u"(list 2 1)"))
+        self.assertEvalsTo(u"(last (range 10))", Integer.fromint(9))
+        self.assertEvalsTo(u"(empty? (range 0))", TRUE)
+        self.assertEvalsTo(u"(sort (range 3 0 -1))", self.eval(u"(list 1 2 3)"))
+        self.assertEvalsTo(
+            u"(join (range 2) (range 2))", self.eval(u"(list 0 1 0 1)"))
+
+    def test_range_copy(self):
+        self.assertEvalsTo(u"(list? (copy (range 3)))", TRUE)
+        self.assertEvalsTo(u"(copy (range 3))", self.eval(u"(list 0 1 2)"))
+
+    def test_range_immutable(self):
+        self.assertEvalError(u"(append! (range 3) 3)", wrong_type)
+        self.assertEvalError(u"(set-index! (range 3) 0 1)", wrong_type)
+        self.assertEvalError(u"(insert! (range 3) 0 1)", wrong_type)
+        self.assertEvalError(u"(join! (range 3))", wrong_type)
+        self.assertEvalError(u"(sort! (range 3))", wrong_type)
+
+
+class LazyMapTest(PreludeTestCase):
+    def test_lazy_map(self):
+        self.assertEvalsTo(
+            u"(realize (lazy-map (lambda (x) (* x 2)) (list 1 2 3)))",
+            self.eval(u"(list 2 4 6)"))
+
+    def test_lazy_map_built_in(self):
+        self.assertEvalsTo(
+            u'(realize (lazy-map length (list "a" "bc")))',
+            self.eval(u"(list 1 2)"))
+
+    def test_lazy_map_is_lazy(self):
+        """We only call the function when an element is asked for."""
+        self.assertEvalsTo(
+            u"(set! calls 0)"
+            u"(set! xs (lazy-map (lambda (x) (inc! calls) x) (range 10)))"
+            u"(next! xs) (next! xs)"
+            u"calls",
+            Integer.fromint(2))
+
+    def test_lazy_map_nested(self):
+        self.assertEvalsTo(
+            u"(realize (lazy-map inc (lazy-map (lambda (x) (* x 10)) (range 3))))",
+            self.eval(u"(list 1 11 21)"))
+
+    def test_lazy_map_error(self):
+        self.assertEvalError(
+            u"(realize (lazy-map (lambda (x) (/ 1 x)) (list 1 0)))",
+            division_by_zero)
+
+    def test_lazy_map_catch_error(self):
+        self.assertEvalsTo(
+            u"(try (realize (lazy-map (lambda (x) (/ 1 x)) (list 1 0)))"
+            u"  :catch division-by-zero e 5)",
+            Integer.fromint(5))
+
+    def test_lazy_map_wrong_type(self):
+        self.assertEvalError(u"(lazy-map inc #null)", wrong_type)
+
+    def test_lazy_map_arity(self):
+        self.assertEvalError(u"(lazy-map inc)", wrong_argument_number)
+
+
+class LazyFilterTest(PreludeTestCase):
+    def test_lazy_filter(self):
+        self.assertEvalsTo(
+            u"(realize (lazy-filter (lambda (x) (< x 2)) (list 3 1 4 1 5)))",
+            self.eval(u"(list 1 1)"))
+
+    def test_lazy_filter_built_in(self):
+        self.assertEvalsTo(
+            u"(realize (lazy-filter list? (list 1 (list) 2)))",
+            self.eval(u"(list (list))"))
+
+    def test_lazy_filter_pipeline(self):
+        self.assertEvalsTo(
+            u"(realize (lazy-map inc (lazy-filter (lambda (x) (zero? (mod x 3))) (range 10))))",
+            self.eval(u"(list 1 4 7 10)"))
+
+    def test_lazy_filter_not_boolean(self):
+        self.assertEvalError(
+            u"(realize (lazy-filter (lambda (x) 1) (list 1)))", wrong_type)
+        self.assertEvalError(
+            u"(realize (lazy-filter length (list (list))))", wrong_type)
+
+    def test_lazy_filter_wrong_type(self):
+        self.assertEvalError(u"(lazy-filter inc 1)", wrong_type)
+
+
+class TakeTest(PreludeTestCase):
+    def test_take(self):
+        self.assertEvalsTo(
+            u"(realize (take 2 (list 1 2 3)))", self.eval(u"(list 1 2)"))
+        self.assertEvalsTo(
+            u"(realize (take 5 (list 1 2 3)))", self.eval(u"(list 1 2 3)"))
+        self.assertEvalsTo(u"(realize (take 0 (list 1 2 3)))", List())
+
+    def test_take_huge_range(self):
+        self.assertEvalsTo(
+            u"(realize (take 3 (lazy-filter (lambda (x) (zero? (mod x 1000))) "
+            u"(range 1000000000000))))",
+            self.eval(u"(list 0 1000 2000)"))
+
+    def test_take_errors(self):
+        self.assertEvalError(u"(take -1 (list))", value_error)
+        self.assertEvalError(u"(take 1.0 (list))", wrong_type)
+        self.assertEvalError(u"(take 1 #null)", wrong_type)
+        self.assertEvalError(u"(take 1)", wrong_argument_number)
+
+
+class DropTest(PreludeTestCase):
+    def test_drop(self):
+        self.assertEvalsTo(
+            u"(realize (drop 1 (list 1 2 3)))", self.eval(u"(list 2 3)"))
+        self.assertEvalsTo(u"(realize (drop 5 (list 1 2 3)))", List())
+
+    def test_drop_lazy(self):
+        self.assertEvalsTo(
+            u"(realize (take 2 (drop 2 (lazy-map (lambda (x) (* x x)) (range 10)))))",
+            self.eval(u"(list 4 9)"))
+
+    def test_drop_errors(self):
+        self.assertEvalError(u"(drop -1 (list))", value_error)
+        self.assertEvalError(u"(drop 1 #null)", wrong_type)
+
+
+class RealizeTest(PreludeTestCase):
+    def test_realize_sequence(self):
+        self.assertEvalsTo(u"(realize (range 3))", self.eval(u"(list 0 1 2)"))
+        self.assertEvalsTo(u'(realize "ab")', self.eval(u"(list 'a' 'b')"))
+
+    def test_realize_consumes(self):
+        self.assertEvalsTo(
+            u"(set! xs (lazy-map inc (range 3)))"
+            u"(realize (take 1 xs))"
+            u"(realize xs)",
+            self.eval(u"(list 2 3)"))
+
+    def test_realize_wrong_type(self):
+        self.assertEvalError(u"(realize #null)", wrong_type)
+
+
+class NextTest(PreludeTestCase):
+    def test_next(self):
+        self.assertEvalsTo(
+            u"(set! xs (lazy-map inc (range 3)))"
+            u"(next! xs)"
+            u"(next! xs)",
+            Integer.fromint(2))
+
+    def test_next_exhausted(self):
+        self.assertEvalError(u"(next! (take 0 (list 1)))", value_error)
+
+    def test_next_wrong_type(self):
+        self.assertEvalError(u"(next! (list 1))", wrong_type)
+
+    def test_empty_lazy(self):
+        """empty? computes the next element, but doesn't consume it."""
+        self.assertEvalsTo(
+            u"(set! calls 0)"
+            u"(set! xs (lazy-map (lambda (x) (inc! calls) x) (range 1 3)))"
+            u"(empty? xs) (empty? xs)"
+            u"(list calls (next! xs) (next! xs) (empty? xs) calls)",
+            self.eval(u"(list 1 1 2 #true 2)"))
+
+
+class GeneratorTest(PreludeTestCase):
+    def test_generator(self):
+        self.assertEvalsTo(
+            u"(realize (generator (yield 1) (yield 2)))",
+            self.eval(u"(list 1 2)"))
+
+    def test_generator_empty(self):
+        self.assertEvalsTo(u"(realize (generator))", List())
+        self.assertEvalsTo(u"(realize (generator 1))", List())
+
+    def test_generator_is_lazy(self):
+        """We only evaluate the body until the next yield."""
+        self.assertEvalsTo(
+            u"(set! x 0)"
+            u"(set! g (generator (set! x 1) (yield #null) (set! x 2) (yield #null)))"
+            u"(set! before x)"
+            u"(next! g)"
+            u"(list before x)",
+            self.eval(u"(list 0 1)"))
+
+    def test_generator_infinite(self):
+        self.assertEvalsTo(
+            u"(function naturals () (generator (let (i 0) (loop (yield i) (inc! i)))))"
+            u"(realize (take 3 (lazy-filter (lambda (x) (zero? (mod x 2))) (naturals))))",
+            self.eval(u"(list 0 2 4)"))
+
+    def test_generator_closure(self):
+        self.assertEvalsTo(
+            u"(function repeat (value count)"
+            u"  (generator (for-each i (range count) (yield value))))"
+            u"(realize (repeat 'a' 2))",
+            self.eval(u"(list 'a' 'a')"))
+
+    def test_generator_for_each(self):
+        self.assertEvalsTo(
+            u"(set! total 0)"
+            u"(for-each x (generator (yield 1) (yield 2)) (set! total (+ total x)))"
+            u"total",
+            Integer.fromint(3))
+
+    def test_generator_of_generator(self):
+        self.assertEvalsTo(
+            u"(set! inner (generator (yield 1) (yield 2)))"
+            u"(realize (generator (for-each x inner (yield (* x 10)))))",
+            self.eval(u"(list 10 20)"))
+
+    def test_yield_returns_null(self):
+        self.assertEvalsTo(
+            u"(realize (generator (yield (yield 1))))",
+            self.eval(u"(list 1 #null)"))
+
+    def test_yield_in_function(self):
+        """yield suspends every frame up to the generator, including
+        function calls and built-ins.
+
+        """
+        self.assertEvalsTo(
+            u"(function yield-twice (x) (yield x) (yield x))"
+            u"(realize (generator (yield-twice 1) (map (lambda (x) (yield x)) (list 2 3))))",
+            self.eval(u"(list 1 1 2 3)"))
+
+    def test_yield_inside_try(self):
+        self.assertEvalsTo(
+            u"(realize (generator (try (do (yield 1) (/ 1 0)) :catch division-by-zero e (yield 2))))",
+            self.eval(u"(list 1 2)"))
+
+    def test_yield_outside_generator(self):
+        self.assertEvalError(u"(yield 1)", value_error)
+
+    def test_yield_arity(self):
+        self.assertEvalError(u"(realize (generator (yield)))", wrong_argument_number)
+
+    def test_generator_error(self):
+        self.assertEvalsTo(
+            u"(set! g (generator (yield 1) (/ 1 0)))"
+            u"(next! g)"
+            u"(try (next! g) :catch division-by-zero e 5)",
+            Integer.fromint(5))
+
+    def test_generator_after_error(self):
+        """A generator can't continue after its body throws an error."""
+        self.assertEvalError(
+            u"(set! g (generator (/ 1 0)))"
+            u"(try (next! g) :catch division-by-zero e 5)"
+            u"(next! g)",
+            value_error)
+
+    def test_generator_running(self):
+        self.assertEvalError(
+            u"(set! g (generator (yield (next! g)))) (next! g)", value_error)
+
+    def test_generator_stack_overflow(self):
+        self.assertEvalError(
+            u"(function nest (n)"
+            u"  (if (zero? n) (generator (yield 0))"
+            u"    (generator (for-each x (nest (dec n)) (yield x)))))"
+            u"(realize (nest 200))",
+            stack_overflow)
+
+
+class TaskTest(PreludeTestCase):
+    def test_spawn(self):
+        self.assertEvalsTo(
+            u"(join-task (spawn (lambda (x y) (+ x y)) 1 2))",
+            Integer.fromint(3))
+
+    def test_join_task_twice(self):
+        self.assertEvalsTo(
+            u"(set! t (spawn (lambda () 1)))"
+            u"(join-task t)"
+            u"(join-task t)",
+            Integer.fromint(1))
+
+    def test_tasks_interleave(self):
+        self.assertEvalsTo(
+            u"(set! log (list))"
+            u"(function worker (name)"
+            u"  (for-each i (range 2) (append! log (list name i)) (yield-now)))"
+            u"(function run ()"
+            u"  (let (a (spawn worker :a) b (spawn worker :b))"
+            u"    (join-task a) (join-task b)))"
+            u"(run)"
+            u"log",
+            self.eval(u"(list (list :a 0) (list :b 0) (list :a 1) (list :b 1))"))
+
+    def test_tasks_preempted(self):
+        """A task that never waits still lets other tasks run."""
+        self.assertEvalsTo(
+            u"(set! done (list))"
+            u"(set! spinner (spawn (lambda () (while (empty? done) #null) :done)))"
+            u"(join-task (spawn (lambda () (append! done #true))))"
+            u"(join-task spinner)",
+            self.eval(u":done"))
+
+    def test_sleep(self):
+        self.assertEvalsTo(
+            u"(set! log (list))"
+            u"(set! slow (spawn (lambda () (sleep 0.05) (append! log :slow))))"
+            u"(set! fast (spawn (lambda () (sleep 1/100) (append! log :fast))))"
+            u"(join-task slow)"
+            u"(join-task fast)"
+            u"log",
+            self.eval(u"(list :fast :slow)"))
+
+    def test_sleep_zero(self):
+        self.assertEvalsTo(u"(sleep 0)", NULL)
+
+    def test_sleep_negative(self):
+        self.assertEvalError(u"(sleep -1)", value_error)
+
+    def test_sleep_wrong_type(self):
+        self.assertEvalError(u"(sleep :forever)", wrong_type)
+
+    def test_join_task_error(self):
+        self.assertEvalError(
+            u"(join-task (spawn (lambda () (/ 1 0))))", division_by_zero)
+
+    def test_join_task_catch_error(self):
+        self.assertEvalsTo(
+            u"(set! t (spawn (lambda () (/ 1 0))))"
+            u"(try (join-task t) :catch division-by-zero e 1)"
+            u"(try (join-task t) :catch division-by-zero e 2)",
+            Integer.fromint(2))
+
+    def test_join_task_deadlock(self):
+        self.assertEvalsTo(
+            u"(set! cell (list))"
+            u"(do"
+            u"  (set! t (spawn (lambda () (join-task (first cell)))))"
+            u"  (append! cell t)"
+            u"  (try (join-task t) :catch deadlock e :deadlock))",
+            self.eval(u":deadlock"))
+
+    def test_join_task_deadlock_uncaught(self):
+        self.assertEvalError(
+            u"(set! cell (list))"
+            u"(do"
+            u"  (set! t (spawn (lambda () (join-task (first cell)))))"
+            u"  (append! cell t)"
+            u"  (join-task t))",
+            deadlock)
+
+    def test_spawn_wrong_type(self):
+        self.assertEvalError(u"(spawn 1)", wrong_type)
+
+    def test_spawn_arity(self):
+        self.assertEvalError(u"(spawn)", wrong_argument_number)
+
+    def test_join_task_wrong_type(self):
+        self.assertEvalError(u"(join-task 1)", wrong_type)
+
+    def test_yield_now(self):
+        self.assertEvalsTo(u"(yield-now)", NULL)
+
 
 class InequalityTest(PreludeTestCase):
     def test_greater_than(self):
@@ -534,6 +1045,89 @@ class SortTest(PreludeTestCase):
             List([Integer.fromint(1), Integer.fromint(2), Integer.fromint(3), Integer.fromint(4), Integer.fromint(5)])
         )
 
+    def test_sort_is_copy(self):
+        self.assertEvalsTo(
+            u"(set! x (list 2 1)) (sort x) x", self.eval(u"(list 2 1)"))
+
+    def test_sort_mixed_numbers(self):
+        self.assertEvalsTo(
+            u"(sort (list 2 1.5 1/2 -1))", self.eval(u"(list -1 1/2 1.5 2)"))
+
+    def test_sort_strings_and_characters(self):
+        self.assertEvalsTo(u'(sort "cab")', String(list(u"abc")))
+        self.assertEvalsTo(u'(sort #bytes("cab"))', Bytestring(list("abc")))
+        self.assertEvalsTo(
+            u'(sort (list "b" "ab" "a"))', self.eval(u'(list "a" "ab" "b")'))
+
+    def test_sort_large(self):
+        self.assertEvalsTo(
+            u"(set! x (map (lambda (i) (mod (* i 7) 1000)) (range 1000)))"
+            u"(equal? (sort x) (range 1000))",
+            TRUE)
+
+    def test_sort_key(self):
+        self.assertEvalsTo(
+            u"(sort (list (list 1 :b) (list 0 :a) (list 1 :a)) :key first)",
+            self.eval(u"(list (list 0 :a) (list 1 :b) (list 1 :a))"))
+
+    def test_sort_compare(self):
+        self.assertEvalsTo(
+            u"(sort (list 1 3 2) :compare (lambda (x y) (> x y)))",
+            self.eval(u"(list 3 2 1)"))
+
+        self.assertEvalsTo(
+            u"(sort (list 1 3 2) :compare <)", self.eval(u"(list 1 2 3)"))
+
+    def test_sort_key_and_compare(self):
+        self.assertEvalsTo(
+            u"(sort (list (list 1 :a) (list 2 :b) (list 1 :c)) :key first"
+            u" :compare (lambda (x y) (> x y)))",
+            self.eval(u"(list (list 2 :b) (list 1 :a) (list 1 :c))"))
+
+    def test_sort_incomparable(self):
+        self.assertEvalError(u'(sort (list 1 "a"))', wrong_type)
+        self.assertEvalError(u"(sort (list #null #null))", wrong_type)
+
+    def test_sort_compare_not_boolean(self):
+        self.assertEvalError(
+            u"(sort (list 1 2) :compare (lambda (x y) 1))", wrong_type)
+
+    def test_sort_error_caught(self):
+        self.assertEvalsTo(
+            u"(try (sort (list 1 2) :key (lambda (x) (/ x 0)))"
+            u" :catch division-by-zero e 3)",
+            Integer.fromint(3))
+
+    def test_sort_invalid_arguments(self):
+        self.assertEvalError(u"(sort 1)", wrong_type)
+        self.assertEvalError(u"(sort (list) :foo first)", value_error)
+        self.assertEvalError(u"(sort (list) 1 first)", wrong_type)
+        self.assertEvalError(u"(sort (list) :key)", wrong_argument_number)
+        self.assertEvalError(u"(sort)", wrong_argument_number)
+
+
+class SortMutateTest(PreludeTestCase):
+    def test_sort_list(self):
+        self.assertEvalsTo(
+            u"(set! x (list 3 1 2)) (sort! x) x", self.eval(u"(list 1 2 3)"))
+
+    def test_sort_returns_null(self):
+        self.assertEvalsTo(u"(sort! (list 2 1))", NULL)
+
+    def test_sort_string(self):
+        self.assertEvalsTo(
+            u'(set! x "cab") (sort! x) x', String(list(u"abc")))
+
+    def test_sort_literal(self):
+        """Sorting a string literal in place shouldn't change the literal."""
+        self.assertEvalsTo(
+            u'(set! f (lambda () "ba")) (sort! (f)) (f)', String(list(u"ba")))
+
+    def test_sort_compare(self):
+        self.assertEvalsTo(
+            u"(set! x (list 1 3 2)) (sort! x :compare (lambda (x y) (> x y))) x",
+            self.eval(u"(list 3 2 1)"))
+
 
 class EmptyTest(PreludeTestCase):
     def test_empty_list(self):
@@ -588,6 +1182,11 @@ class JoinMutateTest(PreludeTestCase):
             u"(set! x (list 1)) (join! x (list 2)) x",
             List([Integer.fromint(1), Integer.fromint(2)]))
 
+    def test_join_itself(self):
+        self.assertEvalsTo(
+            u"(set! x (list 1 2)) (join! x x) x",
+            self.eval(u"(list 1 2 1 2)"))
+
 
 class JoinTest(PreludeTestCase):
     def test_join(self):
@@ -629,6 +1228,7 @@ class SequencePredicateTest(PreludeTestCase):
         self.assertEvalsTo(u"(sequence? (list))", TRUE)
         self.assertEvalsTo(u'(sequence? "")', TRUE)
         self.assertEvalsTo(u'(sequence? #bytes(""))', TRUE)
+        self.assertEvalsTo(u"(sequence? (range 3))", TRUE)
         self.assertEvalsTo(u"(sequence? #false)", FALSE)
         self.assertEvalsTo(u"(sequence? #null)", FALSE)
         
@@ -637,3 +1237,114 @@ class SequencePredicateTest(PreludeTestCase):
             self.eval(u"(sequence?)"), wrong_argument_number)
         self.assertTrifleError(
             self.eval(u"(sequence? 0 0)"), wrong_argument_number)
+
+
+REFERENCE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "prelude_reference.tfl")
+
+
+def env_with_reference():
+    """Return an environment where the Trifle definitions in
+    prelude_reference.tfl replace the equivalent built-ins.
+
+    """
+    env = env_with_prelude()
+    evaluate_program(parse(lex(get_contents(REFERENCE_PATH))), env)
+    return env
+
+
+class ReferenceImplementationTest(PreludeTestCase):
+    """Built-ins that used to be defined in the prelude should give the
+    same results as the Trifle definitions.
+
+    """
+    reference_env = env_with_reference()
+
+    def assertMatchesReference(self, program):
+        result = self.eval(program)
+        reference_result = self.eval(program, self.reference_env)
+
+        # Error messages may differ, but the error types should not.
+        if isinstance(reference_result, TrifleExceptionInstance):
+            self.assertTrifleError(result, reference_result.exception_type)
+        else:
+            self.assertEqual(result, reference_result)
+
+    def test_reference_is_trifle(self):
+        self.assertEqual(
+            self.eval(u"map", self.reference_env).__class__.__name__, "Lambda")
+
+    def test_map(self):
+        self.assertMatchesReference(u"(map (lambda (x) (* x 2)) (list 1 2 3))")
+        self.assertMatchesReference(u'(map inc #bytes("abc"))')
+        self.assertMatchesReference(u'(map (lambda (x) \'z\') "abc")')
+        self.assertMatchesReference(u"(map inc (list))")
+
+    def test_map_errors(self):
+        self.assertMatchesReference(u'(map inc "abc")')
+        self.assertMatchesReference(u"(map 1 (list 1))")
+        self.assertMatchesReference(u"(map inc 1)")
+        self.assertMatchesReference(u'(map (lambda (x) 256) #bytes("a"))')
+        self.assertMatchesReference(u"(map inc)")
+
+    def test_filter(self):
+        self.assertMatchesReference(u"(filter (lambda (x) (< x 2)) (list 1 2 3 0))")
+        self.assertMatchesReference(u'(filter (lambda (x) (equal? x \'b\')) "abcb")')
+        self.assertMatchesReference(u'(filter (lambda (x) (< x 99)) #bytes("abc"))')
+
+    def test_filter_errors(self):
+        self.assertMatchesReference(u"(filter (lambda (x) 1) (list 1))")
+        self.assertMatchesReference(u"(filter inc #null)")
+
+    def test_join(self):
+        self.assertMatchesReference(u'(join (list 1) (list 2 3) "ab")')
+        self.assertMatchesReference(u'(join "a" "bc" "")')
+        self.assertMatchesReference(u'(join #bytes("a") (list 98))')
+        self.assertMatchesReference(u'(join "a" (list 1))')
+        self.assertMatchesReference(u"(join 1)")
+        self.assertMatchesReference(u"(join (list 1) 2)")
+        self.assertMatchesReference(u"(join)")
+
+    def test_join_mutate(self):
+        self.assertMatchesReference(u"(set! x (list 1)) (join! x (list 2) (list 3)) x")
+        self.assertMatchesReference(u"(join! (list) (list 1))")
+        self.assertMatchesReference(u'(join! "a" (list 1))')
+
+    def test_rest(self):
+        self.assertMatchesReference(u"(rest (list 1 2 3))")
+        self.assertMatchesReference(u'(rest "abc")')
+        self.assertMatchesReference(u'(rest #bytes("abc"))')
+        self.assertMatchesReference(u"(rest (list))")
+        self.assertMatchesReference(u"(rest 1)")
+
+    def test_copy(self):
+        self.assertMatchesReference(u"(copy (list 1 (list 2)))")
+        self.assertMatchesReference(u'(copy "abc")')
+        self.assertMatchesReference(u'(copy #bytes("abc"))')
+        self.assertMatchesReference(u"(copy 1)")
+
+    def test_range(self):
+        self.assertMatchesReference(u"(range 5)")
+        self.assertMatchesReference(u"(range 0)")
+        self.assertMatchesReference(u"(range 2.5)")
+        self.assertMatchesReference(u"(range 5/2)")
+        self.assertMatchesReference(u"(range -1)")
+        self.assertMatchesReference(u'(range "a")')
+
+    def test_append(self):
+        self.assertMatchesReference(u"(set! x \"ab\") (append! x 'c') x")
+        self.assertMatchesReference(u"(append! (list) 1)")
+        self.assertMatchesReference(u'(append! #bytes("") 256)')
+        self.assertMatchesReference(u'(append! "" 1)')
+        self.assertMatchesReference(u"(append! 1 2)")
+
+    def test_sort(self):
+        self.assertMatchesReference(u"(sort (list 5 3 2 1 4))")
+        self.assertMatchesReference(u"(sort (list 2 1.5 1/2 2))")
+        self.assertMatchesReference(u"(sort (list))")
+
+    def test_empty_predicate(self):
+        self.assertMatchesReference(u"(empty? (list))")
+        self.assertMatchesReference(u'(empty? "a")')
+        self.assertMatchesReference(u"(empty? 1)")
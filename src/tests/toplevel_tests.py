@@ -2,7 +2,11 @@ import os
 import unittest
 from tempfile import NamedTemporaryFile
 
-from main import entry_point, USAGE
+from main import (
+    entry_point, env_with_prelude, USAGE,
+    PRELUDE_EXPRESSIONS, PRELUDE_FRESH_SYMBOLS)
+from interpreter.trifle_types import Symbol
+from interpreter.tasks import scheduler
 from test_utils import mock_stdout
 
 
@@ -19,12 +23,34 @@ class TopLevelWithoutArgsTest(unittest.TestCase):
 
 
 class TopLevelSnippetTest(unittest.TestCase):
+    def setUp(self):
+        # Don't let unfinished tasks from another test run in this one.
+        scheduler.tasks = []
+        scheduler.current = None
+
     def test_snippet(self):
         with mock_stdout() as stdout:
             entry_point(['trifle', '-i', '(+ 1 2)'])
 
         self.assertEqual(stdout.getvalue(), '3\n')
 
+    def test_snippet_macro(self):
+        with mock_stdout() as stdout:
+            entry_point(['trifle', '-i', '(macro one () 1) (one)'])
+
+        self.assertEqual(stdout.getvalue(), '1\n')
+
+    def test_snippet_finishes_tasks(self):
+        with mock_stdout():
+            entry_point([
+                'trifle', '-i',
+                '(spawn (lambda () (sleep 0.01) (close! (open "foo.txt" :write))))'
+            ])
+
+        self.assertTrue(os.path.exists("foo.txt"))
+
+        os.remove("foo.txt")
+
     def test_snippet_error(self):
         """If given a snippet that throws an error, we should have a non-zero
         return code.
@@ -62,6 +88,11 @@ class TopLevelSnippetTest(unittest.TestCase):
 
 
 class TopLevelFileTest(unittest.TestCase):
+    def setUp(self):
+        # Don't let unfinished tasks from another test run in this one.
+        scheduler.tasks = []
+        scheduler.current = None
+
     def test_eval_file(self):
         with NamedTemporaryFile() as f:
             f.write('(set! f (open "foo.txt" :write)) (close! f)')
@@ -73,6 +104,38 @@ class TopLevelFileTest(unittest.TestCase):
 
         os.remove("foo.txt")
 
+    def test_eval_file_before_syntax_error(self):
+        """We evaluate each expression as we read it, so expressions before
+        a syntax error are still evaluated.
+
+        """
+        with NamedTemporaryFile() as f:
+            f.write('(set! f (open "foo.txt" :write)) (close! f) (')
+            f.flush()
+
+            return_value = entry_point(['trifle', f.name])
+
+        self.assertNotEqual(return_value, 0)
+        self.assertTrue(os.path.exists("foo.txt"))
+
+        os.remove("foo.txt")
+
+    def test_eval_file_finishes_tasks(self):
+        """Tasks spawned by the last expression should still run before
+        we exit.
+
+        """
+        with NamedTemporaryFile() as f:
+            f.write('(spawn (lambda () (sleep 0.01) (close! (open "foo.txt" :write))))')
+            f.flush()
+
+            return_value = entry_point(['trifle', f.name])
+
+        self.assertEqual(return_value, 0)
+        self.assertTrue(os.path.exists("foo.txt"))
+
+        os.remove("foo.txt")
+
     def test_eval_file_error(self):
         with NamedTemporaryFile() as f:
             f.write('(div 1 0)')
@@ -90,3 +153,20 @@ class TopLevelFileTest(unittest.TestCase):
             return_value = entry_point(['trifle', f.name])
 
         self.assertNotEqual(return_value, 0)
+
+
+class FrozenPreludeTest(unittest.TestCase):
+    def test_macros_expanded(self):
+        """The prelude is macro-expanded when we import main, so we shouldn't
+        need to expand function definitions at startup.
+
+        """
+        for expression in PRELUDE_EXPRESSIONS.values:
+            self.assertNotEqual(expression.values[0], Symbol.intern(u'function'))
+
+    def test_fresh_symbols_not_reused(self):
+        env = env_with_prelude()
+        symbol = env.get(Symbol.intern(u'fresh-symbol')).call([])
+
+        self.assertEqual(
+            symbol, Symbol.intern(u"%d-unnamed" % PRELUDE_FRESH_SYMBOLS))